@@ -8,12 +8,14 @@ from .wurb_utils import singleton
 
 # Lib modules.
 from .lib.solartime import SolarTime
+from .lib.dsp4bats import dsp_cache
 from .lib.dsp4bats.frequency_domain_utils import DbfsSpectrumUtil
-# # Check if librosa is available.
-# try:
-#     import librosa
-#     from .lib.dsp4bats.time_domain_utils import SignalUtil 
-# except: pass
+from .lib.dsp4bats.wave_file_utils import WaveFileReader
+from .lib.dsp4bats import spectrogram_tiles
+from .lib.dsp4bats.spectrogram_tiles import SpectrogramTileReader
+from .lib.dsp4bats.time_domain_utils import int16_to_float
+from .lib.dsp4bats.time_domain_utils import ButterworthFilterBank
+from .lib.dsp4bats.time_domain_utils import SignalUtil
 
 # Base classes for sound streaming.
 from .lib.dsp4bats.sound_stream_manager import SoundStreamManager
@@ -26,11 +28,30 @@ from wurb_core.lib.pettersson_m500_batmic import PetterssonM500BatMic
 # WURB Modules.
 from .wurb_sunset_sunrise import WurbSunsetSunrise # Singleton.
 from .wurb_gps_reader import WurbGpsReader # Singleton.
+from .wurb_metadata import WurbMetadata # Singleton.
+from .wurb_sound_cards import WurbSoundCards # Singleton.
+from .wurb_storage import WurbStorageManager # Singleton.
+from .wurb_preview import WurbPreviewGenerator # Singleton.
 from .wurb_settings import WurbSettings
 from .wurb_state_machine import WurbStateMachine
 from .wurb_scheduler import WurbScheduler
 from .wurb_logging import WurbLogging
 
+# File writers for USB memories and SD cards.
+from .wurb_wave_writer import WurbWaveWriter
+from .wurb_wave_writer import get_erase_block_size
+from .wurb_wave_writer import WAVE_HEADER_SIZE
+from .wurb_wave_writer import guano_chunk
+from .wurb_wave_writer import repair_wave_file
+from .wurb_wave_writer import PARTIAL_FILE_SUFFIX
+from .wurb_flac_writer import WurbFlacWriter
+from .wurb_flac_writer import is_flac_available
+from .wurb_file_writer import WurbFileWriter
+from .wurb_staging import WurbStagingMover
+from .wurb_catalog import WurbCatalog
+from .wurb_manifest import verify_manifests
+from .wurb_chirp_metrics import extract_metrics
+
 # Sound data flow from microphone to file.
 from .wurb_recorder import get_device_list
 from .wurb_recorder import get_device_index
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2017-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import functools
+import numpy as np
+import scipy.signal
+# scipy.fft is available in scipy 1.4 and later.
+try:
+    import scipy.fft
+    scipy_fft_available = True
+except ImportError:
+    scipy_fft_available = False
+
+# Process wide tables shared by detectors and offline tools. Bounded by LRU
+# eviction. Returned arrays are read only since they are shared, except
+# filter coefficients.
+CACHE_MAX_SIZE = 32
+
+_fft_workers = 1
+
+def get_window(window_function, window_size, kaiser_beta=14, dtype=np.float64):
+    """ Window function array. Names as in DbfsSpectrumUtil. """
+    window_key = _window_key(window_function, window_size, kaiser_beta)
+    if np.dtype(dtype) == np.float64:
+        return _cached_window(*window_key)
+    return _cached_window_as(*window_key, np.dtype(dtype).name)
+
+def get_dbfs_max(window_function, window_size, kaiser_beta=14):
+    """ Max db value in window. DBFS = db full scale. Half spectrum used. """
+    return _cached_dbfs_max(*_window_key(window_function, window_size, kaiser_beta))
+
+def get_freq_bins_hz(window_size, sampling_freq):
+    """ Frequency for each rfft bin, from "0" to "FS/2" inclusive. """
+    return _cached_freq_bins_hz(int(window_size), float(sampling_freq))
+
+def get_butterworth_sos(filter_type, freq_hz, filter_order, sampling_freq):
+    """ Butterworth filter as second-order sections. filter_type: "highpass", 
+        "lowpass", "bandpass" or "bandstop". freq_hz: One value, or 
+        (low, high) for band filters. """
+    return _cached_butterworth_sos(filter_type, tuple(np.atleast_1d(freq_hz).astype(float)), 
+                                   int(filter_order), float(sampling_freq))
+
+def rfft(signal, axis=-1, overwrite_x=False):
+    """ Real FFT. scipy.fft is used if available. It keeps a cache of FFT plans
+        and can use more than one worker thread for stacked frames. """
+    if scipy_fft_available:
+        return scipy.fft.rfft(signal, axis=axis, overwrite_x=overwrite_x, workers=_fft_workers)
+    return np.fft.rfft(signal, axis=axis)
+
+def set_fft_workers(workers):
+    """ Number of threads for stacked FFTs. -1: One per CPU core. """
+    global _fft_workers
+    _fft_workers = workers
+
+def cache_info():
+    """ Hits, misses and size for each table. """
+    return {'window': _cached_window.cache_info(),
+            'window_as': _cached_window_as.cache_info(),
+            'dbfs_max': _cached_dbfs_max.cache_info(),
+            'freq_bins_hz': _cached_freq_bins_hz.cache_info(),
+            'butterworth_sos': _cached_butterworth_sos.cache_info()}
+
+def cache_clear():
+    """ """
+    _cached_window.cache_clear()
+    _cached_window_as.cache_clear()
+    _cached_dbfs_max.cache_clear()
+    _cached_freq_bins_hz.cache_clear()
+    _cached_butterworth_sos.cache_clear()
+
+def _window_key(window_function, window_size, kaiser_beta):
+    """ Cache key. Beta is only used for kaiser. """
+    name = window_function.lower()
+    if name in ['hanning', 'hann']:
+        return 'hann', int(window_size), None
+    elif name in ['blackman', 'black']:
+        return 'blackman', int(window_size), None
+    elif name in ['blackmanharris', 'blackman-harris', 'blackh']:
+        return 'blackmanharris', int(window_size), None
+    elif name in ['kaiser']:
+        return 'kaiser', int(window_size), float(kaiser_beta)
+    else:
+        raise UserWarning("Invalid window function name.")
+
+@functools.lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_window(name, window_size, kaiser_beta):
+    """ Symmetric windows. Same functions as used before the cache. """
+    if name == 'hann':
+        window = np.hanning(window_size)
+    elif name == 'blackman':
+        window = np.blackman(window_size)
+    elif name == 'blackmanharris':
+        window = scipy.signal.windows.blackmanharris(window_size)
+    else:
+        window = scipy.signal.windows.kaiser(window_size, kaiser_beta)
+    window.setflags(write=False)
+    return window
+
+@functools.lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_window_as(name, window_size, kaiser_beta, dtype_name):
+    """ Copies of the float64 windows, for example float32. """
+    window_as = _cached_window(name, window_size, kaiser_beta).astype(dtype_name)
+    window_as.setflags(write=False)
+    return window_as
+
+@functools.lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_dbfs_max(name, window_size, kaiser_beta):
+    """ """
+    return np.sum(_cached_window(name, window_size, kaiser_beta)) / 2
+
+@functools.lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_freq_bins_hz(window_size, sampling_freq):
+    """ """
+    bins_in_hz = np.fft.rfftfreq(window_size) * sampling_freq
+    bins_in_hz.setflags(write=False)
+    return bins_in_hz
+
+@functools.lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_butterworth_sos(filter_type, freq_hz, filter_order, sampling_freq):
+    """ """
+    # Normalised to the Nyquist frequency. The "fs" argument needs scipy 1.2.
+    nyquist = 0.5 * sampling_freq
+    limits = [freq / nyquist for freq in freq_hz]
+    if len(limits) == 1:
+        limits = limits[0]
+    sos = scipy.signal.butter(filter_order, limits, btype=filter_type, output='sos')
+    # Read only, shared by all filters. The Cython code in sosfilt needs a 
+    # writable buffer, filters use a copy.
+    sos.setflags(write=False)
+    return sos
+
+
+# === TEST ===
+if __name__ == "__main__":
+    """ """
+    print('Test started.')
+    window_1 = get_window('kaiser', 1024, 14)
+    window_2 = get_window('Kaiser', 1024, 14)
+    print('Same window object: ', window_1 is window_2)
+    print('dBFS max: ', get_dbfs_max('kaiser', 1024, 14))
+    print('Bins: ', get_freq_bins_hz(8, 384000))
+    print('SOS shape: ', get_butterworth_sos('highpass', 15000, 9, 384000).shape, 
+          '  Read only: ', not get_butterworth_sos('highpass', 15000, 9, 384000).flags.writeable)
+    print('Spectrum: ', np.round(np.abs(rfft(window_1))[:3], 3))
+    print('Cache info: ', cache_info())
+    print('Test ended.')
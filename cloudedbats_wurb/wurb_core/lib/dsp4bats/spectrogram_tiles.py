@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2017-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import numpy as np
+try:
+    from .frequency_domain_utils import DbfsSpectrumUtil
+    from .wave_file_utils import WaveFileReader
+except ImportError:
+    from frequency_domain_utils import DbfsSpectrumUtil # Used as script.
+    from wave_file_utils import WaveFileReader
+
+# Tile files are NumPy npz files, one per recording. Each tile is a uint8
+# array [columns, rows] with time as columns and frequency as rows. Level 0
+# has full resolution, each following level has half the number of columns,
+# and half the number of rows down to MIN_ROWS. Max values are kept when
+# levels are reduced, short chirps remain visible in zoomed out views.
+TILE_FILE_SUFFIX = '_tiles.npz'
+MIN_ROWS = 32
+
+def tile_key(level, tile_index):
+    """ """
+    return 'level_' + str(level) + '_tile_' + str(tile_index)
+
+def quantise_dbfs(dbfs_matrix, min_dbfs=-120.0, max_dbfs=0.0, out=None):
+    """ dBFS to uint8. Steps are (max_dbfs - min_dbfs) / 255 dB. """
+    scale = 255.0 / (max_dbfs - min_dbfs)
+    scaled = (np.asarray(dbfs_matrix, dtype=np.float32) - min_dbfs) * scale + 0.5
+    np.clip(scaled, 0, 255, out=scaled)
+    if out is None:
+        return scaled.astype(np.uint8)
+    out[:] = scaled
+    return out
+
+def dequantise_dbfs(tile, min_dbfs=-120.0, max_dbfs=0.0):
+    """ uint8 to dBFS as float32. """
+    scale = np.float32((max_dbfs - min_dbfs) / 255.0)
+    return tile.astype(np.float32) * scale + np.float32(min_dbfs)
+
+def reduce_by_max(matrix, axis):
+    """ Half size along axis. Max of pairs, the last odd item is kept. """
+    matrix = np.asarray(matrix)
+    length = matrix.shape[axis]
+    if length < 2:
+        return matrix
+    pairs = length // 2
+    even = np.take(matrix, np.arange(0, 2 * pairs, 2), axis=axis)
+    odd = np.take(matrix, np.arange(1, 2 * pairs, 2), axis=axis)
+    reduced = np.maximum(even, odd)
+    if length % 2:
+        reduced = np.concatenate([reduced, np.take(matrix, [length - 1], axis=axis)], axis=axis)
+    return reduced
+
+def create_tile_file(wave_path,
+                     tile_path=None, # Default: Next to the wave file.
+                     sampling_freq=None, # Default: From the wave header.
+                     window_size=512,
+                     jump=None, # Default: No overlap, keeps the file small.
+                     tile_size=256, # Columns per tile.
+                     min_dbfs=-120.0,
+                     max_dbfs=0.0):
+    """ Calculates the spectrogram once and stores all levels as tiles. The
+        wave file is memory mapped and the spectrogram is calculated for one
+        tile at a time in float32. Returns the path to the tile file. """
+    if tile_path is None:
+        tile_path = os.path.splitext(wave_path)[0] + TILE_FILE_SUFFIX
+    if jump is None:
+        jump = window_size
+    with WaveFileReader(wave_path) as wave_reader:
+        if sampling_freq is None:
+            sampling_freq = wave_reader.header_sampling_freq
+        number_of_frames = wave_reader.number_of_frames
+        data = wave_reader.data()
+        # Level 0.
+        number_of_columns = max(0, (number_of_frames - window_size) // jump + 1)
+        rows = int(window_size / 2)
+        level_matrix = np.zeros((number_of_columns, rows), dtype=np.uint8)
+        dbfs_util = DbfsSpectrumUtil(window_size=window_size,
+                                     window_function='hann',
+                                     sampling_freq=sampling_freq,
+                                     dtype=np.float32)
+        dbfs_buffer = np.empty((tile_size, rows), dtype=np.float32)
+        for first_column in range(0, number_of_columns, tile_size):
+            columns = min(tile_size, number_of_columns - first_column)
+            start_index = first_column * jump
+            end_index = start_index + (columns - 1) * jump + window_size
+            signal = wave_reader.float_signal(data[start_index:end_index])
+            dbfs_matrix = dbfs_util.calc_dbfs_matrix(signal, matrix_size=tile_size,
+                                                     jump=jump, out=dbfs_buffer)
+            quantise_dbfs(dbfs_matrix[:columns], min_dbfs, max_dbfs,
+                          out=level_matrix[first_column:first_column + columns])
+        del data
+    # All levels, split in tiles.
+    tile_dict = {}
+    level_columns = []
+    level_rows = []
+    level_freq_factors = []
+    freq_factor = 1
+    level = 0
+    while True:
+        for tile_index, first_column in enumerate(range(0, len(level_matrix), tile_size)):
+            tile_dict[tile_key(level, tile_index)] = level_matrix[first_column:first_column + tile_size]
+        level_columns.append(level_matrix.shape[0])
+        level_rows.append(level_matrix.shape[1])
+        level_freq_factors.append(freq_factor)
+        if level_matrix.shape[0] <= tile_size:
+            break
+        level_matrix = reduce_by_max(level_matrix, axis=0)
+        if level_matrix.shape[1] > MIN_ROWS:
+            level_matrix = reduce_by_max(level_matrix, axis=1)
+            freq_factor *= 2
+        level += 1
+    # Written to a temporary file first. Readers never see half written files.
+    tmp_path = tile_path + '.tmp'
+    with open(tmp_path, 'wb') as tile_file:
+        np.savez_compressed(tile_file,
+                            sampling_freq=np.float64(sampling_freq),
+                            number_of_frames=np.int64(number_of_frames),
+                            window_size=np.int64(window_size),
+                            jump=np.int64(jump),
+                            tile_size=np.int64(tile_size),
+                            min_dbfs=np.float64(min_dbfs),
+                            max_dbfs=np.float64(max_dbfs),
+                            level_columns=np.array(level_columns, dtype=np.int64),
+                            level_rows=np.array(level_rows, dtype=np.int64),
+                            level_freq_factors=np.array(level_freq_factors, dtype=np.int64),
+                            **tile_dict)
+    os.replace(tmp_path, tile_path)
+    #
+    return tile_path
+
+def open_tile_file(wave_path, tile_path=None, **kwargs):
+    """ Lazy creation. The tile file is created on first request, or if
+        the wave file is newer. kwargs are used by create_tile_file(). """
+    if tile_path is None:
+        tile_path = os.path.splitext(wave_path)[0] + TILE_FILE_SUFFIX
+    if (not os.path.exists(tile_path)) or \
+       (os.path.getmtime(tile_path) < os.path.getmtime(wave_path)):
+        create_tile_file(wave_path, tile_path=tile_path, **kwargs)
+    return SpectrogramTileReader(tile_path)
+
+
+class SpectrogramTileReader():
+    """ Reads spectrogram views from a tile file. Only the tiles inside the
+        view are decompressed and the wave file is not used.
+        Usage:
+            with SpectrogramTileReader('test_tiles.npz') as tile_reader:
+                dbfs_matrix, time_s, freq_hz = tile_reader.get_viewport(
+                                            start_s=1.2, end_s=1.3, max_columns=800)
+    """
+    def __init__(self, tile_path):
+        """ """
+        self.tile_path = tile_path
+        self._npz = np.load(tile_path, allow_pickle=False)
+        self.sampling_freq = float(self._npz['sampling_freq'])
+        self.number_of_frames = int(self._npz['number_of_frames'])
+        self.window_size = int(self._npz['window_size'])
+        self.jump = int(self._npz['jump'])
+        self.tile_size = int(self._npz['tile_size'])
+        self.min_dbfs = float(self._npz['min_dbfs'])
+        self.max_dbfs = float(self._npz['max_dbfs'])
+        self._level_columns = self._npz['level_columns']
+        self._level_rows = self._npz['level_rows']
+        self._level_freq_factors = self._npz['level_freq_factors']
+        self.number_of_levels = len(self._level_columns)
+
+    def get_level_info(self, level):
+        """ Size and resolution for a level. """
+        time_step_s = self.jump * (2 ** level) / self.sampling_freq
+        freq_step_hz = int(self._level_freq_factors[level]) * self.sampling_freq / self.window_size
+        return {'columns': int(self._level_columns[level]),
+                'rows': int(self._level_rows[level]),
+                'time_step_s': time_step_s,
+                'freq_step_hz': freq_step_hz}
+
+    def get_tile(self, level, tile_index):
+        """ uint8 tile, [columns, rows]. """
+        return self._npz[tile_key(level, tile_index)]
+
+    def get_viewport(self,
+                     start_s=0.0,
+                     end_s=None, # Default: To the end.
+                     min_freq_hz=0.0,
+                     max_freq_hz=None, # Default: Half sampling frequency.
+                     max_columns=1000, # The most detailed level within this is used.
+                     level=None, # Use a specific level.
+                     as_dbfs=True): # False: uint8 as stored.
+        """ Returns the matrix [time, freq], and the start time and frequency
+            for each column and row. """
+        if end_s is None:
+            end_s = self.number_of_frames / self.sampling_freq
+        if max_freq_hz is None:
+            max_freq_hz = self.sampling_freq / 2
+        # Select level.
+        if level is None:
+            level = self.number_of_levels - 1
+            for test_level in range(self.number_of_levels):
+                time_step_s = self.get_level_info(test_level)['time_step_s']
+                if (end_s - start_s) / time_step_s <= max_columns:
+                    level = test_level
+                    break
+        level_info = self.get_level_info(level)
+        # Columns and rows inside the view.
+        first_column = max(0, int(start_s / level_info['time_step_s']))
+        last_column = min(level_info['columns'],
+                          int(np.ceil(end_s / level_info['time_step_s'])))
+        first_row = max(0, int(min_freq_hz / level_info['freq_step_hz']))
+        last_row = min(level_info['rows'],
+                       int(np.ceil(max_freq_hz / level_info['freq_step_hz'])))
+        # Tiles inside the view.
+        matrix_parts = []
+        if last_column > first_column:
+            first_tile = first_column // self.tile_size
+            last_tile = (last_column - 1) // self.tile_size
+            for tile_index in range(first_tile, last_tile + 1):
+                tile_start = tile_index * self.tile_size
+                tile = self.get_tile(level, tile_index)
+                matrix_parts.append(tile[max(0, first_column - tile_start):
+                                         last_column - tile_start,
+                                         first_row:last_row])
+        if matrix_parts:
+            matrix = np.concatenate(matrix_parts, axis=0)
+        else:
+            matrix = np.zeros((0, max(0, last_row - first_row)), dtype=np.uint8)
+        if as_dbfs:
+            matrix = dequantise_dbfs(matrix, self.min_dbfs, self.max_dbfs)
+        time_s = np.arange(first_column, first_column + len(matrix)) * level_info['time_step_s']
+        freq_hz = np.arange(first_row, first_row + matrix.shape[1]) * level_info['freq_step_hz']
+        #
+        return matrix, time_s, freq_hz
+
+    def close(self):
+        """ """
+        if self._npz is not None:
+            self._npz.close()
+            self._npz = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# === TEST ===
+if __name__ == "__main__":
+    """ """
+    import time
+    from wave_file_utils import WaveFileWriter
+    from time_domain_utils import SignalUtil
+    print('Test started.')
+    signal_util = SignalUtil(sampling_freq=384000, dtype=np.float32)
+    wave_writer = WaveFileWriter('test.wav', sampling_freq=384000)
+    for block in signal_util.chirp_block_generator(signal_util.chirp_schedule(
+                                    signal_util.chirp_template(), duration_s=20),
+                                    duration_s=20, seed=1):
+        wave_writer.write_buffer(block)
+    wave_writer.close()
+    #
+    start_time = time.time()
+    tile_path = create_tile_file('test.wav')
+    print('Create time (s): ', round(time.time() - start_time, 2),
+          '  Size (kB): ', round(os.path.getsize(tile_path) / 1000))
+    start_time = time.time()
+    with SpectrogramTileReader(tile_path) as tile_reader:
+        print('Levels: ', tile_reader.number_of_levels)
+        for start_s, end_s in [(0.0, 20.0), (5.0, 7.0), (10.0, 10.1)]:
+            dbfs_matrix, time_s, freq_hz = tile_reader.get_viewport(start_s, end_s,
+                                                                    min_freq_hz=15000)
+            print('View: ', start_s, end_s, ' Shape: ', dbfs_matrix.shape,
+                  ' Max dBFS: ', round(float(dbfs_matrix.max()), 1))
+    print('Read time (ms): ', round((time.time() - start_time) * 1000, 1))
+    os.remove('test.wav')
+    os.remove(tile_path)
+    print('Test ended.')
@@ -6,20 +6,29 @@
 
 import numpy as np
 import scipy.signal
-# Check if librosa is available.
-librosa_available = False
 try:
-    import librosa
-    librosa_available = True
-except: pass
+    from . import dsp_cache
+except ImportError:
+    import dsp_cache # Used as script.
+
+def int16_to_float(data_int16, out=None, dtype=np.float32):
+    """ Scales int16 samples to the range [-1.0, 1.0]. Written to "out" if 
+        given, for example a buffer reused for each frame. No temporary 
+        float64 arrays. """
+    if out is None:
+        out = np.empty(len(data_int16), dtype=dtype)
+    np.multiply(data_int16, out.dtype.type(1.0 / 32768.0), out=out)
+    return out
 
 class SignalUtil():
     """ """
     def __init__(self, 
                  sampling_freq=384000,
+                 dtype=np.float64, # np.float32: Faster, for real-time use.
                  ):
         """ """
         self.sampling_freq = sampling_freq
+        self.dtype = np.dtype(dtype).type
         self.array_in_sec = None
 
     def get_array_in_sec(self, signal):
@@ -28,7 +37,7 @@ class SignalUtil():
 
     def noise_level(self, signal):
         """ """
-        return np.sqrt(np.mean(np.square(signal)))
+        return np.sqrt(np.mean(np.square(signal, dtype=self.dtype)))
 
     def noise_level_in_db(self, signal):
         """ """
@@ -38,42 +47,29 @@ class SignalUtil():
                            low_freq_hz=None, # For highpass and bandpass filters
                            high_freq_hz=None, # For lowpass and bandpass filters
                            filter_order=9,  
-                           bandstop=False): # Use both low_ and high_freq_hz for bandstop. 
-        """ Filter. Butterworth. """
-        nyquist = 0.5 * self.sampling_freq
-        #
-        if (low_freq_hz is not None) and (high_freq_hz is None) and (bandstop is False):
-            low = low_freq_hz / nyquist
-            b, a = scipy.signal.butter(filter_order, [low], btype='highpass')
-        elif (low_freq_hz is None) and (high_freq_hz is None) and (bandstop is False):
-            high = high_freq_hz / nyquist
-            b, a = scipy.signal.butter(filter_order, [high], btype='lowpass')
-        elif (low_freq_hz is None) and (high_freq_hz is None) and (bandstop is False):
-            low = low_freq_hz / nyquist
-            high = high_freq_hz / nyquist
-            b, a = scipy.signal.butter(filter_order, [low, high], btype='bandpass')
-        elif (low_freq_hz is not None) and (high_freq_hz is not None) and (bandstop is True):
-            low = low_freq_hz / nyquist
-            high = high_freq_hz / nyquist
-            b, a = scipy.signal.butter(filter_order, [low, high], btype='bandstop')
-        else:
+                           bandstop=False, # Use both low_ and high_freq_hz for bandstop. 
+                           zero_phase=True): # False: Causal, one pass. 
+        """ Filter. Butterworth. Zero phase is used for offline analysis. 
+            Use ButterworthFilterBank for streamed buffers. """
+        filter_type, freq_hz = butterworth_filter_type(low_freq_hz, high_freq_hz, bandstop)
+        if filter_type is None:
             return signal
-        # Apply folter on signal.
-        # filtered_signal = scipy.signal.lfilter(b, a, signal)
-        filtered_signal = scipy.signal.filtfilt(b, a, signal)
+        # Writable copy of the shared coefficients, needed by sosfilt.
+        sos = dsp_cache.get_butterworth_sos(filter_type, freq_hz, filter_order, self.sampling_freq).copy()
+        # Apply filter on signal.
+        if zero_phase:
+            filtered_signal = scipy.signal.sosfiltfilt(sos, signal)
+        else:
+            filtered_signal = scipy.signal.sosfilt(sos, signal)
         #
-        return filtered_signal
+        return filtered_signal.astype(self.dtype, copy=False)
     
     def find_localmax(self, signal,
                       noise_threshold=0.0, # Range: [0.0, 1.0]. 
                       jump=None, 
                       frame_length=1024):
-        """ """
-        if not librosa_available:
-            print('ERROR: Error in find_localmax. Librosa not installed.')
-            index_list = []
-            return index_list
-        
+        """ Peaks in framed RMS. Returns sample indexes. Same result as the 
+            earlier librosa based version (feature.rmse and util.localmax). """
         # Adjust for comparable results for low sampling rates.
         if self.sampling_freq < 300000:
             frame_length = int(frame_length / 2) 
@@ -82,11 +78,10 @@ class SignalUtil():
         y = signal.copy()
         if noise_threshold > 0.0:
             y[(np.abs(y) < noise_threshold)] = 0.0
-        rmse = librosa.feature.rmse(y=y, hop_length=jump, frame_length=frame_length, center=True)
-        locmax = librosa.util.localmax(rmse.T)
-        maxindexlist = [index for index, a in enumerate(locmax) if a==True]
+        rms = framed_rms(y, frame_length=frame_length, hop_length=jump, center=True)
+        maxindexlist = np.flatnonzero(localmax(rms))
         # Original index list is related to jump length. Convert.
-        index_list = librosa.frames_to_samples(maxindexlist, hop_length=jump)
+        index_list = maxindexlist * jump
         #
         return index_list
 
@@ -100,27 +95,241 @@ class SignalUtil():
                         number_of_chirps = 10, 
                         ):
         """ """
-        # Create chirp. The shape is in between FM and QCF calls.
-        time = np.linspace(0, duration_s, int(self.sampling_freq * duration_s))
-        chirp = scipy.signal.waveforms.chirp(time, 
-                                             f0=start_freq_hz, 
-                                             f1=end_freq_hz, 
-                                             t1=duration_s, 
-                                             method='quadratic', 
-                                             vertex_zero=False)
-        # Apply window function and amplitude.
-        chirp = chirp * scipy.signal.hanning(len(time)) * max_amplitude
+        chirp = self.chirp_template(start_freq_hz=start_freq_hz, 
+                                    end_freq_hz=end_freq_hz, 
+                                    duration_s=duration_s, 
+                                    max_amplitude=max_amplitude, 
+                                    dtype=np.float64)
         # Create silent part.
         silent_duration = chirp_interval_s - duration_s
-        silent_half = np.zeros(int(self.sampling_freq * silent_duration / 2))
-        # Build sequence.
-        signal = []
+        silent_half_length = int(self.sampling_freq * silent_duration / 2)
+        # Build sequence. Preallocated, chirps are copied in place.
+        period_length = 2 * silent_half_length + len(chirp)
+        signal = np.zeros(number_of_chirps * period_length)
         for index in range(number_of_chirps):
-            signal = np.concatenate((signal, silent_half, chirp, silent_half))
+            chirp_start = index * period_length + silent_half_length
+            signal[chirp_start:chirp_start + len(chirp)] = chirp
         # Add noise.
-        signal = signal + np.random.randn(len(signal)) * noise_level
+        signal += np.random.randn(len(signal)) * noise_level
         # 
-        return signal
+        return signal.astype(self.dtype, copy=False)
+
+    def chirp_template(self, 
+                       start_freq_hz = 100000, 
+                       end_freq_hz = 20000, 
+                       duration_s = 0.008, 
+                       max_amplitude = 0.3, 
+                       method = 'quadratic', 
+                       dtype = None, # Default: Same as SignalUtil.
+                       ):
+        """ One chirp with window function applied. The default shape is 
+            in between FM and QCF calls. """
+        time = np.linspace(0, duration_s, int(self.sampling_freq * duration_s))
+        chirp = scipy.signal.chirp(time, 
+                                   f0=start_freq_hz, 
+                                   f1=end_freq_hz, 
+                                   t1=duration_s, 
+                                   method=method, 
+                                   vertex_zero=False)
+        # Apply window function and amplitude.
+        chirp = chirp * np.hanning(len(time)) * max_amplitude
+        #
+        return chirp.astype(dtype or self.dtype, copy=False)
+
+    def chirp_schedule(self, 
+                       templates, # One template, or a list for mixed call types.
+                       chirp_interval_s = 0.1, 
+                       duration_s = None, # None: Never ending.
+                       start_s = 0.0, 
+                       ):
+        """ Generator for (start_s, template) at regular intervals. Templates 
+            are used in turn. Schedules can be combined with overlapping 
+            calls, sorted by start time:
+                heapq.merge(schedule_1, schedule_2, key=lambda call: call[0])
+        """
+        if isinstance(templates, np.ndarray):
+            templates = [templates]
+        index = 0
+        while True:
+            call_start_s = start_s + index * chirp_interval_s
+            if (duration_s is not None) and (call_start_s >= start_s + duration_s):
+                return
+            yield call_start_s, templates[index % len(templates)]
+            index += 1
+
+    def chirp_block_generator(self, 
+                              schedule, # Iterable of (start_s, template), sorted by start_s.
+                              duration_s = None, # None: Until the last call is finished.
+                              block_size = None, # Default: 0.5 s, as the recorder.
+                              noise_level = 0.002, 
+                              seed = None, # Int for repeatable noise.
+                              ):
+        """ Generator for signal blocks of fixed size. The schedule is read 
+            lazily and calls may overlap, also across block borders. Memory 
+            use is constant for any duration, for example for long soak tests:
+                schedule = signal_util.chirp_schedule(template, duration_s=3600)
+                for block in signal_util.chirp_block_generator(schedule, 3600):
+                    ...
+        """
+        if block_size is None:
+            block_size = int(self.sampling_freq / 2)
+        total_length = None
+        if duration_s is not None:
+            total_length = int(round(duration_s * self.sampling_freq))
+        # RandomState, default_rng() needs numpy 1.17.
+        random_generator = np.random.RandomState(seed)
+        schedule_iter = iter(schedule)
+        next_call = next(schedule_iter, None)
+        active_calls = [] # List of (start_index, template).
+        block_start = 0
+        while True:
+            if total_length is None:
+                if (next_call is None) and (not active_calls):
+                    return
+                block_end = block_start + block_size
+            else:
+                if block_start >= total_length:
+                    return
+                block_end = min(block_start + block_size, total_length)
+            # Noise.
+            block = random_generator.standard_normal(block_end - block_start).astype(self.dtype, copy=False)
+            block *= noise_level
+            # Calls starting in this block.
+            while next_call is not None:
+                start_index = int(round(next_call[0] * self.sampling_freq))
+                if start_index >= block_end:
+                    break
+                active_calls.append((start_index, next_call[1]))
+                next_call = next(schedule_iter, None)
+            # Add the part of each call that is inside the block.
+            still_active = []
+            for start_index, template in active_calls:
+                first = max(start_index, block_start)
+                last = min(start_index + len(template), block_end)
+                if last > first:
+                    block[first - block_start:last - block_start] += \
+                                template[first - start_index:last - start_index]
+                if start_index + len(template) > block_end:
+                    still_active.append((start_index, template))
+            active_calls = still_active
+            #
+            yield block
+            block_start = block_end
+
+def framed_rms(signal, frame_length=1024, hop_length=512, center=True):
+    """ RMS for each frame. Frames are strided views, no copies. 
+        center=True: Frame "n" is centered at sample "n * hop_length", 
+        the signal is padded by reflection. """
+    signal = np.asarray(signal)
+    if center:
+        signal = np.pad(signal, int(frame_length // 2), mode='reflect')
+    number_of_frames = 1 + (len(signal) - frame_length) // hop_length
+    if number_of_frames < 1:
+        return np.zeros(0, dtype=signal.dtype)
+    item_size = signal.strides[0]
+    frames = np.lib.stride_tricks.as_strided(signal, 
+                                    shape=(number_of_frames, frame_length), 
+                                    strides=(hop_length * item_size, item_size), 
+                                    writeable=False)
+    # Sum of squares per frame without a temporary copy of all frames.
+    rms = np.einsum('ij,ij->i', frames, frames)
+    rms /= frame_length
+    return np.sqrt(rms, out=rms)
+
+def localmax(values):
+    """ True where a value is larger than the previous value and not smaller 
+        than the next value. The edges are compared with themselves. """
+    values = np.asarray(values)
+    if len(values) == 0:
+        return np.zeros(0, dtype=bool)
+    padded = np.pad(values, 1, mode='edge')
+    return (values > padded[:-2]) & (values >= padded[2:])
+
+def butterworth_filter_type(low_freq_hz=None, high_freq_hz=None, bandstop=False):
+    """ Returns filter type and frequency limits, or (None, None) if no 
+        filter should be used. """
+    if (low_freq_hz is not None) and (high_freq_hz is None) and (bandstop is False):
+        return 'highpass', low_freq_hz
+    elif (low_freq_hz is None) and (high_freq_hz is not None) and (bandstop is False):
+        return 'lowpass', high_freq_hz
+    elif (low_freq_hz is not None) and (high_freq_hz is not None) and (bandstop is False):
+        return 'bandpass', (low_freq_hz, high_freq_hz)
+    elif (low_freq_hz is not None) and (high_freq_hz is not None) and (bandstop is True):
+        return 'bandstop', (low_freq_hz, high_freq_hz)
+    return None, None
+
+
+class ButterworthFilterBank():
+    """ Named Butterworth filters for streamed buffers. Coefficients are 
+        designed once as second-order sections and shared via dsp_cache. 
+        Filters are causal (sosfilt) and the filter state is carried from 
+        one buffer to the next, one pass per sample. 
+        Usage:
+            filter_bank = ButterworthFilterBank(sampling_freq=384000)
+            filter_bank.add_filter('highpass', low_freq_hz=15000)
+            for buffer in buffers:
+                filtered = filter_bank.filter_buffer(buffer, 'highpass')
+    """
+    def __init__(self, 
+                 sampling_freq=384000,
+                 dtype=np.float64, # np.float32: Faster, for real-time use.
+                 ):
+        """ """
+        self.sampling_freq = sampling_freq
+        self.dtype = np.dtype(dtype).type
+        self._filter_dict = {} # Name: [sos, state]. State is None before first buffer.
+    
+    def add_filter(self, name, 
+                   low_freq_hz=None, # For highpass and bandpass filters
+                   high_freq_hz=None, # For lowpass and bandpass filters
+                   filter_order=9,  
+                   bandstop=False): # Use both low_ and high_freq_hz for bandstop.
+        """ """
+        filter_type, freq_hz = butterworth_filter_type(low_freq_hz, high_freq_hz, bandstop)
+        if filter_type is None:
+            raise ValueError('Invalid filter limits for: ' + name)
+        # Writable copy of the shared coefficients, needed by sosfilt.
+        sos = dsp_cache.get_butterworth_sos(filter_type, freq_hz, filter_order, self.sampling_freq).copy()
+        self._filter_dict[name] = [sos, None]
+    
+    def remove_filter(self, name):
+        """ """
+        self._filter_dict.pop(name, None)
+    
+    def get_filter_names(self):
+        """ """
+        return list(self._filter_dict.keys())
+    
+    def reset(self, name=None):
+        """ Clears the filter state, for example when a new sound file is
+            started or after a gap in the stream. """
+        for filter_name, filter_item in self._filter_dict.items():
+            if (name is None) or (name == filter_name):
+                filter_item[1] = None
+    
+    def filter_buffer(self, signal, name):
+        """ Causal. The state is carried to the next call. The state for the 
+            first buffer is the steady state for its first sample, to avoid 
+            a startup transient. """
+        filter_item = self._filter_dict[name]
+        sos, state = filter_item
+        if len(signal) == 0:
+            return np.asarray(signal, dtype=self.dtype)
+        if state is None:
+            state = scipy.signal.sosfilt_zi(sos) * signal[0]
+        filtered_signal, filter_item[1] = scipy.signal.sosfilt(sos, signal, zi=state)
+        #
+        return filtered_signal.astype(self.dtype, copy=False)
+    
+    def filter_buffer_all(self, signal):
+        """ Returns a dict with the filtered buffer for each filter. """
+        return {name: self.filter_buffer(signal, name) for name in self._filter_dict}
+    
+    def filter_offline(self, signal, name):
+        """ Zero phase (sosfiltfilt) for a complete signal. Not streamed and 
+            the carried state is not used or changed. """
+        sos = self._filter_dict[name][0]
+        return scipy.signal.sosfiltfilt(sos, signal).astype(self.dtype, copy=False)
 
 
 # === TEST ===    
@@ -155,3 +364,46 @@ if __name__ == "__main__":
 #      
 #     print('Test ended.')
 
+    # Timing for find_localmax(). 5 s at 384 kHz. Compared to one frame at a 
+    # time, and to the earlier librosa based code if librosa is installed.
+    import time
+    print('Test started.')
+    signal_util = SignalUtil(sampling_freq=384000)
+    signal = np.tile(signal_util.chirp_generator(number_of_chirps=10), 5) # 10 chirps per s.
+    jump = 384
+    frame_length = 1024
+    for noise_threshold in [0.0, 0.004, 0.02]:
+        start_time = time.time()
+        index_list = signal_util.find_localmax(signal, noise_threshold=noise_threshold, 
+                                               jump=jump, frame_length=frame_length)
+        localmax_time = time.time() - start_time
+        # One frame at a time.
+        y = signal.copy()
+        y[(np.abs(y) < noise_threshold)] = 0.0
+        y = np.pad(y, frame_length // 2, mode='reflect')
+        start_time = time.time()
+        rms = np.array([np.sqrt(np.mean(np.square(y[start:start + frame_length]))) 
+                        for start in range(0, len(y) - frame_length + 1, jump)])
+        loop_index_list = np.flatnonzero(localmax(rms)) * jump
+        loop_time = time.time() - start_time
+        print('find_localmax. Noise threshold: ', noise_threshold, 
+              '  Time (ms): ', np.round(localmax_time * 1000, 1), 
+              '  per frame: ', np.round(loop_time * 1000, 1), 
+              '  Identical: ', np.array_equal(index_list, loop_index_list))
+        try:
+            import librosa
+            start_time = time.time()
+            y = signal.copy()
+            y[(np.abs(y) < noise_threshold)] = 0.0
+            if hasattr(librosa.feature, 'rmse'): # Before librosa 0.7.
+                librosa_rms = librosa.feature.rmse(y=y, frame_length=frame_length, hop_length=jump)
+            else:
+                librosa_rms = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=jump)
+            librosa_index_list = librosa.frames_to_samples(
+                                    np.flatnonzero(librosa.util.localmax(librosa_rms.T)), 
+                                    hop_length=jump)
+            print('    librosa. Time (ms): ', np.round((time.time() - start_time) * 1000, 1), 
+                  '  Identical: ', np.array_equal(index_list, librosa_index_list))
+        except ImportError:
+            pass
+    print('Test ended.')
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2017-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import mmap
+import wave
+import struct
+import numpy as np
+
+class WaveFileReader():
+    """ Memory mapped wave file reader. The data chunk is accessed as a NumPy
+        view without copying, int16 for PCM files and float32 for IEEE float
+        files. Only the pages used are read from disk.
+        Views returned by data(), blocks() and time_slice() are valid until
+        close() is called. Scaled float32 arrays from read_buffer() and
+        float_signal() are copies.
+        Usage:
+            reader = WaveFileReader('test.wav')
+            for block in reader.blocks(block_size=reader.sampling_freq):
+                ...
+            chirp = reader.time_slice(start_s=1.2, duration_s=0.05)
+            reader.close()
+    """
+    def __init__(self, file_path,
+                 time_expanded=False, # True: Real sampling freq is 10 times the header value.
+                 ):
+        """ """
+        self.file_path = str(file_path)
+        self._file = open(self.file_path, 'rb')
+        self._mmap = None
+        self._data = None
+        self._read_index = 0
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._parse_header()
+        except:
+            self.close()
+            raise
+        #
+        self.header_sampling_freq = self._header_sampling_freq
+        self.sampling_freq = self._header_sampling_freq * (10 if time_expanded else 1)
+        self.number_of_frames = len(self._data)
+
+    def _parse_header(self):
+        """ Walks the chunks. Data chunks with zero or too large size, for
+            example after power failures, are limited to the file size. """
+        file_size = len(self._mmap)
+        if (file_size < 12) or (self._mmap[0:4] != b'RIFF') or (self._mmap[8:12] != b'WAVE'):
+            raise ValueError('Not a wave file: ' + self.file_path)
+        format_tag = None
+        data_offset = None
+        data_size = 0
+        position = 12
+        while position + 8 <= file_size:
+            chunk_id, chunk_size = struct.unpack_from('<4sI', self._mmap, position)
+            if chunk_id == b'fmt ':
+                (format_tag, n_channels, sampling_freq, _byte_rate,
+                 _block_align, bits_per_sample) = struct.unpack_from('<HHIIHH', self._mmap, position + 8)
+                if format_tag == 0xfffe: # WAVE_FORMAT_EXTENSIBLE. Subformat first.
+                    format_tag = struct.unpack_from('<H', self._mmap, position + 32)[0]
+            elif chunk_id == b'data':
+                data_offset = position + 8
+                if (chunk_size == 0) or (data_offset + chunk_size > file_size):
+                    chunk_size = file_size - data_offset
+                data_size = chunk_size
+            position += 8 + chunk_size + (chunk_size % 2) # Chunks are word aligned.
+        #
+        if (format_tag is None) or (data_offset is None):
+            raise ValueError('Missing fmt or data chunk: ' + self.file_path)
+        if n_channels != 1:
+            raise ValueError('Only mono files are supported: ' + self.file_path)
+        if (format_tag == 1) and (bits_per_sample == 16):
+            dtype = np.int16
+        elif (format_tag == 3) and (bits_per_sample == 32):
+            dtype = np.float32
+        else:
+            raise ValueError('Only 16 bits PCM and 32 bits float are supported: ' + self.file_path)
+        #
+        self._header_sampling_freq = sampling_freq
+        self._scale = 1.0 / 32768.0 if dtype == np.int16 else 1.0
+        item_size = np.dtype(dtype).itemsize
+        self._data = np.frombuffer(self._mmap, dtype=dtype,
+                                   count=data_size // item_size, offset=data_offset)
+
+    def data(self):
+        """ The whole data chunk as a read only view. """
+        return self._data
+
+    def blocks(self, block_size, overlap=0):
+        """ Generator for views of consecutive blocks. Blocks overlap by
+            "overlap" frames. The last block may be shorter. """
+        block_size = int(block_size)
+        step = block_size - int(overlap)
+        if step <= 0:
+            raise ValueError('Overlap must be smaller than the block size.')
+        for start_index in range(0, max(1, self.number_of_frames - int(overlap)), step):
+            yield self._data[start_index:start_index + block_size]
+
+    def time_slice(self, start_s, duration_s=None):
+        """ Random access by time, in real time (not time expanded). """
+        start_index = max(0, int(round(start_s * self.sampling_freq)))
+        if duration_s is None:
+            return self._data[start_index:]
+        end_index = start_index + int(round(duration_s * self.sampling_freq))
+        return self._data[start_index:end_index]
+
+    def float_signal(self, view=None):
+        """ Scaled to [-1.0, 1.0] as float32. Copy of the view, or of the
+            whole data chunk if no view is given. """
+        if view is None:
+            view = self._data
+        return np.multiply(view, self._scale, dtype=np.float32)
+
+    def read_buffer(self, buffer_size=None):
+        """ Sequential read, scaled to float32. Default buffer size is one
+            second. Returns an empty array at end of file. """
+        if buffer_size is None:
+            buffer_size = self.sampling_freq
+        view = self._data[self._read_index:self._read_index + int(buffer_size)]
+        self._read_index += len(view)
+        return self.float_signal(view)
+
+    def close(self):
+        """ """
+        self._data = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass # Views still in use. Closed when they are released.
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WaveFileWriter():
+    """ Wave file writer for float signals in the range [-1.0, 1.0] or int16.
+        Mono, 16 bits. """
+    def __init__(self, file_path,
+                 sampling_freq=384000,
+                 time_expanded=False, # True: Header value is 1/10 of sampling_freq.
+                 ):
+        """ """
+        self.sampling_freq = int(sampling_freq / 10) if time_expanded else int(sampling_freq)
+        self._wave_file = wave.open(str(file_path), 'wb')
+        self._wave_file.setnchannels(1)
+        self._wave_file.setsampwidth(2)
+        self._wave_file.setframerate(self.sampling_freq)
+
+    def write_buffer(self, signal):
+        """ """
+        signal = np.asarray(signal)
+        if signal.dtype != np.int16:
+            signal = np.clip(signal * 32768.0, -32768, 32767).astype(np.int16)
+        self._wave_file.writeframes(signal.astype('<i2', copy=False).tobytes())
+
+    def close(self):
+        """ """
+        if self._wave_file is not None:
+            self._wave_file.close()
+            self._wave_file = None
+
+
+# === TEST ===
+if __name__ == "__main__":
+    """ """
+    import os
+    import time
+    print('Test started.')
+    signal = np.sin(2 * np.pi * 40000 * np.arange(384000 * 5) / 384000) * 0.5
+    wave_writer = WaveFileWriter('test.wav', sampling_freq=384000, time_expanded=True)
+    wave_writer.write_buffer(signal)
+    wave_writer.close()
+    #
+    start_time = time.time()
+    with WaveFileReader('test.wav', time_expanded=True) as wave_reader:
+        print('Length in sec: ', wave_reader.number_of_frames / wave_reader.sampling_freq)
+        print('Blocks: ', sum(1 for _ in wave_reader.blocks(wave_reader.sampling_freq)))
+        print('Slice at 2.0 s, 10 ms: ', len(wave_reader.time_slice(2.0, 0.01)))
+        buffer = wave_reader.read_buffer()
+        print('Max in first buffer: ', round(float(np.max(buffer)), 3))
+    print('Time (ms): ', round((time.time() - start_time) * 1000, 1))
+    os.remove('test.wav')
+    print('Test ended.')
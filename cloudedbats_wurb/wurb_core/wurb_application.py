@@ -91,6 +91,12 @@ class WurbApplication():
         # Load default settings for wurb_sound_detector.
         desc, default, dev = wurb_core.wurb_sound_detector.default_settings()
         self._settings.set_default_values(desc, default, dev)
+        # Load default settings for wurb_storage.
+        desc, default, dev = wurb_core.wurb_storage.default_settings()
+        self._settings.set_default_values(desc, default, dev)
+        # Load default settings for wurb_preview.
+        desc, default, dev = wurb_core.wurb_preview.default_settings()
+        self._settings.set_default_values(desc, default, dev)
         # Internal and external paths to setting files.
         current_dir = pathlib.Path(__file__).parents[1]
         internal_path = pathlib.Path(current_dir, 'wurb_settings')
@@ -131,6 +137,20 @@ class WurbApplication():
         self._logger.info('')
         self._logger.info('=== GPS startup. ===')
         wurb_core.WurbGpsReader().start()
+        # Time and position for file names. Singleton util.
+        wurb_core.WurbMetadata().start()
+        
+        # Sound cards. Singleton util. Detects added or removed sound cards.
+        self._logger.info('')
+        self._logger.info('=== Sound card startup. ===')
+        wurb_core.WurbSoundCards().start()
+        
+        # Storage. Singleton util. Free space and retention policy.
+        self._logger.info('')
+        self._logger.info('=== Storage manager startup. ===')
+        wurb_core.WurbStorageManager().start()
+        # Previews. Singleton util. Low priority background process.
+        wurb_core.WurbPreviewGenerator().start()
         
         # Initiate sound recorder.
         self._logger.info('')
@@ -160,6 +180,10 @@ class WurbApplication():
         """ """
         # Stop modules.
         wurb_core.WurbGpsReader().stop()
+        wurb_core.WurbMetadata().stop()
+        wurb_core.WurbSoundCards().stop()
+        wurb_core.WurbStorageManager().stop()
+        wurb_core.WurbPreviewGenerator().stop()
         if self._recorder: self._recorder.stop_recording(stop_immediate=True)
         if self._gpio_ctrl: self._gpio_ctrl.stop()
         if self._mouse_ctrl: self._mouse_ctrl.stop()
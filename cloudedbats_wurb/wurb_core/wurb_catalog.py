@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import re
+import struct
+import sqlite3
+import datetime
+import threading
+import logging
+import concurrent.futures
+
+# Columns in the catalog table. Order used for inserts.
+CATALOG_COLUMNS = [
+    ('file_name', 'TEXT PRIMARY KEY'),
+    ('dir_path', 'TEXT'),
+    ('start_time', 'TEXT'), # Local time, same format as in the file name.
+    ('start_time_s', 'REAL'), # Seconds since epoch, UTC.
+    ('duration_s', 'REAL'), # Real time. Not time expanded.
+    ('sampling_freq_hz', 'INTEGER'), # As stored in the file header.
+    ('te_factor', 'INTEGER'), # 1 for FS, 10 for TE.
+    ('rec_type', 'TEXT'), # Example: "FS384".
+    ('latitude', 'REAL'),
+    ('longitude', 'REAL'),
+    ('file_size', 'INTEGER'),
+    ('detections', 'INTEGER'), # Number of buffers with detected sound.
+    ('peak_freq_hz', 'REAL'), # Frequency for the strongest detected peak.
+    ('peak_dbfs', 'REAL'),
+    ('min_freq_hz', 'REAL'), # Lowest and highest peak frequency.
+    ('max_freq_hz', 'REAL'),
+    ]
+CATALOG_INDEXES = ['start_time_s', 'max_freq_hz', 'peak_dbfs']
+
+# Filename example: "WURB1_20180420T205942+0200_N57.6626E12.6393_TE384.wav"
+FILENAME_PATTERN = re.compile(r'^(.*)_(\d{8}T\d{6}[+-]\d{4})_([NS])([\d.]+)([EW])([\d.]+)_([A-Z]+)(\d+)\.(wav|flac)$')
+
+def read_sound_file_header(file_path):
+    """ Reads sampling frequency and number of frames from a wave or FLAC
+        file header. Only the first part of the file is read. Returns a dict,
+        or None if the format is unknown. Wave files with zero or too large
+        data size, for example after power failures, are calculated from the
+        actual file size. """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as sound_file:
+        head = sound_file.read(12)
+        if (len(head) == 12) and (head[0:4] == b'RIFF') and (head[8:12] == b'WAVE'):
+            header_dict = {'file_format': 'WAV', 'file_size': file_size}
+            position = 12
+            while position + 8 <= file_size:
+                sound_file.seek(position)
+                chunk_id, chunk_size = struct.unpack('<4sI', sound_file.read(8))
+                if chunk_id == b'fmt ':
+                    (_format_tag, n_channels, sampling_freq_hz, _byte_rate,
+                     _block_align, bits_per_sample) = struct.unpack('<HHIIHH', sound_file.read(16))
+                    header_dict['n_channels'] = n_channels
+                    header_dict['sampling_freq_hz'] = sampling_freq_hz
+                    header_dict['sample_width'] = int(bits_per_sample / 8)
+                elif chunk_id == b'data':
+                    header_dict['data_offset'] = position + 8
+                    if (chunk_size == 0) or (position + 8 + chunk_size > file_size):
+                        chunk_size = file_size - position - 8
+                    header_dict['data_size'] = chunk_size
+                elif chunk_id == b'guan':
+                    header_dict['guano'] = sound_file.read(chunk_size).decode('utf-8', 'replace')
+                position += 8 + chunk_size + (chunk_size % 2) # Chunks are word aligned.
+            if ('sampling_freq_hz' not in header_dict) or ('data_size' not in header_dict):
+                return None
+            frame_size = header_dict['n_channels'] * header_dict['sample_width']
+            header_dict['n_frames'] = int(header_dict['data_size'] / frame_size)
+            return header_dict
+        #
+        if head[0:4] == b'fLaC':
+            # STREAMINFO is always the first metadata block.
+            sound_file.seek(8)
+            streaminfo = sound_file.read(34)
+            bits = struct.unpack('>Q', streaminfo[10:18])[0]
+            header_dict = {'file_format': 'FLAC', 'file_size': file_size}
+            header_dict['sampling_freq_hz'] = bits >> 44
+            header_dict['n_channels'] = ((bits >> 41) & 0x07) + 1
+            header_dict['sample_width'] = int((((bits >> 36) & 0x1f) + 1) / 8)
+            header_dict['n_frames'] = bits & 0xfffffffff
+            return header_dict
+    #
+    return None
+
+def parse_file_name(file_name):
+    """ Extracts time, position and recording type from the file name.
+        Returns a dict, or None if not created by the WURB. """
+    match = FILENAME_PATTERN.match(file_name)
+    if not match:
+        return None
+    prefix, datetimestring, ns, latitude, ew, longitude, rec_mode, rec_khz, _ext = match.groups()
+    name_dict = {'prefix': prefix}
+    name_dict['start_time'] = datetimestring
+    start_datetime = datetime.datetime.strptime(datetimestring, '%Y%m%dT%H%M%S%z')
+    name_dict['start_time_s'] = start_datetime.timestamp()
+    # Local time as seconds since epoch, as used for subdirectories.
+    name_dict['local_time_s'] = name_dict['start_time_s'] + start_datetime.utcoffset().total_seconds()
+    name_dict['latitude'] = float(latitude) * (1 if ns == 'N' else -1)
+    name_dict['longitude'] = float(longitude) * (1 if ew == 'E' else -1)
+    name_dict['rec_type'] = rec_mode + rec_khz
+    name_dict['te_factor'] = 10 if rec_mode == 'TE' else 1
+    return name_dict
+
+def parse_guano_text(text):
+    """ Returns a dict with the GUANO fields as strings. """
+    guano_dict = {}
+    for line in text.split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            guano_dict[key.strip()] = value.strip().replace('\\n', '\n')
+    return guano_dict
+
+def catalog_record_from_file(file_path):
+    """ Used when rebuilding the catalog. Detector results are read from
+        the GUANO metadata chunk, if available. """
+    name_dict = parse_file_name(os.path.basename(file_path))
+    if name_dict is None:
+        return None
+    header_dict = read_sound_file_header(file_path)
+    if header_dict is None:
+        return None
+    record = {'file_name': os.path.basename(file_path),
+              'dir_path': os.path.dirname(file_path)}
+    for key in ['start_time', 'start_time_s', 'latitude', 'longitude', 'rec_type', 'te_factor']:
+        record[key] = name_dict[key]
+    record['sampling_freq_hz'] = header_dict['sampling_freq_hz']
+    record['file_size'] = header_dict['file_size']
+    record['duration_s'] = header_dict['n_frames'] / header_dict['sampling_freq_hz'] / name_dict['te_factor']
+    if 'guano' in header_dict:
+        guano_dict = parse_guano_text(header_dict['guano'])
+        for key, guano_key in [('detections', 'WURB|Detections'), 
+                               ('peak_freq_hz', 'WURB|Peak Freq Hz'), 
+                               ('peak_dbfs', 'WURB|Peak dBFS'), 
+                               ('min_freq_hz', 'WURB|Min Peak Freq Hz'), 
+                               ('max_freq_hz', 'WURB|Max Peak Freq Hz')]:
+            if guano_key in guano_dict:
+                record[key] = float(guano_dict[guano_key])
+        if 'detections' in record:
+            record['detections'] = int(record['detections'])
+        if 'Loc Position' in guano_dict:
+            latitude, longitude = guano_dict['Loc Position'].split()
+            record['latitude'] = float(latitude)
+            record['longitude'] = float(longitude)
+    #
+    return record
+
+
+class WurbCatalog(object):
+    """ SQLite catalog for recorded files. Updated by the file writer thread
+        each time a file is closed. Makes it possible to search for files
+        without listing and opening thousands of files on a USB memory.
+        Usage:
+            catalog = WurbCatalog('/media/usb0/wurb1_rec/wurb_catalog.db')
+            catalog.add_file(record_dict)
+            rows = catalog.find_files(start_time_s=..., end_time_s=..., min_freq_hz=40000)
+            catalog.rebuild('/media/usb0/wurb1_rec')
+            catalog.close()
+    """
+    def __init__(self, db_path):
+        """ """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._db_path = str(db_path)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def close(self):
+        """ """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def add_file(self, record):
+        """ Insert or replace one record. One transaction. """
+        self.add_files([record])
+
+    def add_files(self, record_list):
+        """ Batched insert. All records in one transaction. Missing keys are
+            stored as NULL. """
+        column_names = [name for name, _type in CATALOG_COLUMNS]
+        rows = [[record.get(name, None) for name in column_names] for record in record_list]
+        sql = 'INSERT OR REPLACE INTO files (' + ', '.join(column_names) + ') ' + \
+              'VALUES (' + ', '.join(['?'] * len(column_names)) + ')'
+        with self._lock:
+            connection = self._connect()
+            with connection: # Commit, or rollback on exception.
+                connection.executemany(sql, rows)
+
+    def remove_file(self, file_name):
+        """ """
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('DELETE FROM files WHERE file_name = ?', (file_name,))
+
+    def find_files(self,
+                   start_time_s=None, # Seconds since epoch.
+                   end_time_s=None,
+                   min_freq_hz=None, # Files with peaks above this frequency.
+                   min_dbfs=None,
+                   order_by='start_time_s',
+                   limit=None):
+        """ Indexed query. Returns a list of dicts. """
+        where_list = []
+        parameters = []
+        if start_time_s is not None:
+            where_list.append('start_time_s >= ?')
+            parameters.append(start_time_s)
+        if end_time_s is not None:
+            where_list.append('start_time_s < ?')
+            parameters.append(end_time_s)
+        if min_freq_hz is not None:
+            where_list.append('max_freq_hz >= ?')
+            parameters.append(min_freq_hz)
+        if min_dbfs is not None:
+            where_list.append('peak_dbfs >= ?')
+            parameters.append(min_dbfs)
+        if order_by not in [name for name, _type in CATALOG_COLUMNS]:
+            order_by = 'start_time_s'
+        sql = 'SELECT * FROM files'
+        if where_list:
+            sql += ' WHERE ' + ' AND '.join(where_list)
+        sql += ' ORDER BY ' + order_by
+        if limit:
+            sql += ' LIMIT ' + str(int(limit))
+        with self._lock:
+            connection = self._connect()
+            cursor = connection.execute(sql, parameters)
+            column_names = [description[0] for description in cursor.description]
+            return [dict(zip(column_names, row)) for row in cursor.fetchall()]
+
+    def rebuild(self, dir_path, max_workers=4, batch_size=500):
+        """ Recreates the catalog from files in a directory tree. Headers are
+            read in parallel, reads are I/O bound. Existing records for files
+            still present are replaced, detector results are then lost. """
+        file_path_list = []
+        for root, _dirs, files in os.walk(dir_path):
+            for file_name in files:
+                if file_name.endswith(('.wav', '.flac')):
+                    file_path_list.append(os.path.join(root, file_name))
+        #
+        record_list = []
+        counter = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for record in executor.map(self._record_or_none, file_path_list):
+                if record is None:
+                    continue
+                record_list.append(record)
+                if len(record_list) >= batch_size:
+                    self.add_files(record_list)
+                    counter += len(record_list)
+                    record_list = []
+        if record_list:
+            self.add_files(record_list)
+            counter += len(record_list)
+        #
+        self._logger.info('Catalog: Rebuilt. Files: ' + str(counter) +
+                          ' of ' + str(len(file_path_list)))
+        return counter
+
+    def _record_or_none(self, file_path):
+        """ """
+        try:
+            return catalog_record_from_file(file_path)
+        except Exception as e:
+            self._logger.warning('Catalog: Failed to read: ' + file_path + ' ' + str(e))
+            return None
+
+    def _connect(self):
+        """ Must be called with the lock acquired. Creates table if needed. """
+        if self._connection is None:
+            # Used from the file writer thread, but only one at a time.
+            self._connection = sqlite3.connect(self._db_path, check_same_thread=False)
+            columns = ', '.join([name + ' ' + sql_type for name, sql_type in CATALOG_COLUMNS])
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS files (' + columns + ')')
+                for column in CATALOG_INDEXES:
+                    self._connection.execute('CREATE INDEX IF NOT EXISTS idx_' + column +
+                                             ' ON files (' + column + ')')
+        return self._connection
+
+
+# === MAIN ===
+if __name__ == "__main__":
+    """ Rebuild the catalog from an existing directory.
+        Usage: python3 wurb_catalog.py <rec_directory_path> [<db_path>] """
+    import sys
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    if len(sys.argv) < 2:
+        print('Usage: python3 wurb_catalog.py <rec_directory_path> [<db_path>]')
+        sys.exit(1)
+    rec_dir_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        catalog_db_path = sys.argv[2]
+    else:
+        catalog_db_path = os.path.join(rec_dir_path, 'wurb_catalog.db')
+    catalog = WurbCatalog(catalog_db_path)
+    catalog.rebuild(rec_dir_path)
+    catalog.close()
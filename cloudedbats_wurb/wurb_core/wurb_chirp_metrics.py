@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import sys
+import json
+import time
+import signal
+import numpy as np
+import concurrent.futures
+try:
+    from .wurb_catalog import parse_file_name
+    from .lib.dsp4bats.wave_file_utils import WaveFileReader
+    from .lib.dsp4bats.time_domain_utils import SignalUtil
+    from .lib.dsp4bats.frequency_domain_utils import DbfsSpectrumUtil
+except ImportError:
+    from wurb_catalog import parse_file_name # Used as script.
+    from lib.dsp4bats.wave_file_utils import WaveFileReader
+    from lib.dsp4bats.time_domain_utils import SignalUtil
+    from lib.dsp4bats.frequency_domain_utils import DbfsSpectrumUtil
+
+# Chirp metrics for recorded files, one npz file per wave file, stored in the
+# subdirectory "metrics". One array per column, as in chirp_metrics_header()
+# plus "peak_position". Signal indexes are counted from the start of the file.
+METRICS_DIR_NAME = 'metrics'
+METRICS_SUFFIX = '_metrics.npz'
+# Subdirectories with files created from the recordings. Same name as
+# wurb_preview.PREVIEW_DIR_NAME, not imported since the script is used
+# without the wurb_core package.
+SKIP_DIR_NAMES = [METRICS_DIR_NAME, 'preview']
+# Filtered blocks kept from the noise level pass, per process. Blocks above
+# the limit are filtered again. Covers a 20 s recording at 384 kHz.
+MAX_KEPT_BYTES = 64 * 1000000
+
+def default_parameters():
+    """ Same values as used in the earlier detector test code. """
+    return {'filter_low_hz': 15000, # Highpass filter in the time domain.
+            'localmax_noise_threshold_factor': 3.0,
+            'localmax_jump_factor': 1000,
+            'localmax_frame_length': 1024,
+            'window_size': 1024,
+            'kaiser_beta': 14,
+            'jump_factor': 1000,
+            'threshold_dbfs': -50.0,
+            'threshold_dbfs_below_peak': 20.0,
+            'max_frames_to_check': 200,
+            'max_silent_slots': 8,
+            'block_s': 1.0} # Part of the file processed at a time.
+
+def metrics_file_path(wave_path):
+    """ """
+    base_name = os.path.splitext(os.path.basename(wave_path))[0]
+    return os.path.join(os.path.dirname(wave_path), METRICS_DIR_NAME,
+                        base_name + METRICS_SUFFIX)
+
+def is_metrics_done(wave_path, parameters):
+    """ True if the metrics file exists, is newer than the wave file and was
+        created with the same parameters. Used to resume interrupted runs. """
+    metrics_path = metrics_file_path(wave_path)
+    if (not os.path.exists(metrics_path)) or \
+       (os.path.getmtime(metrics_path) < os.path.getmtime(wave_path)):
+        return False
+    try:
+        with np.load(metrics_path, allow_pickle=False) as metrics:
+            return json.loads(str(metrics['parameters'])) == parameters
+    except Exception:
+        return False
+
+def extract_file_metrics(wave_path, parameters=None):
+    """ Finds peaks and extracts chirp metrics for one wave file. The file is
+        memory mapped and processed in blocks. Each block is extended by a
+        margin on both sides, used for filtering and by the chirp search,
+        and only peaks inside the block itself are kept. No peaks are lost
+        or counted twice at block borders. Returns the path to the metrics
+        file and the duration of the file in seconds. """
+    if parameters is None:
+        parameters = default_parameters()
+    name_dict = parse_file_name(os.path.basename(wave_path))
+    te_factor = name_dict['te_factor'] if name_dict else 1
+    #
+    with WaveFileReader(wave_path) as wave_reader:
+        sampling_freq = wave_reader.header_sampling_freq * te_factor
+        number_of_frames = wave_reader.number_of_frames
+        data = wave_reader.data()
+        #
+        signal_util = SignalUtil(sampling_freq=sampling_freq, dtype=np.float32)
+        spectrum_util = DbfsSpectrumUtil(window_size=parameters['window_size'],
+                                         window_function='kaiser',
+                                         kaiser_beta=parameters['kaiser_beta'],
+                                         sampling_freq=sampling_freq,
+                                         dtype=np.float32)
+        result_dtype = spectrum_util.chirp_metrics_batch_dtype()
+        localmax_jump = int(sampling_freq / parameters['localmax_jump_factor'])
+        jump = int(sampling_freq / parameters['jump_factor'])
+        # Widest chirp search and RMS frame, plus one window. Blocks and margins
+        # are multiples of the localmax jump, the RMS frames are then placed 
+        # as for the whole file.
+        margin = ((parameters['max_frames_to_check'] - 1) // 2) * jump + \
+                 parameters['localmax_frame_length'] + parameters['window_size']
+        margin = int(np.ceil(margin / localmax_jump)) * localmax_jump
+        block_size = max(1, int(parameters['block_s'] * sampling_freq) // localmax_jump) * localmax_jump
+        # The noise level is calculated once for the whole file, from the 
+        # filtered blocks without margins. Results do not depend on the block size.
+        def filtered_blocks():
+            for block_start in range(0, number_of_frames, block_size):
+                block_end = min(block_start + block_size, number_of_frames)
+                signal_start = max(0, block_start - margin)
+                signal_end = min(number_of_frames, block_end + margin)
+                signal = wave_reader.float_signal(data[signal_start:signal_end])
+                if len(signal) < 2 * parameters['window_size']:
+                    continue
+                signal = signal_util.butterworth_filter(signal,
+                                                        low_freq_hz=parameters['filter_low_hz'])
+                yield block_start, block_end, signal_start, signal
+        #
+        square_sum = 0.0
+        square_counter = 0
+        kept_blocks = []
+        kept_bytes = 0
+        for block_start, block_end, signal_start, signal in filtered_blocks():
+            block_signal = signal[block_start - signal_start:block_end - signal_start]
+            square_sum += float(np.sum(np.square(block_signal), dtype=np.float64))
+            square_counter += len(block_signal)
+            kept_bytes += signal.nbytes
+            if kept_bytes <= MAX_KEPT_BYTES:
+                kept_blocks.append((block_start, block_end, signal_start, signal))
+        noise_level = np.sqrt(square_sum / square_counter) if square_counter else 0.0
+        if kept_bytes <= MAX_KEPT_BYTES:
+            block_list = kept_blocks
+        else:
+            del kept_blocks
+            block_list = filtered_blocks()
+        #
+        result_list = []
+        for block_start, block_end, signal_start, signal in block_list:
+            peaks = signal_util.find_localmax(signal=signal,
+                                              noise_threshold=noise_level * parameters['localmax_noise_threshold_factor'],
+                                              jump=localmax_jump,
+                                              frame_length=parameters['localmax_frame_length'])
+            # Only peaks inside the block. The margins are used as context.
+            peaks = peaks[(peaks >= block_start - signal_start) & (peaks < block_end - signal_start)]
+            if len(peaks) == 0:
+                continue
+            with np.errstate(divide='ignore'): # Empty bins are -inf dBFS.
+                result = spectrum_util.chirp_metrics_batch(signal, peaks,
+                                                           jump_factor=parameters['jump_factor'],
+                                                           high_pass_filter_freq_hz=parameters['filter_low_hz'],
+                                                           threshold_dbfs=parameters['threshold_dbfs'],
+                                                           threshold_dbfs_below_peak=parameters['threshold_dbfs_below_peak'],
+                                                           max_frames_to_check=parameters['max_frames_to_check'],
+                                                           max_silent_slots=parameters['max_silent_slots'])
+            # Signal indexes from the start of the file.
+            for key in result_dtype.names:
+                if key.endswith('_signal_index') or (key == 'peak_position'):
+                    result[key] += signal_start
+            result_list.append(result)
+        del data
+    #
+    if result_list:
+        results = np.concatenate(result_list)
+    else:
+        results = np.zeros(0, dtype=result_dtype)
+    # Written to a temporary file first. Interrupted runs leave no half written files.
+    metrics_path = metrics_file_path(wave_path)
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    tmp_path = metrics_path + '.tmp'
+    with open(tmp_path, 'wb') as metrics_file:
+        np.savez_compressed(metrics_file,
+                            file_name=np.array(os.path.basename(wave_path)),
+                            sampling_freq=np.float64(sampling_freq),
+                            duration_s=np.float64(number_of_frames / sampling_freq),
+                            parameters=np.array(json.dumps(parameters, sort_keys=True)),
+                            **{key: results[key] for key in result_dtype.names})
+    os.replace(tmp_path, metrics_path)
+    #
+    return metrics_path, number_of_frames / sampling_freq
+
+def extract_metrics(dir_path, parameters=None, max_workers=None, progress=None):
+    """ Extracts chirp metrics for all wave files in a directory tree, in
+        parallel processes. Files already done with the same parameters are
+        skipped, an interrupted run continues where it stopped. The optional
+        progress function is called as progress(status_dict) after each file.
+        Returns the status dict. """
+    if parameters is None:
+        parameters = default_parameters()
+    wave_list = []
+    for root, dirs, files in os.walk(dir_path):
+        dirs[:] = [d for d in dirs if d not in SKIP_DIR_NAMES]
+        for file_name in sorted(files):
+            # Only recordings. Staged and partial files have the suffix ".part".
+            if file_name.endswith('.wav') and parse_file_name(file_name):
+                wave_list.append(os.path.join(root, file_name))
+    todo_list = [path for path in wave_list if not is_metrics_done(path, parameters)]
+    status_dict = {'files': len(wave_list),
+                   'skipped_files': len(wave_list) - len(todo_list),
+                   'done_files': 0,
+                   'failed_files': [],
+                   'audio_s': 0.0,
+                   'wall_s': 0.0,
+                   'audio_h_per_wall_h': 0.0}
+    start_time = time.time()
+    # Ctrl-C is handled by the main process. Started files are finished.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                initializer=signal.signal,
+                                                initargs=(signal.SIGINT, signal.SIG_IGN)) as executor:
+        future_dict = {executor.submit(extract_file_metrics, path, parameters): path
+                       for path in todo_list}
+        try:
+            for future in concurrent.futures.as_completed(future_dict):
+                try:
+                    _metrics_path, duration_s = future.result()
+                    status_dict['done_files'] += 1
+                    status_dict['audio_s'] += duration_s
+                except Exception as e:
+                    status_dict['failed_files'].append((future_dict[future], str(e)))
+                status_dict['wall_s'] = time.time() - start_time
+                if status_dict['wall_s'] > 0:
+                    status_dict['audio_h_per_wall_h'] = status_dict['audio_s'] / status_dict['wall_s']
+                if progress:
+                    progress(status_dict)
+        except KeyboardInterrupt:
+            # Finished files are kept and skipped when restarted.
+            for future in future_dict:
+                future.cancel()
+            raise
+    #
+    return status_dict
+
+def read_metrics(dir_path):
+    """ All metrics files in a directory tree as one table. Returns a dict
+        with one array per column, "file_name" included. """
+    column_dict = {}
+    for root, _dirs, files in os.walk(dir_path):
+        for file_name in sorted(files):
+            if not (file_name.endswith(METRICS_SUFFIX) and
+                    os.path.basename(root) == METRICS_DIR_NAME):
+                continue
+            with np.load(os.path.join(root, file_name), allow_pickle=False) as metrics:
+                length = len(metrics['peak_position'])
+                wave_name = str(metrics['file_name'])
+                for key in metrics.files:
+                    if key in ['file_name', 'sampling_freq', 'duration_s', 'parameters']:
+                        continue
+                    column_dict.setdefault(key, []).append(metrics[key])
+                column_dict.setdefault('file_name', []).append(np.full(length, wave_name))
+    return {key: np.concatenate(value) for key, value in column_dict.items()}
+
+
+# === MAIN ===
+if __name__ == "__main__":
+    """ Extract chirp metrics for recorded files. Can be restarted after
+        interruption, finished files are skipped.
+        Usage: python3 wurb_chirp_metrics.py <rec_directory_path> [<max_workers>] """
+    if len(sys.argv) < 2:
+        print('Usage: python3 wurb_chirp_metrics.py <rec_directory_path> [<max_workers>]')
+        sys.exit(1)
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    #
+    def print_progress(status_dict):
+        print('Files: ' + str(status_dict['done_files'] + status_dict['skipped_files'] +
+                              len(status_dict['failed_files'])) +
+              ' of ' + str(status_dict['files']) +
+              '  Audio (h): ' + str(round(status_dict['audio_s'] / 3600, 3)) +
+              '  Audio h per wall h: ' + str(round(status_dict['audio_h_per_wall_h'], 1)))
+    #
+    try:
+        status = extract_metrics(sys.argv[1], max_workers=workers, progress=print_progress)
+    except KeyboardInterrupt:
+        print('Interrupted. Run again to continue.')
+        sys.exit(1)
+    for path, problem_text in status['failed_files']:
+        print(path + ': ' + problem_text)
+    print('Done: ' + str(status['done_files']) + '  Skipped (already done): ' +
+          str(status['skipped_files']) + '  Failed: ' + str(len(status['failed_files'])) +
+          '  Time (s): ' + str(round(status['wall_s'], 1)))
+    sys.exit(1 if status['failed_files'] else 0)
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import queue
+import threading
+import logging
+
+class WurbFileWriter(object):
+    """ File writer running in a separate thread. Slow storage will not
+        stall the sound target thread, and by that not the detection and
+        capture threads. Data is passed in a bounded I/O queue. Opens,
+        writes and closes are executed in order, but the caller does not
+        wait for them.
+        The total size of queued data is limited. New files are not opened
+        when there is no room for a full file in the queue. Whole files are
+        shed instead of cutting audio in the middle of a file.
+        File objects must implement open(), write(data) and close().
+        Usage:
+            file_writer = WurbFileWriter(buffer_max_bytes, file_buffer_max_bytes)
+            file_writer.start()
+            if file_writer.open_file(file_object):
+                file_writer.write(file_object, data)
+                file_writer.close_file(file_object)
+            file_writer.stop() # Waits until queued files are written.
+    """
+    def __init__(self,
+                 buffer_max_bytes=64*1024*1024, # All queued data.
+                 file_buffer_max_bytes=16*1024*1024, # Max size of one file.
+                 stall_limit_s=1.0, # Operations slower than this are counted as stalls.
+                 io_queue_max=1000, # Max items.
+                 callback_function=None):
+        """ """
+        self._callback_function = callback_function
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        #
+        self._buffer_max_bytes = buffer_max_bytes
+        self._file_buffer_max_bytes = min(file_buffer_max_bytes, buffer_max_bytes)
+        self._stall_limit_s = stall_limit_s
+        self._io_queue = queue.Queue(maxsize=io_queue_max)
+        self._pending_bytes = 0
+        self._pending_condition = threading.Condition()
+        self._worker_thread = None
+        self._failed = False
+        # Statistics.
+        self._stall_counter = 0
+        self._max_stall_s = 0.0
+        self._shed_file_counter = 0
+        self._max_pending_bytes = 0
+        self._open_counter = 0
+        self._open_time_s = 0.0
+        self._max_open_time_s = 0.0
+
+    def start(self):
+        """ """
+        if self._worker_thread and self._worker_thread.is_alive():
+            return
+        self._failed = False
+        self._stall_counter = 0
+        self._max_stall_s = 0.0
+        self._shed_file_counter = 0
+        self._max_pending_bytes = 0
+        self._open_counter = 0
+        self._open_time_s = 0.0
+        self._max_open_time_s = 0.0
+        self._worker_thread = threading.Thread(target=self._worker_exec, args=[])
+        self._worker_thread.start()
+
+    def stop(self):
+        """ Terminates the worker when all queued items are executed. """
+        if self._worker_thread:
+            self._io_queue.put(None)
+            self._worker_thread.join()
+            self._worker_thread = None
+        self._log_stats()
+
+    def open_file(self, file_object):
+        """ Returns False if the storage is behind and the file is shed. """
+        with self._pending_condition:
+            if self._failed:
+                return False
+            if self._pending_bytes + self._file_buffer_max_bytes > self._buffer_max_bytes:
+                self._shed_file_counter += 1
+                self._logger.warning('Recorder: Storage is behind. File skipped. Backlog (MB): ' +
+                                     str(round(self._pending_bytes / 1000000, 1)))
+                return False
+        #
+        self._io_queue.put(('open', file_object, None))
+        return True
+
+    def write(self, file_object, data):
+        """ Blocks only if the total buffer limit is reached. """
+        with self._pending_condition:
+            while (not self._failed) and \
+                  (self._pending_bytes + len(data) > self._buffer_max_bytes):
+                self._pending_condition.wait(timeout=1.0)
+            self._pending_bytes += len(data)
+            if self._max_pending_bytes < self._pending_bytes:
+                self._max_pending_bytes = self._pending_bytes
+        #
+        self._io_queue.put(('write', file_object, data))
+
+    def close_file(self, file_object):
+        """ """
+        self._io_queue.put(('close', file_object, None))
+
+    def _worker_exec(self):
+        """ Running in thread. """
+        while True:
+            item = self._io_queue.get()
+            if item is None:
+                break # Terminated.
+            #
+            command, file_object, data = item
+            start_time = time.time()
+            try:
+                if not self._failed:
+                    if command == 'open':
+                        file_object.open()
+                    elif command == 'write':
+                        file_object.write(data)
+                    elif command == 'close':
+                        file_object.close()
+            except Exception as e:
+                self._failed = True
+                self._logger.error('Recorder: File writer exception: ' + str(e))
+                if self._callback_function:
+                    self._callback_function('rec_target_error')
+            finally:
+                if data is not None:
+                    with self._pending_condition:
+                        self._pending_bytes -= len(data)
+                        self._pending_condition.notify_all()
+            # Statistics.
+            duration_s = time.time() - start_time
+            if command == 'open':
+                # File create time grows with the number of files in FAT directories.
+                self._open_counter += 1
+                self._open_time_s += duration_s
+                if self._max_open_time_s < duration_s:
+                    self._max_open_time_s = duration_s
+            if duration_s > self._stall_limit_s:
+                self._stall_counter += 1
+                if self._max_stall_s < duration_s:
+                    self._max_stall_s = duration_s
+                self._logger.warning('Recorder: Storage stalled for ' +
+                                     str(round(duration_s, 1)) + ' sec. Backlog (MB): ' +
+                                     str(round(self._pending_bytes / 1000000, 1)))
+
+    def _log_stats(self):
+        """ """
+        mean_open_time_ms = 0.0
+        if self._open_counter > 0:
+            mean_open_time_ms = self._open_time_s / self._open_counter * 1000.0
+        self._logger.info('Recorder: File open time (ms) mean: ' + str(round(mean_open_time_ms, 1)) + 
+                          '  max: ' + str(round(self._max_open_time_s * 1000.0, 1)) + 
+                          '  Files: ' + str(self._open_counter))
+        self._logger.info('Recorder: File writer stats. Stalls: ' + str(self._stall_counter) +
+                          '  Max stall (s): ' + str(round(self._max_stall_s, 1)) +
+                          '  Shed files: ' + str(self._shed_file_counter) +
+                          '  Max backlog (MB): ' + str(round(self._max_pending_bytes / 1000000, 1)))
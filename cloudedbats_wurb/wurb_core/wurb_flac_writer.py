@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import time
+import shutil
+import subprocess
+
+def is_flac_available():
+    """ The FLAC command line encoder is used. Install on Raspbian with:
+        "sudo apt install flac". """
+    return shutil.which('flac') is not None
+
+
+class WurbFlacWriter(object):
+    """ Lossless FLAC file writer. Raw 16 bits PCM is streamed to the "flac"
+        command line encoder running in a separate process. The encoder
+        runs in parallel with the recorder and on another CPU core.
+        Recordings of bats are mostly noise floor and compresses well.
+        Same interface as WurbWaveWriter.
+        Usage:
+            writer = WurbFlacWriter('test.flac', 384000)
+            writer.write(data_bytes)
+            writer.close()
+            stats_dict = writer.get_stats()
+    """
+    def __init__(self, file_path, sampling_freq_hz,
+                 compression_level=5, # 0=fast, 8=best.
+                 n_channels=1, # 1=Mono.
+                 sample_width=2): # 2=16 bits.
+        """ """
+        self._file_path = str(file_path)
+        self._sampling_freq_hz = int(sampling_freq_hz)
+        self._data_size = 0
+        self._file_size = 0
+        self._cpu_s = 0.0
+        # Statistics.
+        self._write_counter = 0
+        self._write_time_s = 0.0
+        self._max_latency_s = 0.0
+        #
+        command = ['flac', '--silent', '--force',
+                   '--force-raw-format', '--endian=little', '--sign=signed',
+                   '--channels=' + str(n_channels),
+                   '--bps=' + str(sample_width * 8),
+                   '--sample-rate=' + str(self._sampling_freq_hz),
+                   '--compression-level-' + str(int(compression_level)),
+                   '--output-name=' + self._file_path,
+                   '-'] # Read from stdin.
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def get_file_path(self):
+        """ """
+        return self._file_path
+
+    def get_data_size(self):
+        """ Number of raw audio bytes sent to the encoder. """
+        return self._data_size
+
+    def write(self, buffer):
+        """ Blocks if the encoder is behind. """
+        start_time = time.time()
+        self._process.stdin.write(buffer)
+        self._data_size += len(buffer)
+        # Statistics.
+        latency_s = time.time() - start_time
+        self._write_counter += 1
+        self._write_time_s += latency_s
+        if self._max_latency_s < latency_s:
+            self._max_latency_s = latency_s
+
+    def close(self):
+        """ Waits for the encoder to finish. CPU usage is collected
+            from the terminated process. """
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+            _pid, status, rusage = os.wait4(self._process.pid, 0)
+            self._cpu_s = rusage.ru_utime + rusage.ru_stime
+            # Already reaped by wait4(). Tell Popen.
+            if os.WIFEXITED(status):
+                self._process.returncode = os.WEXITSTATUS(status)
+            else:
+                self._process.returncode = -1
+            if self._process.returncode != 0:
+                raise IOError('FLAC encoder failed. Return code: ' + str(self._process.returncode))
+            self._file_size = os.path.getsize(self._file_path)
+        finally:
+            self._process = None
+
+    def get_stats(self):
+        """ Same as WurbWaveWriter with compression ratio and CPU cost added.
+            CPU usage in percent of one core, related to the audio length. """
+        stats_dict = {}
+        stats_dict['bytes_written'] = self._file_size
+        stats_dict['write_counter'] = self._write_counter
+        stats_dict['write_time_s'] = self._write_time_s
+        stats_dict['mb_per_s'] = 0.0
+        stats_dict['mean_latency_ms'] = 0.0
+        stats_dict['max_latency_ms'] = self._max_latency_s * 1000.0
+        stats_dict['compression_ratio'] = 0.0
+        stats_dict['cpu_s'] = self._cpu_s
+        stats_dict['cpu_percent'] = 0.0
+        if self._write_time_s > 0.0:
+            stats_dict['mb_per_s'] = self._data_size / self._write_time_s / 1000000.0
+        if self._write_counter > 0:
+            stats_dict['mean_latency_ms'] = self._write_time_s / self._write_counter * 1000.0
+        if self._file_size > 0:
+            stats_dict['compression_ratio'] = self._data_size / self._file_size
+        if self._data_size > 0:
+            audio_length_s = self._data_size / 2 / self._sampling_freq_hz
+            stats_dict['cpu_percent'] = self._cpu_s / audio_length_s * 100.0
+        #
+        return stats_dict
+
+
+# === TEST ===
+if __name__ == "__main__":
+    """ """
+    import numpy as np
+    print('Test started.')
+    if not is_flac_available():
+        print('FLAC encoder not installed.')
+    else:
+        writer = WurbFlacWriter('test.flac', 384000)
+        for _index in range(10):
+            noise = (np.random.randn(192000) * 10).astype(np.int16) # 0.5 sec.
+            writer.write(noise.tobytes())
+        writer.close()
+        print('Stats: ', writer.get_stats())
+        os.remove('test.flac')
+    print('Test ended.')
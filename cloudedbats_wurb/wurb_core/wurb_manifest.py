@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import shutil
+import hashlib
+import subprocess
+import concurrent.futures
+try:
+    from .wurb_catalog import read_sound_file_header
+except ImportError:
+    from wurb_catalog import read_sound_file_header # Used as script.
+
+# Manifest files, one per night: "manifest_20180420_night.txt".
+# Tab separated. The hash is calculated on the sound data only, not
+# on the wave header and metadata chunks that are written at close.
+MANIFEST_PREFIX = 'manifest_'
+MANIFEST_HEADER = '# file_name\tsize_bytes\tduration_s\tsha256_sound_data\n'
+# Appended when a file is deleted by the retention policy. Used instead of 
+# the hash, earlier rows for the file are then ignored.
+DELETED_MARKER = 'deleted'
+
+def manifest_file_name(night_name):
+    """ """
+    return MANIFEST_PREFIX + night_name + '.txt'
+
+def append_manifest_entry(manifest_path, file_name, size_bytes, duration_s, sha256_hex):
+    """ Not thread safe. Use a lock if called from more than one thread. """
+    new_file = not os.path.exists(manifest_path)
+    with open(manifest_path, 'a') as manifest_file:
+        if new_file:
+            manifest_file.write(MANIFEST_HEADER)
+        manifest_file.write(file_name + '\t' + str(size_bytes) + '\t' +
+                            str(round(duration_s, 3)) + '\t' + sha256_hex + '\n')
+
+def append_manifest_deletion(manifest_path, file_name):
+    """ Marks a file as deleted on purpose. The verification then does not
+        report it as missing. Not thread safe, as append_manifest_entry(). """
+    with open(manifest_path, 'a') as manifest_file:
+        manifest_file.write(file_name + '\t0\t0\t' + DELETED_MARKER + '\n')
+
+def read_manifest(manifest_path):
+    """ Returns a list of dicts with the keys 'file_name', 'size_bytes',
+        'duration_s' and 'sha256'. Damaged rows are skipped. Files marked 
+        as deleted are not included. """
+    entry_dict = {} # Rows per file name.
+    with open(manifest_path, 'r') as manifest_file:
+        for row in manifest_file:
+            if row.startswith('#'):
+                continue
+            parts = row.rstrip('\n').split('\t')
+            if len(parts) != 4:
+                continue
+            if parts[3] == DELETED_MARKER:
+                entry_dict.pop(parts[0], None)
+                continue
+            try:
+                entry = {'file_name': parts[0],
+                         'size_bytes': int(parts[1]),
+                         'duration_s': float(parts[2]),
+                         'sha256': parts[3]}
+            except ValueError:
+                continue
+            entry_dict.setdefault(entry['file_name'], []).append(entry)
+    return [entry for entry_list in entry_dict.values() for entry in entry_list]
+
+def hash_sound_data(file_path, read_size=1024*1024):
+    """ SHA-256 of the sound data. Wave files: the data chunk. FLAC files
+        are decoded to raw PCM by the "flac" command line tool. """
+    sha256 = hashlib.sha256()
+    if file_path.endswith('.flac'):
+        if shutil.which('flac') is None:
+            raise RuntimeError('"flac" not installed.')
+        command = ['flac', '--decode', '--silent', '--stdout', '--force-raw-format',
+                   '--endian=little', '--sign=signed', file_path]
+        with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+            for block in iter(lambda: process.stdout.read(read_size), b''):
+                sha256.update(block)
+        if process.returncode != 0:
+            raise RuntimeError('Failed to decode FLAC file.')
+        return sha256.hexdigest()
+    #
+    header_dict = read_sound_file_header(file_path)
+    if (header_dict is None) or ('data_offset' not in header_dict):
+        raise RuntimeError('Unknown file format.')
+    remaining_bytes = header_dict['data_size']
+    with open(file_path, 'rb') as sound_file:
+        sound_file.seek(header_dict['data_offset'])
+        while remaining_bytes > 0:
+            block = sound_file.read(min(read_size, remaining_bytes))
+            if not block:
+                break
+            sha256.update(block)
+            remaining_bytes -= len(block)
+    return sha256.hexdigest()
+
+def verify_manifests(dir_path, max_workers=4):
+    """ Checks all manifests in a directory tree. Files are hashed in parallel
+        since most of the time is spent waiting for the USB memory, and hashlib
+        releases the GIL. Returns a list of (file_path, problem), empty if all
+        files are ok, and the number of checked files. """
+    check_list = []
+    for root, _dirs, files in os.walk(dir_path):
+        for file_name in files:
+            if file_name.startswith(MANIFEST_PREFIX) and file_name.endswith('.txt'):
+                for entry in read_manifest(os.path.join(root, file_name)):
+                    check_list.append((os.path.join(root, entry['file_name']), entry))
+    #
+    def check_file(file_path, entry):
+        if not os.path.exists(file_path):
+            return 'Missing.'
+        if file_path.endswith('.wav') and (os.path.getsize(file_path) != entry['size_bytes']):
+            return 'Size differs.'
+        if hash_sound_data(file_path) != entry['sha256']:
+            return 'Checksum differs.'
+        return None
+    #
+    problem_list = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_dict = {executor.submit(check_file, file_path, entry): file_path
+                       for file_path, entry in check_list}
+        for future in concurrent.futures.as_completed(future_dict):
+            file_path = future_dict[future]
+            try:
+                problem = future.result()
+            except Exception as e:
+                problem = 'Failed to read: ' + str(e)
+            if problem:
+                problem_list.append((file_path, problem))
+    #
+    return sorted(problem_list), len(check_list)
+
+
+# === MAIN ===
+if __name__ == "__main__":
+    """ Verify recorded files against the manifests, for example after
+        the USB memory was moved to another computer.
+        Usage: python3 wurb_manifest.py <rec_directory_path> [<max_workers>] 
+        Test: python3 wurb_manifest.py --test """
+    import sys
+    import time
+    if len(sys.argv) < 2:
+        print('Usage: python3 wurb_manifest.py <rec_directory_path> [<max_workers>]')
+        sys.exit(1)
+    if sys.argv[1] == '--test':
+        # === TEST ===
+        import struct
+        import tempfile
+        print('Test started.')
+        with tempfile.TemporaryDirectory() as test_dir_path:
+            test_manifest_path = os.path.join(test_dir_path, manifest_file_name('20180420_night'))
+            for test_name in ['kept.wav', 'deleted.wav', 'lost.wav']:
+                test_path = os.path.join(test_dir_path, test_name)
+                with open(test_path, 'wb') as test_file:
+                    test_file.write(struct.pack('<4sI4s4sIHHIIHH4sI',
+                                                b'RIFF', 36 + 1000, b'WAVE', b'fmt ', 16, 1, 1,
+                                                384000, 768000, 2, 16, b'data', 1000) + bytes(1000))
+                append_manifest_entry(test_manifest_path, test_name, os.path.getsize(test_path),
+                                      0.001, hash_sound_data(test_path))
+            # Deleted by the retention policy, and lost.
+            os.remove(os.path.join(test_dir_path, 'deleted.wav'))
+            append_manifest_deletion(test_manifest_path, 'deleted.wav')
+            os.remove(os.path.join(test_dir_path, 'lost.wav'))
+            problems, checked_counter = verify_manifests(test_dir_path)
+            print('Checked files (expected 2): ', checked_counter)
+            print('Problems (expected lost.wav missing): ', 
+                  [(os.path.basename(path), problem_text) for path, problem_text in problems])
+        print('Test ended.')
+        sys.exit(0)
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    start_time = time.time()
+    problems, checked_counter = verify_manifests(sys.argv[1], max_workers=workers)
+    for path, problem_text in problems:
+        print(path + ': ' + problem_text)
+    print('Checked files: ' + str(checked_counter) + '  Problems: ' + str(len(problems)) +
+          '  Time (s): ' + str(round(time.time() - start_time, 1)))
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import datetime
+import threading
+import logging
+import wurb_core
+
+@wurb_core.singleton
+class WurbMetadata(object):
+    """ Singleton class for time and position used in file names and metadata.
+        GPS time parsing, time zone conversion and formatting of the position
+        is done in a background thread. Opening a new sound file only reads
+        the last snapshot and formats the current time from a precalculated
+        UTC offset.
+        Usage:
+            WurbMetadata().start() # Activates background updates.
+            snapshot = WurbMetadata().get_snapshot()
+            datetimestring = WurbMetadata().get_datetimestring()
+            local_time_s = WurbMetadata().get_local_time_s()
+            WurbMetadata().stop()
+    """
+    def __init__(self):
+        """ Note: Singleton, parameters not allowed. """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._settings = wurb_core.WurbSettings()
+        #
+        self._snapshot = None
+        self._update_interval_s = 1.0
+        self._active = False
+        self._update_thread = None
+
+    def start(self):
+        """ """
+        self._update_snapshot()
+        # Check if already started.
+        if self._active:
+            return
+        #
+        try:
+            self._active = True
+            self._update_thread = threading.Thread(target = self._update_exec, args = [])
+            self._update_thread.start()
+        except Exception as e:
+            self._active = False
+            self._logger.error('Metadata: Failed to start. ' + str(e))
+
+    def stop(self):
+        """ """
+        self._active = False
+
+    def get_snapshot(self):
+        """ Returns a dict with the keys: 'latitude', 'longitude',
+            'latlongstring', 'position_source', 'clock_offset_s',
+            'utc_offset_s', 'utc_offset_string' and 'snapshot_time_s'.
+            Replaced, never modified, by the background thread. """
+        snapshot = self._snapshot
+        if (snapshot is None) or \
+           (time.time() > snapshot['snapshot_time_s'] + self._update_interval_s * 10):
+            # Not started or not updated.
+            self._update_snapshot()
+            snapshot = self._snapshot
+        #
+        return snapshot
+
+    def get_local_time_s(self, time_s=None, snapshot=None):
+        """ Local time as seconds. Use time.gmtime() for conversion. """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        if time_s is None:
+            time_s = time.time()
+        return time_s + snapshot['clock_offset_s'] + snapshot['utc_offset_s']
+
+    def get_datetimestring(self, time_s=None, snapshot=None):
+        """ Local time in file name format, "20180420T205942+0200". """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        local_time_s = self.get_local_time_s(time_s, snapshot)
+        return time.strftime('%Y%m%dT%H%M%S', time.gmtime(local_time_s)) + \
+               snapshot['utc_offset_string']
+
+    def _update_snapshot(self):
+        """ """
+        snapshot = {}
+        now_s = time.time()
+        gps_reader = wurb_core.WurbGpsReader()
+        # Time. Use GPS time and the configured time zone if available.
+        snapshot['clock_offset_s'] = 0.0
+        local_datetime = datetime.datetime.fromtimestamp(now_s).astimezone()
+        try:
+            gps_local_datetime = gps_reader.get_time_local()
+            if gps_local_datetime:
+                snapshot['clock_offset_s'] = round(gps_local_datetime.timestamp() - now_s)
+                local_datetime = gps_local_datetime
+        except Exception as e:
+            self._logger.debug('Metadata: Failed to read GPS time: ' + str(e))
+        utc_offset = local_datetime.utcoffset()
+        snapshot['utc_offset_s'] = utc_offset.total_seconds() if utc_offset else 0.0
+        snapshot['utc_offset_string'] = local_datetime.strftime('%z')
+        # Position. Default from settings.
+        latitude = float(self._settings.float('default_latitude'))
+        longitude = float(self._settings.float('default_longitude'))
+        latlongstring = ('N' if latitude >= 0 else 'S') + str(abs(latitude)) + \
+                        ('E' if longitude >= 0 else 'W') + str(abs(longitude))
+        position_source = 'Settings'
+        # Use GPS position if available.
+        gps_latlongstring = gps_reader.get_latlong_string()
+        if gps_latlongstring:
+            latitude = gps_reader.get_latitude()
+            longitude = gps_reader.get_longitude()
+            latlongstring = gps_latlongstring
+            position_source = 'GPS'
+        snapshot['latitude'] = latitude
+        snapshot['longitude'] = longitude
+        snapshot['latlongstring'] = latlongstring
+        snapshot['position_source'] = position_source
+        snapshot['snapshot_time_s'] = now_s
+        # Replace, atomic for readers.
+        self._snapshot = snapshot
+
+    def _update_exec(self):
+        """ Running in thread. """
+        while self._active:
+            time.sleep(self._update_interval_s)
+            try:
+                self._update_snapshot()
+            except Exception as e:
+                self._logger.debug('Metadata: Update failed: ' + str(e))
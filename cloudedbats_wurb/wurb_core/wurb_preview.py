@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import re
+import sys
+import wave
+import zlib
+import queue
+import select
+import signal
+import shutil
+import struct
+import threading
+import subprocess
+import logging
+import numpy as np
+import wurb_core
+
+def default_settings():
+    """ Available settings for the this module.
+        This info is used to define default values and to
+        generate the wurb_settings_DEFAULT.txt file."""
+
+    description = [
+        '# Settings for previews: spectrogram thumbnails and time expanded audio.',
+        ]
+    default_settings = [
+        {'key': 'preview_create', 'value': 'N'}, # "Y": Create previews for closed wave files.
+        ]
+    developer_settings = [
+        {'key': 'preview_max_cpu_load', 'value': '0.5'}, # Paused above this while recording.
+        {'key': 'preview_decimation', 'value': '2'}, # Decimation factor for the preview audio.
+        {'key': 'preview_image_width', 'value': '1000'}, # Max width of the thumbnails.
+        {'key': 'preview_tiles', 'value': 'N'}, # "Y": Spectrogram tiles for zoomable views.
+        ]
+    #
+    return description, default_settings, developer_settings
+
+# Previews are stored in a subdirectory to the sound files.
+PREVIEW_DIR_NAME = 'preview'
+
+def preview_sampling_freq(wave_path, header_sampling_freq):
+    """ Real sampling frequency. Time expanded recordings, for example 
+        "..._TE384.wav", have the header value divided by 10. """
+    if re.search(r'_TE\d+\.wav$', wave_path):
+        return header_sampling_freq * 10
+    return header_sampling_freq
+
+def tile_file_path(wave_path):
+    """ Spectrogram tiles are stored with the other previews. """
+    base_name = os.path.splitext(os.path.basename(wave_path))[0]
+    return os.path.join(os.path.dirname(wave_path), PREVIEW_DIR_NAME, 
+                        base_name + wurb_core.spectrogram_tiles.TILE_FILE_SUFFIX)
+
+def get_spectrogram_tiles(wave_path):
+    """ Returns a SpectrogramTileReader. The tiles are created on first 
+        request if not already done when the wave file was closed. """
+    with wurb_core.WaveFileReader(wave_path) as wave_reader:
+        sampling_freq = preview_sampling_freq(wave_path, wave_reader.header_sampling_freq)
+    tile_path = tile_file_path(wave_path)
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    return wurb_core.spectrogram_tiles.open_tile_file(wave_path, tile_path=tile_path, 
+                                                      sampling_freq=sampling_freq)
+
+def write_png(file_path, image, palette=None):
+    """ Minimal PNG writer, no plotting library needed. The image is a 2D
+        uint8 array, first row at top. Grayscale, or indexed colours if a
+        palette with 256 (r, g, b) rows is given. """
+    height, width = image.shape
+    # Filter type 0 (none) first on each row.
+    raw_rows = np.zeros((height, width + 1), dtype=np.uint8)
+    raw_rows[:, 1:] = image
+    #
+    def png_chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+               struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+    #
+    colour_type = 0 if palette is None else 3
+    png = b'\x89PNG\r\n\x1a\n'
+    png += png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, colour_type, 0, 0, 0))
+    if palette is not None:
+        png += png_chunk(b'PLTE', np.asarray(palette, dtype=np.uint8).tobytes())
+    png += png_chunk(b'IDAT', zlib.compress(raw_rows.tobytes(), 6))
+    png += png_chunk(b'IEND', b'')
+    with open(file_path, 'wb') as png_file:
+        png_file.write(png)
+
+def spectrogram_palette():
+    """ Black - blue - red - yellow - white. 256 rows of (r, g, b). """
+    x = np.linspace(0.0, 1.0, 256)
+    points = [0.0, 0.25, 0.5, 0.75, 1.0]
+    red = np.interp(x, points, [0, 0, 200, 255, 255])
+    green = np.interp(x, points, [0, 0, 0, 200, 255])
+    blue = np.interp(x, points, [0, 160, 80, 0, 255])
+    return np.stack([red, green, blue], axis=1).astype(np.uint8)
+
+def create_preview(wave_path,
+                   decimation=2, # Decimation factor for the preview audio.
+                   te_factor=10, # Time expansion for the preview audio.
+                   image_width=1000, # Max number of columns.
+                   window_size=512, # FFT size. Image height is half.
+                   min_dbfs=-100.0, # Black below this level.
+                   create_tiles=False): # Spectrogram tiles for zoomable views.
+    """ Creates a spectrogram PNG thumbnail and a decimated time expanded
+        wave file. Stored in the subdirectory "preview". Returns the paths. """
+    import scipy.signal
+    #
+    with wurb_core.WaveFileReader(wave_path) as wave_reader:
+        header_sampling_freq = wave_reader.header_sampling_freq
+        signal = wave_reader.float_signal()
+    sampling_freq = preview_sampling_freq(wave_path, header_sampling_freq)
+    #
+    preview_dir_path = os.path.join(os.path.dirname(wave_path), PREVIEW_DIR_NAME)
+    os.makedirs(preview_dir_path, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(wave_path))[0]
+    png_path = os.path.join(preview_dir_path, base_name + '.png')
+    preview_wave_path = os.path.join(preview_dir_path, base_name + '_preview.wav')
+    # Spectrogram. Time on x-axis, high frequencies at top.
+    dbfs_util = wurb_core.DbfsSpectrumUtil(window_size=window_size,
+                                 window_function='hann',
+                                 sampling_freq=sampling_freq)
+    n_columns = max(1, min(image_width, (len(signal) - window_size) // (window_size // 4)))
+    jump = max(1, (len(signal) - window_size) // n_columns)
+    dbfs_matrix = dbfs_util.calc_dbfs_matrix(signal, matrix_size=n_columns, jump=jump)
+    scaled = (dbfs_matrix.T[::-1] - min_dbfs) * (255.0 / -min_dbfs)
+    write_png(png_path, np.clip(scaled, 0, 255).astype(np.uint8), spectrogram_palette())
+    # Decimated and time expanded audio.
+    if decimation > 1:
+        signal = scipy.signal.decimate(signal, decimation, ftype='fir', zero_phase=True)
+    preview_int16 = np.clip(signal * 32768.0, -32768, 32767).astype(np.int16)
+    with wave.open(preview_wave_path, 'wb') as preview_file:
+        preview_file.setnchannels(1)
+        preview_file.setsampwidth(2)
+        preview_file.setframerate(int(sampling_freq / decimation / te_factor))
+        preview_file.writeframes(preview_int16.tobytes())
+    # Spectrogram tiles. Calculated from the memory mapped file.
+    if create_tiles:
+        wurb_core.spectrogram_tiles.create_tile_file(wave_path, 
+                                                     tile_path=tile_file_path(wave_path), 
+                                                     sampling_freq=sampling_freq)
+    #
+    return png_path, preview_wave_path
+
+def read_cpu_times():
+    """ Busy and total CPU time from "/proc/stat". Time used by niced
+        processes, as the preview worker, is not counted as busy. """
+    with open('/proc/stat', 'r') as stat_file:
+        values = [int(x) for x in stat_file.readline().split()[1:]]
+    user, _nice, system, _idle, _iowait, irq, softirq, steal = (values + [0] * 8)[:8]
+    return user + system + irq + softirq + steal, sum(values[:8])
+
+
+@wurb_core.singleton
+class WurbPreviewGenerator(object):
+    """ Singleton class. Creates previews for closed wave files: a spectrogram
+        thumbnail and a decimated time expanded wave file. The work is done in
+        a child process running with low CPU and I/O priority. The child process
+        is stopped (SIGSTOP) while the recorder is busy with sound files and
+        the CPU load is high, and continued (SIGCONT) when the load drops.
+        Usage:
+            WurbPreviewGenerator().start()
+            WurbPreviewGenerator().add_file(wave_file_path)
+            WurbPreviewGenerator().set_recorder_busy(True)
+            WurbPreviewGenerator().stop()
+    """
+    def __init__(self):
+        """ Note: Singleton, parameters not allowed. """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._settings = wurb_core.WurbSettings()
+        #
+        self._max_cpu_load = 0.5
+        self._decimation = 2
+        self._image_width = 1000
+        self._create_tiles = False
+        self._file_queue = queue.Queue()
+        self._process = None
+        self._paused = False
+        self._recorder_busy = False
+        self._cpu_times = None
+        self._active = False
+        self._control_thread = None
+        # Statistics.
+        self._preview_counter = 0
+        self._pause_counter = 0
+
+    def start(self):
+        """ Settings are read here since the singleton may be
+            created before settings are loaded. """
+        self._max_cpu_load = self._settings.float('preview_max_cpu_load')
+        self._decimation = max(1, self._settings.integer('preview_decimation'))
+        self._image_width = max(1, self._settings.integer('preview_image_width'))
+        self._create_tiles = self._settings.boolean('preview_tiles')
+        # Check if enabled or already started.
+        if (not self._settings.boolean('preview_create')) or self._active:
+            return
+        #
+        try:
+            self._active = True
+            self._control_thread = threading.Thread(target = self._control_exec, args = [])
+            self._control_thread.start()
+        except Exception as e:
+            self._active = False
+            self._logger.error('Preview: Failed to start. ' + str(e))
+
+    def stop(self):
+        """ Queued files without previews are skipped. """
+        self._active = False
+        self._file_queue.put(None)
+        self._stop_process()
+
+    def add_file(self, file_path):
+        """ Wave files only. """
+        if self._active and file_path.endswith('.wav'):
+            self._file_queue.put(file_path)
+
+    def set_recorder_busy(self, busy):
+        """ True while a sound file is open. """
+        self._recorder_busy = busy
+
+    def _start_process(self):
+        """ """
+        command = [sys.executable, '-c',
+                   'import sys; import wurb_core; ' + 
+                   'wurb_core.wurb_preview.worker_main(int(sys.argv[1]), int(sys.argv[2]), ' + 
+                   'sys.argv[3] == "Y")',
+                   str(self._decimation), str(self._image_width), 
+                   'Y' if self._create_tiles else 'N']
+        if shutil.which('ionice'):
+            command = ['ionice', '-c', '3'] + command # Idle I/O class.
+        package_dir_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self._process = subprocess.Popen(command,
+                                         cwd=package_dir_path,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         universal_newlines=True,
+                                         preexec_fn=lambda: os.nice(19))
+        self._paused = False
+
+    def _stop_process(self):
+        """ """
+        process = self._process
+        self._process = None
+        if process and (process.poll() is None):
+            try:
+                process.send_signal(signal.SIGCONT)
+                process.stdin.close()
+                process.wait(timeout=10)
+            except Exception:
+                process.kill()
+
+    def _update_pause(self):
+        """ Pause when the recorder is busy and there is no CPU headroom. """
+        try:
+            cpu_times = read_cpu_times()
+        except Exception:
+            return
+        cpu_load = 0.0
+        if self._cpu_times:
+            busy_delta = cpu_times[0] - self._cpu_times[0]
+            total_delta = cpu_times[1] - self._cpu_times[1]
+            if total_delta > 0:
+                cpu_load = busy_delta / total_delta
+        self._cpu_times = cpu_times
+        #
+        pause = self._recorder_busy and (cpu_load > self._max_cpu_load)
+        if self._process and (pause != self._paused):
+            self._process.send_signal(signal.SIGSTOP if pause else signal.SIGCONT)
+            self._paused = pause
+            if pause:
+                self._pause_counter += 1
+            self._logger.debug('Preview: ' + ('Paused' if pause else 'Continued') +
+                               '. CPU load: ' + str(round(cpu_load, 2)))
+
+    def _control_exec(self):
+        """ Running in thread. One file at a time is sent to the worker. """
+        while self._active:
+            try:
+                file_path = self._file_queue.get(timeout=1.0)
+            except queue.Empty:
+                self._update_pause()
+                continue
+            if file_path is None:
+                break # Terminated.
+            #
+            try:
+                if (self._process is None) or (self._process.poll() is not None):
+                    self._start_process()
+                self._process.stdin.write(file_path + '\n')
+                self._process.stdin.flush()
+                # Wait for reply. Check load meanwhile.
+                while self._active and self._process:
+                    readable, _, _ = select.select([self._process.stdout], [], [], 1.0)
+                    if readable:
+                        reply = self._process.stdout.readline().strip()
+                        if reply == 'OK':
+                            self._preview_counter += 1
+                        else:
+                            self._logger.warning('Preview: Failed: ' + file_path + ' ' + reply)
+                        break
+                    self._update_pause()
+            except Exception as e:
+                self._logger.error('Preview: Exception: ' + str(e))
+                self._stop_process()
+        #
+        self._logger.info('Preview: Created previews: ' + str(self._preview_counter) +
+                          '  Paused: ' + str(self._pause_counter))
+
+
+def worker_main(decimation, image_width, create_tiles=False):
+    """ Child process. Reads file paths from stdin, one per line. """
+    for line in sys.stdin:
+        file_path = line.strip()
+        if not file_path:
+            continue
+        try:
+            create_preview(file_path, decimation=decimation, image_width=image_width, 
+                           create_tiles=create_tiles)
+            reply = 'OK'
+        except Exception as e:
+            reply = 'ERROR ' + str(e).replace('\n', ' ')
+        sys.stdout.write(reply + '\n')
+        sys.stdout.flush()
+
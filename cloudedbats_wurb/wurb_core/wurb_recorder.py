@@ -7,7 +7,9 @@
 import os
 import logging
 import time
-import wave
+import hashlib
+import threading
+import datetime
 import pyaudio
 import wurb_core
 
@@ -23,8 +25,12 @@ def default_settings():
         {'key': 'rec_directory_path', 'value': '/media/usb0/wurb1_rec'}, 
         {'key': 'rec_filename_prefix', 'value': 'WURB1'},
         {'key': 'rec_format', 'value': 'FS'}, # "TE" (Time Expansion) ot "FS" (Full Scan).        
+        {'key': 'rec_file_format', 'value': 'WAV'}, # "WAV" or "FLAC" (lossless compression).
+        {'key': 'rec_dir_sharding', 'value': 'Night'}, # Subdirectories: "None", "Night", "Date" or "Hour".
         {'key': 'rec_max_length_s', 'value': '20'},
         {'key': 'rec_buffers_s', 'value': 2.0}, # Pre- and post detected sound buffer size.
+        {'key': 'rec_trim_to_sound', 'value': 'N'}, # "Y": Cut files to detected sound plus margins.
+        {'key': 'rec_trim_margin_ms', 'value': '200'}, # Margin before and after sound when trimmed.
         # Hardware.
         {'key': 'rec_sampling_freq_khz', 'value': '384'}, 
         {'key': 'rec_microphone_type', 'value': 'USB'}, # "USB" or "M500".
@@ -36,33 +42,46 @@ def default_settings():
         {'key': 'rec_proc_debug', 'value': 'N'}, 
         {'key': 'rec_target_debug', 'value': 'N'}, 
         {'key': 'rec_source_adj_time_on_drift', 'value': 'Y'}, 
+        {'key': 'rec_source_reconnect_timeout_s', 'value': '60'}, # Wait for lost sound card.
+        {'key': 'rec_device_poll_interval_s', 'value': '2.0'}, # Check for added/removed sound cards.
+        {'key': 'rec_write_chunk_kb', 'value': '0'}, # 0=Erase block size of the memory device.
+        {'key': 'rec_preallocate', 'value': 'Y'}, # Preallocate file space for max rec length.
+        {'key': 'rec_io_buffer_max_mb', 'value': '64'}, # Queued data for the file writer thread.
+        {'key': 'rec_io_stall_limit_s', 'value': '1.0'}, # Slower file operations are logged as stalls.
+        {'key': 'rec_flac_compression_level', 'value': '5'}, # 0=fast, 8=best.
+        {'key': 'rec_catalog', 'value': 'Y'}, # SQLite catalog in the rec directory.
+        {'key': 'rec_guano_metadata', 'value': 'Y'}, # GUANO metadata chunk in wave files.
+        {'key': 'rec_manifest', 'value': 'Y'}, # SHA-256 checksums in a manifest per night.
+        {'key': 'rec_staging_dir_path', 'value': ''}, # RAM staging, example: "/dev/shm/wurb_staging".
+        {'key': 'rec_staging_max_mb', 'value': '128'}, # Max RAM for staged files.
+        {'key': 'rec_staging_min_free_ram_mb', 'value': '64'}, # Direct write below this.
         ]
     #
     return description, default_settings, developer_settings
 
 def get_device_list():
-    """ Sound source util. Check connected sound cards. """
-    py_audio = pyaudio.PyAudio()
-    device_list = []
-    device_count = py_audio.get_device_count()
-    for index in range(device_count):
-        info_dict = py_audio.get_device_info_by_index(index)
-        # Sound card for input only.
-        if info_dict['maxInputChannels'] != 0:
-            device_list.append(info_dict['name'])
-    #
-    return device_list
+    """ Sound source util. Check connected sound cards. Cached. """
+    return wurb_core.WurbSoundCards().get_device_list()
 
 def get_device_index(part_of_device_name):
-    """ Sound source util. Lookup for device by name. """
-    py_audio = pyaudio.PyAudio()
-    device_count = py_audio.get_device_count()
-    for index in range(device_count):
-        info_dict = py_audio.get_device_info_by_index(index)
-        if part_of_device_name in info_dict['name']:
-            return index
+    """ Sound source util. Lookup for device by name. Cached. """
+    return wurb_core.WurbSoundCards().get_device_index(part_of_device_name)
+
+def get_shard_dir_name(local_time_s, dir_sharding):
+    """ Sound target util. Subdirectory for new sound files. Large FAT 
+        directories are slow since each file create scans the directory.
+        Nights start at noon, as for the scheduler. Examples for the night 
+        and the morning after: "20180420_night", "20180421", "20180421T04".
+        Empty string if not used. """
+    if dir_sharding == 'Night':
+        night_start_s = local_time_s - wurb_core.wurb_scheduler.NIGHT_START_HOUR * 3600
+        return time.strftime('%Y%m%d', time.gmtime(night_start_s)) + '_night'
+    elif dir_sharding == 'Date':
+        return time.strftime('%Y%m%d', time.gmtime(local_time_s))
+    elif dir_sharding == 'Hour':
+        return time.strftime('%Y%m%dT%H', time.gmtime(local_time_s))
     #
-    return None
+    return ''
 
 
 class WurbRecorder(object):
@@ -121,9 +140,13 @@ class SoundSource(wurb_core.SoundSourceBase):
         #
         self._debug = self._settings.boolean('rec_source_debug')
         self._rec_source_adj_time_on_drift = self._settings.boolean('rec_source_adj_time_on_drift')
+        self._reconnect_timeout_s = self._settings.float('rec_source_reconnect_timeout_s')
         #
-        self._pyaudio = pyaudio.PyAudio()
+        self._sound_cards = wurb_core.WurbSoundCards()
         self._stream = None
+        # Statistics for lost sound cards.
+        self._reconnect_counter = 0
+        self._lost_time_total_s = 0.0
         #
         self.read_settings()
         
@@ -138,6 +161,7 @@ class SoundSource(wurb_core.SoundSourceBase):
         # Sound card.
         in_device_name = self._settings.text('rec_part_of_device_name')
         in_device_index = self._settings.integer('rec_device_index') # Default=0. First recognized sound card.
+        self._in_device_name = in_device_name # Used for lookup after reconnect.
         if in_device_name:
             self._in_device_index = wurb_core.get_device_index(in_device_name)
         else:
@@ -145,12 +169,12 @@ class SoundSource(wurb_core.SoundSourceBase):
 
         self._logger.info('Recorder: Sampling frequency (hz): ' + str(self._sampling_freq_hz))
          
-    def _setup_pyaudio(self):
-        """ """
+    def _setup_pyaudio(self, report_error=True):
+        """ report_error=False: Only logged, used for retries on reconnect. """
         # Initiate PyAudio.
         try:
-            self._stream = self._pyaudio.open(
-                format = self._pyaudio.get_format_from_width(2), # 2=16 bits.
+            self._stream = self._sound_cards.open_stream(
+                format = pyaudio.get_format_from_width(2), # 2=16 bits.
                 channels = 1, # 1=Mono.
                 rate = self._sampling_freq_hz,
                 frames_per_buffer = self._sampling_freq_hz, # Buffer 1 sec.
@@ -161,6 +185,9 @@ class SoundSource(wurb_core.SoundSourceBase):
             )
         except Exception as e:
             self._stream = None
+            if not report_error:
+                self._logger.debug('Recorder: Failed to create stream, will retry: ' + str(e))
+                return
             self._logger.error('Recorder: Failed to create stream: ' + str(e))
             # Report to state machine.
             if self._callback_function:
@@ -184,40 +211,100 @@ class SoundSource(wurb_core.SoundSourceBase):
         # 
         buffer_size = int(self._sampling_freq_hz / 2)
         
-        # Main source loop.
-        try:
-            data = self._stream.read(buffer_size) #, exception_on_overflow=False)
-            while self._active and data:
-                # Add time and check for time drift.
-                self._stream_time_s += 0.5 # One buffer is 0.5 sec.
-                if (self._stream_time_s > (time.time() + 10)) or \
-                   (self._stream_time_s < (time.time() - 10)):
-                    #
-                    time_diff_s = int(time.time() - self._stream_time_s)
-                    if self._rec_source_adj_time_on_drift:
-                        self._logger.warning('Recorder: Rec. time adjusted. Diff: ' + str(time_diff_s) + ' sec.')
-                        self._stream_time_s = time.time()
-                    else:
-                        self._logger.debug('Recorder: Rec. time drift. Diff: ' + str(time_diff_s) + ' sec.')                    
-                # Push time and data buffer.
-                self.push_item((self._stream_time_s, data)) 
-                #
+        # Main source loop. Restarted if the sound card was lost and reconnected.
+        while self._active:
+            try:
                 data = self._stream.read(buffer_size) #, exception_on_overflow=False)
-        except Exception as e:
-            self._logger.error('Recorder: Failed to read stream: ' + str(e))
+                while self._active and data:
+                    # Add time and check for time drift.
+                    self._stream_time_s += 0.5 # One buffer is 0.5 sec.
+                    if (self._stream_time_s > (time.time() + 10)) or \
+                       (self._stream_time_s < (time.time() - 10)):
+                        #
+                        time_diff_s = int(time.time() - self._stream_time_s)
+                        if self._rec_source_adj_time_on_drift:
+                            self._logger.warning('Recorder: Rec. time adjusted. Diff: ' + str(time_diff_s) + ' sec.')
+                            self._stream_time_s = time.time()
+                        else:
+                            self._logger.debug('Recorder: Rec. time drift. Diff: ' + str(time_diff_s) + ' sec.')                    
+                    # Push time and data buffer.
+                    self.push_item((self._stream_time_s, data)) 
+                    #
+                    data = self._stream.read(buffer_size) #, exception_on_overflow=False)
+                # Terminated or no more data.
+                break
+            except Exception as e:
+                self._logger.error('Recorder: Failed to read stream: ' + str(e))
+            # Try to reopen the stream if the sound card was re-enumerated.
+            if (not self._active) or (not self._reconnect()):
+                break
 
         # Main loop terminated.
         self._logger.debug('Source: Source terminated.')
         self.push_item(None)
         #
+        self._close_stream()
+
+    def _close_stream(self):
+        """ """
         if self._stream is not None:
             try:
-                self._stream.stop_stream()
-                self._stream.close()
+                self._sound_cards.close_stream(self._stream)
             except: 
                 self._logger.error('Recorder: Pyaudio stream stop/close failed.')
             self._stream = None
 
+    def _reconnect(self):
+        """ Waits until the lost sound card is enumerated again and reopens 
+            the stream. The card may be listed before it can be opened, for 
+            example with a stale index, and opening is retried until the 
+            timeout. Returns False if not reconnected within the timeout. """
+        lost_at_time_s = time.time()
+        end_time_s = lost_at_time_s + self._reconnect_timeout_s
+        self._close_stream()
+        self._logger.warning('Recorder: Sound card lost. Waiting for reconnect.')
+        if self._callback_function:
+            self._callback_function('rec_source_warning')
+        #
+        while self._active:
+            device_index = self._sound_cards.wait_for_device(
+                                    part_of_device_name=self._in_device_name, 
+                                    device_index=self._in_device_index, 
+                                    timeout_s=max(0.0, end_time_s - time.time()), 
+                                    is_active_function=lambda: self._active)
+            if device_index is not None:
+                self._in_device_index = device_index
+                self._setup_pyaudio(report_error=False)
+                if self._stream is not None:
+                    try:
+                        self._stream.start_stream()
+                        break # Reconnected.
+                    except Exception as e:
+                        self._logger.debug('Recorder: Failed to start stream, will retry: ' + str(e))
+                        self._close_stream()
+            if time.time() >= end_time_s:
+                break
+            time.sleep(1.0)
+        #
+        if self._stream is None:
+            if self._active:
+                self._logger.error('Recorder: Sound card not reconnected within ' + 
+                                   str(self._reconnect_timeout_s) + ' sec.')
+                # Report to state machine.
+                if self._callback_function:
+                    self._callback_function('rec_source_error')
+            return False
+        self._stream_time_s = time.time()
+        # Report lost recording time.
+        lost_time_s = time.time() - lost_at_time_s
+        self._reconnect_counter += 1
+        self._lost_time_total_s += lost_time_s
+        self._logger.warning('Recorder: Sound card reconnected. Lost recording time: ' + 
+                             str(round(lost_time_s, 1)) + ' sec. Total lost: ' + 
+                             str(round(self._lost_time_total_s, 1)) + ' sec in ' + 
+                             str(self._reconnect_counter) + ' reconnects.')
+        return True
+
 class SoundSourceM500(SoundSource):
     """ Subclass of SoundSource for the Pettersson M500 microphone. """
     def __init__(self, callback_function=None):
@@ -295,6 +382,12 @@ class SoundProcess(wurb_core.SoundProcessBase):
         #
         self._debug = self._settings.boolean('rec_proc_debug')
         self._rec_buffers_s = self._settings.float('rec_buffers_s')
+        self._rec_trim_to_sound = self._settings.boolean('rec_trim_to_sound')
+        self._rec_trim_margin_s = self._settings.float('rec_trim_margin_ms') / 1000.0
+        if self._settings.text('rec_microphone_type') == 'M500':
+            self._sampling_freq_hz = 500000
+        else:
+            self._sampling_freq_hz = self._settings.integer('rec_sampling_freq_khz') * 1000
 
     def process_exec(self):
         """ Called from base class. """
@@ -306,6 +399,10 @@ class SoundProcess(wurb_core.SoundProcessBase):
         except Exception as e:
             sound_detector = None
             self._logger.error('Recorder: SoundDetector exception: ', str(e))
+        # Sample precise trimming is done in a separate loop.
+        if self._rec_trim_to_sound:
+            self._process_exec_trimmed(sound_detector)
+            return
 
         sound_detected = False
         #
@@ -341,8 +438,9 @@ class SoundProcess(wurb_core.SoundProcessBase):
                                 self.push_item(silent_time_and_data)
                             #
                             silent_buffer = []
-                        # Send buffer.    
-                        self.push_item(time_and_data)
+                        # Send buffer. Detector info added for the catalog.
+                        rec_time, data = time_and_data
+                        self.push_item((rec_time, data, self._get_sound_info(sound_detector)))
                         silent_counter = 0
                     else:
                         
@@ -365,6 +463,156 @@ class SoundProcess(wurb_core.SoundProcessBase):
                                 silent_buffer.pop(0)
         except Exception as e:
             self._logger.error('Recorder: Sound process_exec exception: ', str(e))
+    
+    def _process_exec_trimmed(self, sound_detector):
+        """ Same as process_exec, but only the active part and a margin before and 
+            after is forwarded. Boundaries are sample indexes from the sound detector. 
+            Silent buffers after sound are held until sound is detected again, then 
+            forwarded, or until the file ends, then only the margin is forwarded. """
+        if sound_detector is not None:
+            sound_detector.find_active_span = True
+        #
+        buffer_size = int(self._rec_buffers_s * 2.0) # Buffers are of 0.5 sec length.
+        margin_bytes = int(self._rec_trim_margin_s * self._sampling_freq_hz) * 2 # 16 bits.
+        #
+        pre_buffer = [] # Silent buffers before sound. List of (time, data).
+        held_list = [] # Silent parts after sound. List of (time, data).
+        sound_active = False # True when sound was detected, until end of file.
+        silent_counter = 0
+        # Statistics for saved bytes compared to block granular writing.
+        # The pre buffer is pruned to the margin, silent buffers are counted
+        # separately. Block granular writing forwards up to buffer_size of them.
+        silent_before_counter = 0
+        trimmed_bytes = 0
+        block_bytes = 0
+        total_trimmed_bytes = 0
+        total_block_bytes = 0
+        
+        try:
+            while self._active:
+                time_and_data = self.pull_item()
+                
+                if time_and_data is None:
+                    self._logger.debug('Rec-process terminated.')
+                    self._active = False
+                    # Forward margin after sound before terminating.
+                    if sound_active:
+                        trimmed_bytes += self._push_head(held_list, margin_bytes)
+                    # Terminated by previous step.
+                    self.push_item(None)
+                    continue
+                #
+                rec_time, data = time_and_data
+                try:
+                    sound_detected = sound_detector.check_for_sound(time_and_data)
+                    if sound_detected:
+                        start_byte = sound_detector.active_start_index * 2
+                        end_byte = sound_detector.active_end_index * 2
+                except Exception as e:
+                    sound_detected = True
+                    start_byte = 0
+                    end_byte = len(data)
+                #
+                if sound_detected:
+                    
+                    if self._debug:
+                        print('DEBUG: Sound detected. Bytes: ', start_byte, ' - ', end_byte)
+                    
+                    if not sound_active:
+                        # Margin before sound. May start in earlier buffers.
+                        trimmed_bytes += self._push_tail(pre_buffer, margin_bytes - start_byte)
+                        block_bytes += len(data) * min(silent_before_counter, buffer_size)
+                        silent_before_counter = 0
+                        start_byte = max(0, start_byte - margin_bytes)
+                        sound_active = True
+                    else:
+                        # Sound again. Forward held silent parts.
+                        for held_time_and_data in held_list:
+                            self.push_item(held_time_and_data)
+                            trimmed_bytes += len(held_time_and_data[1])
+                        start_byte = 0
+                    # Forward active part. Hold the rest. Time is adjusted to 
+                    # the end of the forwarded part, as for full buffers.
+                    end_time = rec_time - (len(data) - end_byte) / 2 / self._sampling_freq_hz
+                    self.push_item((end_time, data[start_byte:end_byte], 
+                                    self._get_sound_info(sound_detector)))
+                    trimmed_bytes += end_byte - start_byte
+                    block_bytes += len(data)
+                    held_list = [(rec_time, data[end_byte:])]
+                    pre_buffer = []
+                    silent_counter = 0
+                
+                elif sound_active:
+                    held_list.append(time_and_data)
+                    silent_counter += 1
+                    if silent_counter >= (buffer_size * 2): # Unit 0.5 sec.
+                        # End of file. Forward margin after sound.
+                        trimmed_bytes += self._push_head(held_list, margin_bytes)
+                        block_bytes += len(data) * buffer_size
+                        self.push_item(False)
+                        sound_active = False
+                        pre_buffer = held_list[1:]
+                        silent_before_counter = len(pre_buffer)
+                        held_list = []
+                        # Report saved bytes.
+                        total_trimmed_bytes += trimmed_bytes
+                        total_block_bytes += block_bytes
+                        if block_bytes > 0:
+                            self._logger.debug('Recorder: Trimmed to sound. Saved bytes: ' + 
+                                               str(block_bytes - trimmed_bytes) + ' (' + 
+                                               str(round((block_bytes - trimmed_bytes) * 100 / block_bytes)) + 
+                                               '%). Total saved bytes: ' + 
+                                               str(total_block_bytes - total_trimmed_bytes))
+                        trimmed_bytes = 0
+                        block_bytes = 0
+                
+                else:
+                    # Silent, store in pre buffer.
+                    pre_buffer.append(time_and_data)
+                    silent_before_counter += 1
+                
+                # Only the margin is needed in the pre buffer.
+                while (len(pre_buffer) > 1) and \
+                      (sum([len(x[1]) for x in pre_buffer[1:]]) >= margin_bytes):
+                    pre_buffer.pop(0)
+        except Exception as e:
+            self._logger.error('Recorder: Sound process_exec exception: ' + str(e))
+    
+    def _get_sound_info(self, sound_detector):
+        """ Detector summary for the last checked buffer, or None. """
+        try:
+            return sound_detector.get_sound_info()
+        except:
+            return None
+    
+    def _push_head(self, time_and_data_list, max_bytes):
+        """ Forwards the first part, max_bytes long. Returns forwarded bytes. """
+        pushed_bytes = 0
+        for rec_time, data in time_and_data_list:
+            if pushed_bytes >= max_bytes:
+                break
+            data = data[:max_bytes - pushed_bytes]
+            if data:
+                self.push_item((rec_time, data))
+                pushed_bytes += len(data)
+        #
+        return pushed_bytes
+    
+    def _push_tail(self, time_and_data_list, max_bytes):
+        """ Forwards the last part, max_bytes long. Returns forwarded bytes. """
+        tail_list = []
+        tail_bytes = 0
+        for rec_time, data in reversed(time_and_data_list):
+            if tail_bytes >= max_bytes:
+                break
+            if len(data) > (max_bytes - tail_bytes):
+                data = data[len(data) - (max_bytes - tail_bytes):]
+            tail_list.insert(0, (rec_time, data))
+            tail_bytes += len(data)
+        for time_and_data in tail_list:
+            self.push_item(time_and_data)
+        #
+        return tail_bytes
                     
 
 
@@ -379,12 +627,9 @@ class SoundTarget(wurb_core.SoundTargetBase):
         super(SoundTarget, self).__init__()
         # From settings. 
         self._dir_path = self._settings.text('rec_directory_path')
+        self._dir_sharding = self._settings.text('rec_dir_sharding')
         self._filename_prefix = self._settings.text('rec_filename_prefix')
         rec_max_length_s = self._settings.integer('rec_max_length_s')
-        self._rec_max_length = rec_max_length_s * 2
-        # Default for latitude/longitude in the decimal degree format.
-        self._latitude = float(self._settings.float('default_latitude'))
-        self._longitude = float(self._settings.float('default_longitude'))
         # Different microphone types.
         if self._settings.text('rec_microphone_type') == 'M500':
             # For M500 only.
@@ -402,23 +647,96 @@ class SoundTarget(wurb_core.SoundTargetBase):
             else:
                 self._filename_rec_type = 'FS' + self._settings.text('rec_sampling_freq_khz')
                 self._out_sampling_rate_hz = self._settings.integer('rec_sampling_freq_khz') * 1000
+        # Time expansion factor. Used in metadata.
+        if self._settings.text('rec_format') == 'TE':
+            self._te_factor = 10
+        else:
+            self._te_factor = 1
+        # File format. FLAC needs the external encoder.
+        self._file_format = self._settings.text('rec_file_format').upper()
+        if self._file_format == 'FLAC':
+            if not wurb_core.is_flac_available():
+                self._logger.error('Recorder: FLAC encoder not installed. WAV format is used.')
+                self._file_format = 'WAV'
+        else:
+            self._file_format = 'WAV'
+        self._file_extension = '.' + self._file_format.lower()
+        # GUANO metadata, appended to wave files at close.
+        self._guano_metadata = self._settings.boolean('rec_guano_metadata')
+        self._detector_settings = []
+        for key in ['sound_detector', 'sound_simple_filter_min_hz', 
+                    'sound_simple_threshold_dbfs', 'sound_simple_window_size', 
+                    'sound_simple_jump', 'rec_trim_to_sound', 'rec_trim_margin_ms']:
+            self._detector_settings.append((key, self._settings.text(key)))
+        self._flac_compression_level = self._settings.integer('rec_flac_compression_level')
+        # Large aligned writes. Default chunk size is the erase block size.
+        write_chunk_kb = self._settings.integer('rec_write_chunk_kb')
+        if write_chunk_kb > 0:
+            self._write_chunk_size = write_chunk_kb * 1024
+        else:
+            self._write_chunk_size = wurb_core.get_erase_block_size(self._dir_path)
+        # Max file size. Same amount of data for FS and TE.
+        if self._settings.text('rec_microphone_type') == 'M500':
+            max_file_bytes = rec_max_length_s * 500000 * 2
+        else:
+            max_file_bytes = rec_max_length_s * self._settings.integer('rec_sampling_freq_khz') * 1000 * 2
+        self._preallocate_size = 0
+        self._max_file_bytes = max_file_bytes
+        if self._settings.boolean('rec_preallocate'):
+            self._preallocate_size = max_file_bytes + wurb_core.WAVE_HEADER_SIZE
+        self._logger.info('Recorder: Write chunk size (kB): ' + str(int(self._write_chunk_size / 1024)))
+        # Writes are done in a separate thread. Room for at least one full file.
+        io_buffer_max_bytes = max(self._settings.integer('rec_io_buffer_max_mb') * 1000000, 
+                                  max_file_bytes)
+        self._file_writer = wurb_core.WurbFileWriter(
+                                    buffer_max_bytes=io_buffer_max_bytes, 
+                                    file_buffer_max_bytes=max_file_bytes, 
+                                    stall_limit_s=self._settings.float('rec_io_stall_limit_s'), 
+                                    callback_function=self._callback_function)
+        # Catalog for recorded files. Updated from the file writer thread.
+        self._catalog = None
+        if self._settings.boolean('rec_catalog'):
+            self._catalog = wurb_core.WurbCatalog(os.path.join(self._dir_path, 'wurb_catalog.db'))
+        # Checksums, calculated on written buffers. Appended from the file 
+        # writer thread, or from the staging mover thread.
+        self._manifest = self._settings.boolean('rec_manifest')
+        self._manifest_lock = threading.Lock()
+        # Created by the file writer thread when the first file is opened.
+        self._created_dirs = set()
+        # Free space is checked before new files are opened.
+        self._storage = wurb_core.WurbStorageManager()
+        self._preview = wurb_core.WurbPreviewGenerator()
+        # Optional RAM staging. Files are moved to the rec directory when closed.
+        self._staging_mover = None
+        staging_dir_path = self._settings.text('rec_staging_dir_path')
+        if staging_dir_path:
+            self._staging_mover = wurb_core.WurbStagingMover(staging_dir_path, 
+                        max_bytes=self._settings.integer('rec_staging_max_mb') * 1000000, 
+                        min_free_ram_bytes=self._settings.integer('rec_staging_min_free_ram_mb') * 1000000, 
+                        copy_chunk_size=self._write_chunk_size)
         #
-        self._total_start_time = None
-        self._internal_buffer_list = []
-        self._write_thread_active = False
         self._active = False
     
     def target_exec(self):
         """ Called from base class. """
         self._active = True
         wave_file_writer = None
-        # Use buffer to increase write speed.
-        item_list = []
-        item_list_max = 5 # Unit 0.5 sec. Before flush to file.
-        item_counter = 0
+        file_shed = False # True if skipped since the storage is behind.
+        file_bytes = 0 # Buffers may be trimmed. Count bytes, not buffers.
+        # Files left from an earlier session, for example after power failure.
+        if self._staging_mover:
+            self._staging_mover.start()
+            self._add_moved_files_to_catalog(
+                    self._staging_mover.move_leftover_files(self._dir_path, 
+                                                            self._dir_sharding))
+        self._recover_partial_files()
+        # Files are written in a separate thread.
+        self._file_writer.start()
         #
         try:
             while self._active:
+                # Previews are paused while busy, if the CPU load is high.
+                self._preview.set_recorder_busy(wave_file_writer is not None)
                 item = self.pull_item()
                 
                 # "None" indicates terminate by previous part in chain.
@@ -429,59 +747,51 @@ class SoundTarget(wurb_core.SoundTargetBase):
                 # "False" indicates silent part. Close file until not silent. 
                 elif item is False:
                     if wave_file_writer:
-                        # Flush buffer.
-                        joined_items = b''.join(item_list)
-                        item_list = []
-                        wave_file_writer.write(joined_items)
-                        # Close.
-                        wave_file_writer.close()
+                        self._file_writer.close_file(wave_file_writer)
                         wave_file_writer = None
-                        item_counter = 0
+                    file_shed = False
+                    file_bytes = 0
                     #
                     continue
                 
                 # Normal case, write frames.
                 else:
-                    _rec_time, data = item # "rec_time" not used.
+                    # Detector results are added by the sound process, if available.
+                    rec_time, data = item[0], item[1]
+                    sound_info = item[2] if len(item) > 2 else None
 
-                    # Open file if first after silent part.
-                    if not wave_file_writer:
-                        wave_file_writer = WaveFileWriter(self)
-                        
                     # Check if max rec length was reached.
-                    if item_counter >= self._rec_max_length: 
+                    if file_bytes >= self._max_file_bytes: 
                         if wave_file_writer:
-                            # Flush buffer.
-                            joined_items = b''.join(item_list)
-                            item_list = []
-                            wave_file_writer.write(joined_items)
-                            # Close the old one.
-                            wave_file_writer.close()
+                            # Close the old one. A new one is opened below.
+                            self._file_writer.close_file(wave_file_writer)
                             wave_file_writer = None
-                            item_counter = 0
-                            # Open a new file.
-                            wave_file_writer = WaveFileWriter(self)
-                                
-                    # Append data to buffer
-                    item_list.append(data)
-                    item_counter += 1
+                        file_shed = False
+                        file_bytes = 0
                     
-                    # Flush buffer when needed.
-                    if len(item_list) >= item_list_max:
-                        if wave_file_writer:
-                            joined_items = b''.join(item_list)
-                            item_list = []
-                            wave_file_writer.write(joined_items)
+                    # Open file if first after silent part.
+                    if (wave_file_writer is None) and (not file_shed):
+                        if not self._storage.is_space_available(self._preallocate_size or 
+                                                                self._max_file_bytes):
+                            # Below the storage reserve. Skip the whole file.
+                            file_shed = True
+                    if (wave_file_writer is None) and (not file_shed):
+                        wave_file_writer = WaveFileWriter(self)
+                        if not self._file_writer.open_file(wave_file_writer):
+                            # Storage is behind. Skip the whole file.
+                            wave_file_writer = None
+                            file_shed = True
+                    
+                    # Queue data for the writer thread. 
+                    if wave_file_writer:
+                        wave_file_writer.add_buffer_info(rec_time, len(data), sound_info)
+                        self._file_writer.write(wave_file_writer, data)
+                        self._storage.add_written_bytes(len(data))
+                    file_bytes += len(data)
             
             # Thread terminated.
             if wave_file_writer:
-                if len(item_list) > 0:
-                    # Flush buffer.
-                    joined_items = b''.join(item_list)
-                    item_list = []
-                    wave_file_writer.write(joined_items)
-                #
-                wave_file_writer.close()
+                self._file_writer.close_file(wave_file_writer)
                 wave_file_writer = None
         #
         except Exception as e:
@@ -489,44 +799,101 @@ class SoundTarget(wurb_core.SoundTargetBase):
             self._active = False # Terminate
             if self._callback_function:
                 self._callback_function('rec_target_error')
+        self._preview.set_recorder_busy(False)
+        # Wait until queued files are written and moved.
+        self._file_writer.stop()
+        if self._staging_mover:
+            self._staging_mover.stop()
+        if self._catalog:
+            self._catalog.close()
+
+    def _add_moved_files_to_catalog(self, file_paths):
+        """ Files moved from staging at start. Partial files are added later 
+            by the recovery scan. """
+        if not self._catalog:
+            return
+        for file_path in file_paths:
+            if not file_path.endswith(wurb_core.PARTIAL_FILE_SUFFIX):
+                try:
+                    record = wurb_core.wurb_catalog.catalog_record_from_file(file_path)
+                    if record:
+                        self._catalog.add_file(record)
+                except Exception as e:
+                    self._logger.warning('Recorder: Failed to update catalog: ' + str(e))
+
+    def _recover_partial_files(self):
+        """ Repairs and renames files still having the temporary name. 
+            Only names are checked, os.scandir() does not need a stat call 
+            for each file. The rec directory and its subdirectories are 
+            scanned. """
+        start_time = time.time()
+        recovered_counter = 0
+        try:
+            if not os.path.exists(self._dir_path):
+                return
+            partial_paths = []
+            scan_dir_paths = [self._dir_path]
+            while scan_dir_paths:
+                with os.scandir(scan_dir_paths.pop()) as dir_entries:
+                    for dir_entry in dir_entries:
+                        if dir_entry.name.endswith(wurb_core.PARTIAL_FILE_SUFFIX):
+                            partial_paths.append(dir_entry.path)
+                        elif dir_entry.is_dir():
+                            scan_dir_paths.append(dir_entry.path)
+            #
+            for partial_path in partial_paths:
+                file_path = partial_path[:-len(wurb_core.PARTIAL_FILE_SUFFIX)]
+                try:
+                    if file_path.endswith('.wav'):
+                        if wurb_core.repair_wave_file(partial_path) is None:
+                            self._logger.warning('Recorder: Empty file removed: ' + partial_path)
+                            os.remove(partial_path)
+                            continue
+                    # FLAC files are kept as is. Length is unknown in the header.
+                    os.rename(partial_path, file_path)
+                    recovered_counter += 1
+                    if self._catalog:
+                        record = wurb_core.wurb_catalog.catalog_record_from_file(file_path)
+                        if record:
+                            self._catalog.add_file(record)
+                except Exception as e:
+                    self._logger.warning('Recorder: Failed to recover: ' + partial_path + ' ' + str(e))
+        except Exception as e:
+            self._logger.error('Recorder: Recovery scan failed: ' + str(e))
+        #
+        if recovered_counter > 0:
+            self._logger.warning('Recorder: Recovered files not closed: ' + str(recovered_counter))
+        self._logger.debug('Recorder: Recovery scan time (ms): ' + 
+                           str(round((time.time() - start_time) * 1000, 1)))
 
 
 class WaveFileWriter():
-    """ Each file is connected to a separate object to avoid concurrency problems. """
+    """ Each file is connected to a separate object to avoid concurrency problems. 
+        The file name is created when the object is created. open(), write() and 
+        close() are called from the file writer thread. """
     def __init__(self, sound_target_obj):
         """ """
         self._wave_file = None
         self._sound_target_obj = sound_target_obj
         self._size_counter = 0 
+        # Time and position from the last metadata snapshot. 
+        snapshot = wurb_core.WurbMetadata().get_snapshot()
+        datetimestring = wurb_core.WurbMetadata().get_datetimestring(snapshot=snapshot)
+        latlongstring = snapshot['latlongstring'] # Format: 'N56.78E12.34'
+        # For the catalog and metadata. Detector results are aggregated per file.
+        self._start_time_s = time.time() # Replaced by time for the first buffer.
+        self._datetimestring = datetimestring
+        self._latitude = snapshot['latitude']
+        self._longitude = snapshot['longitude']
+        self._position_source = snapshot['position_source']
+        self._buffer_counter = 0
+        self._detection_counter = 0
+        self._peak_freq_hz = None
+        self._peak_dbfs = None
+        self._min_freq_hz = None
+        self._max_freq_hz = None
+        self._sha256 = hashlib.sha256() if sound_target_obj._manifest else None
         
-        # Create file name.
-        # Default time and position.
-        datetimestring = time.strftime("%Y%m%dT%H%M%S%z")
-        latlongstring = '' # Format: 'N56.78E12.34'
-        try:
-            if sound_target_obj._latitude >= 0: 
-                latlongstring += 'N' 
-            else: 
-                latlongstring += 'S'
-            latlongstring += str(abs(sound_target_obj._latitude))
-            #
-            if sound_target_obj._longitude >= 0: 
-                latlongstring += 'E' 
-            else: 
-                latlongstring += 'W'
-            latlongstring += str(abs(sound_target_obj._longitude))
-        except:
-            latlongstring = 'N00.00E00.00'
-        
-        # Use GPS time if available.
-        datetime_local_gps = wurb_core.WurbGpsReader().get_time_local_string()
-        if datetime_local_gps:
-            datetimestring = datetime_local_gps
-        # Use GPS position if available.
-        latlong = wurb_core.WurbGpsReader().get_latlong_string()
-        if latlong:
-            latlongstring = latlong
-            
         # Filename example: "WURB1_20180420T205942+0200_N00.00E00.00_TE384.wav"
         filename =  sound_target_obj._filename_prefix + \
                     '_' + \
@@ -535,32 +902,186 @@ class WaveFileWriter():
                     latlongstring + \
                     '_' + \
                     sound_target_obj._filename_rec_type + \
-                    '.wav'
-        filenamepath = os.path.join(sound_target_obj._dir_path, filename)
-        #
-        if not os.path.exists(sound_target_obj._dir_path):
-            os.makedirs(sound_target_obj._dir_path) # For data, full access.
-        # Open wave file for writing.
-        self._wave_file = wave.open(filenamepath, 'wb')
-        self._wave_file.setnchannels(1) # 1=Mono.
-        self._wave_file.setsampwidth(2) # 2=16 bits.
-        self._wave_file.setframerate(sound_target_obj._out_sampling_rate_hz)
+                    sound_target_obj._file_extension
+        self._filename = filename
+        # Subdirectory per night, date or hour.
+        local_time_s = wurb_core.WurbMetadata().get_local_time_s(snapshot=snapshot)
+        shard_dir_name = get_shard_dir_name(local_time_s, sound_target_obj._dir_sharding)
+        self._dir_path = os.path.join(sound_target_obj._dir_path, shard_dir_name)
+        self._filenamepath = os.path.join(self._dir_path, filename)
+        # One manifest per night, in the same directory as the file.
+        self._manifest_path = os.path.join(self._dir_path, 
+                                wurb_core.wurb_manifest.manifest_file_name(
+                                    get_shard_dir_name(local_time_s, 'Night')))
+        # Renamed when closed. Files not closed are recovered at next start.
+        self._partial_filenamepath = self._filenamepath + wurb_core.PARTIAL_FILE_SUFFIX
+        self._staged_filenamepath = None # Used for RAM staging.
+    
+    def open(self):
+        """ """
+        sound_target_obj = self._sound_target_obj
+        # RAM staging if used and if there is room for a full file.
+        file_path = self._partial_filenamepath
+        preallocate_size = sound_target_obj._preallocate_size
+        if sound_target_obj._staging_mover:
+            self._staged_filenamepath = sound_target_obj._staging_mover.reserve(
+                                    os.path.basename(self._partial_filenamepath), 
+                                    sound_target_obj._max_file_bytes + wurb_core.WAVE_HEADER_SIZE)
+            if self._staged_filenamepath:
+                file_path = self._staged_filenamepath
+                preallocate_size = 0 # Not needed on tmpfs.
+        # Directories created once per recording session.
+        if (not self._staged_filenamepath) and (self._dir_path not in sound_target_obj._created_dirs):
+            os.makedirs(self._dir_path, exist_ok=True) # For data, full access.
+            sound_target_obj._created_dirs.add(self._dir_path)
+        # Open file for writing. Mono, 16 bits.
+        try:
+            if sound_target_obj._file_format == 'FLAC':
+                self._wave_file = wurb_core.WurbFlacWriter(file_path, 
+                                        sound_target_obj._out_sampling_rate_hz, 
+                                        compression_level=sound_target_obj._flac_compression_level)
+            else:
+                self._wave_file = wurb_core.WurbWaveWriter(file_path, 
+                                        sound_target_obj._out_sampling_rate_hz, 
+                                        chunk_size=sound_target_obj._write_chunk_size, 
+                                        preallocate_size=preallocate_size)
+        except:
+            if self._staged_filenamepath:
+                sound_target_obj._staging_mover.release(self._staged_filenamepath)
+            raise
         #
-        sound_target_obj._logger.info('Recorder: New sound file: ' + filename)
+        sound_target_obj._logger.info('Recorder: New sound file: ' + self._filename)
         
+    def add_buffer_info(self, rec_time, buffer_bytes, sound_info):
+        """ Called from the sound target thread for each buffer. Time is 
+            for the end of the buffer. """
+        if self._buffer_counter == 0:
+            in_sampling_freq_hz = self._sound_target_obj._out_sampling_rate_hz * \
+                                  self._sound_target_obj._te_factor
+            self._start_time_s = rec_time - buffer_bytes / 2 / in_sampling_freq_hz
+        self._buffer_counter += 1
+        if not sound_info:
+            return
+        self._detection_counter += 1
+        peak_freq_hz = sound_info['peak_freq_hz']
+        if (self._peak_dbfs is None) or (sound_info['peak_dbfs'] > self._peak_dbfs):
+            self._peak_dbfs = sound_info['peak_dbfs']
+            self._peak_freq_hz = peak_freq_hz
+        if (self._min_freq_hz is None) or (peak_freq_hz < self._min_freq_hz):
+            self._min_freq_hz = peak_freq_hz
+        if (self._max_freq_hz is None) or (peak_freq_hz > self._max_freq_hz):
+            self._max_freq_hz = peak_freq_hz
+
     def write(self, buffer):
         """ """
-        self._wave_file.writeframes(buffer)
+        self._wave_file.write(buffer)
         self._size_counter += len(buffer) / 2 # Count frames.
+        if self._sha256:
+            self._sha256.update(buffer) # Same buffer, the data is not read again.
 
     def close(self):
         """ """
         if self._wave_file is not None:
+            if self._sound_target_obj._guano_metadata and \
+               (self._sound_target_obj._file_format == 'WAV'):
+                self._wave_file.add_chunk(wurb_core.guano_chunk(self.get_guano_metadata()))
             self._wave_file.close()
+            stats_dict = self._wave_file.get_stats()
             self._wave_file = None 
+            if not self._staged_filenamepath:
+                os.rename(self._partial_filenamepath, self._filenamepath)
 
             length_in_sec = self._size_counter / self._sound_target_obj._out_sampling_rate_hz
             self._sound_target_obj._logger.info('Recorder: Sound file closed. Length:' + str(length_in_sec) + ' sec.')
+            self._sound_target_obj._logger.debug('Recorder: Write speed (MB/s): ' + 
+                                                 str(round(stats_dict['mb_per_s'], 2)) + 
+                                                 '  Latency (ms) mean: ' + 
+                                                 str(round(stats_dict['mean_latency_ms'], 1)) + 
+                                                 ' max: ' + 
+                                                 str(round(stats_dict['max_latency_ms'], 1)))
+            if 'compression_ratio' in stats_dict:
+                self._sound_target_obj._logger.debug('Recorder: FLAC compression ratio: ' + 
+                                                     str(round(stats_dict['compression_ratio'], 2)) + 
+                                                     '  CPU (% of one core): ' + 
+                                                     str(round(stats_dict['cpu_percent'], 1)))
+            # Staged files are added to the catalog when moved.
+            if self._staged_filenamepath:
+                self._sound_target_obj._staging_mover.move_file(self._staged_filenamepath, 
+                                    self._filenamepath, 
+                                    done_function=lambda: self._file_in_place(stats_dict))
+            else:
+                self._file_in_place(stats_dict)
+
+    def _file_in_place(self, stats_dict):
+        """ Catalog, manifest and preview. Recording continues if this fails. """
+        if self._sound_target_obj._catalog:
+            try:
+                self._sound_target_obj._catalog.add_file(self.get_catalog_record(stats_dict))
+            except Exception as e:
+                self._sound_target_obj._logger.warning('Recorder: Failed to update catalog: ' + str(e))
+        if self._sha256:
+            try:
+                te_factor = self._sound_target_obj._te_factor
+                duration_s = self._size_counter / self._sound_target_obj._out_sampling_rate_hz / te_factor
+                with self._sound_target_obj._manifest_lock:
+                    wurb_core.wurb_manifest.append_manifest_entry(self._manifest_path, 
+                                    self._filename, 
+                                    os.path.getsize(self._filenamepath), 
+                                    duration_s, 
+                                    self._sha256.hexdigest())
+            except Exception as e:
+                self._sound_target_obj._logger.warning('Recorder: Failed to update manifest: ' + str(e))
+        self._sound_target_obj._preview.add_file(self._filenamepath)
+
+    def get_catalog_record(self, stats_dict):
+        """ """
+        sound_target_obj = self._sound_target_obj
+        te_factor = sound_target_obj._te_factor
+        record = {}
+        record['file_name'] = self._filename
+        record['dir_path'] = self._dir_path
+        record['start_time'] = self._datetimestring
+        record['start_time_s'] = self._start_time_s
+        record['duration_s'] = self._size_counter / sound_target_obj._out_sampling_rate_hz / te_factor
+        record['sampling_freq_hz'] = sound_target_obj._out_sampling_rate_hz
+        record['te_factor'] = te_factor
+        record['rec_type'] = sound_target_obj._filename_rec_type
+        record['latitude'] = self._latitude
+        record['longitude'] = self._longitude
+        record['file_size'] = stats_dict['bytes_written']
+        record['detections'] = self._detection_counter
+        record['peak_freq_hz'] = self._peak_freq_hz
+        record['peak_dbfs'] = self._peak_dbfs
+        record['min_freq_hz'] = self._min_freq_hz
+        record['max_freq_hz'] = self._max_freq_hz
+        return record
+
+    def get_guano_metadata(self):
+        """ GUANO fields as (key, value) tuples. WURB specific fields use 
+            the "WURB" namespace. """
+        sound_target_obj = self._sound_target_obj
+        te_factor = sound_target_obj._te_factor
+        start_datetime = datetime.datetime.fromtimestamp(self._start_time_s).astimezone()
+        metadata = []
+        metadata.append(('Make', 'CloudedBats'))
+        metadata.append(('Model', 'WURB'))
+        metadata.append(('Timestamp', start_datetime.isoformat(timespec='milliseconds')))
+        metadata.append(('Length', round(self._size_counter / sound_target_obj._out_sampling_rate_hz / te_factor, 6)))
+        metadata.append(('Samplerate', sound_target_obj._out_sampling_rate_hz * te_factor))
+        metadata.append(('TE', te_factor))
+        metadata.append(('Loc Position', str(self._latitude) + ' ' + str(self._longitude)))
+        metadata.append(('Original Filename', self._filename))
+        metadata.append(('WURB|Position Source', self._position_source))
+        for key, value in sound_target_obj._detector_settings:
+            metadata.append(('WURB|' + key, value))
+        metadata.append(('WURB|Buffers', self._buffer_counter))
+        metadata.append(('WURB|Detections', self._detection_counter))
+        if self._detection_counter > 0:
+            metadata.append(('WURB|Peak Freq Hz', self._peak_freq_hz))
+            metadata.append(('WURB|Peak dBFS', round(self._peak_dbfs, 2)))
+            metadata.append(('WURB|Min Peak Freq Hz', self._min_freq_hz))
+            metadata.append(('WURB|Max Peak Freq Hz', self._max_freq_hz))
+        return metadata
 
     
 
@@ -581,6 +1102,8 @@ if __name__ == "__main__":
     settings.set_default_values(desc, default, dev)
     (desc, default, dev) = wurb_core.wurb_gps_reader.default_settings()
     settings.set_default_values(desc, default, dev)
+    (desc, default, dev) = wurb_core.wurb_storage.default_settings()
+    settings.set_default_values(desc, default, dev)
     #
     internal_setting_path = pathlib.Path('../wurb_settings/user_settings.txt')
     settings.load_settings(internal_setting_path)
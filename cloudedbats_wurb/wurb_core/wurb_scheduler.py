@@ -10,6 +10,10 @@ import logging
 import threading
 import wurb_core
 
+# Nights are counted from noon to noon. The scheduler is restarted at noon
+# and recordings are grouped per night, so a night isn't split at midnight.
+NIGHT_START_HOUR = 12
+
 def default_settings():
     """ Available settings for the this module.
         This info is used to define default values and to 
@@ -248,7 +252,7 @@ class WurbScheduler(object):
         # The scheduler event times needs to be recalulated 
         # when used over a long period.
         tomorrow = datetime.date.today() + datetime.timedelta(days=1)
-        tomorrow_at_noon = datetime.datetime.combine(tomorrow, datetime.time(12))
+        tomorrow_at_noon = datetime.datetime.combine(tomorrow, datetime.time(NIGHT_START_HOUR))
         
         # Start main loop. 
         while self._thread_active:
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import time
+import pathlib
+import threading
+import logging
+import pyaudio
+import wurb_core
+
+@wurb_core.singleton
+class WurbSoundCards(object):
+    """ Singleton class for access to sound cards.
+        One shared PyAudio instance is used and the table of connected
+        sound cards is cached. Added or removed sound cards are detected
+        by polling "/proc/asound/cards", which is cheap compared to a full
+        PortAudio rescan. PortAudio can only rescan when no streams are open.
+        Usage:
+            WurbSoundCards().start() # Activates hot-plug polling.
+            device_list = WurbSoundCards().get_device_list()
+            device_index = WurbSoundCards().get_device_index('Pettersson')
+            stream = WurbSoundCards().open_stream(...)
+            WurbSoundCards().close_stream(stream)
+            WurbSoundCards().stop() # Deactivates hot-plug polling.
+    """
+    def __init__(self):
+        """ Note: Singleton, parameters not allowed. """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._settings = wurb_core.WurbSettings()
+        #
+        self._lock = threading.RLock()
+        self._pyaudio = None
+        self._device_table = None # Cached list of dicts.
+        self._open_stream_counter = 0
+        self._cards_signature = None
+        self._rescan_needed = False
+        #
+        self._poll_interval_s = 2.0
+        self._active = False
+        self._poll_thread = None
+
+    def start(self):
+        """ Start polling for added or removed sound cards.
+            Settings are read here since the singleton may be
+            created before settings are loaded. """
+        poll_interval_s = self._settings.float('rec_device_poll_interval_s')
+        if poll_interval_s > 0.0:
+            self._poll_interval_s = poll_interval_s
+        # Check if already started.
+        if self._active:
+            return
+        #
+        self._cards_signature = self._read_cards_signature()
+        try:
+            self._active = True
+            self._poll_thread = threading.Thread(target = self._poll_exec, args = [])
+            self._poll_thread.start()
+        except Exception as e:
+            self._active = False
+            self._logger.error('Sound cards: Failed to start polling. ' + str(e))
+
+    def stop(self):
+        """ Stop polling. """
+        self._active = False
+
+    def get_pyaudio(self):
+        """ Returns the shared PyAudio instance. """
+        with self._lock:
+            if self._pyaudio is None:
+                self._pyaudio = pyaudio.PyAudio()
+                self._device_table = None
+            #
+            return self._pyaudio
+
+    def get_device_table(self):
+        """ Returns the cached device table. One dict for each device
+            with the keys 'index', 'name' and 'max_input_channels'. """
+        with self._lock:
+            if self._rescan_needed and (self._open_stream_counter == 0):
+                self._rescan()
+            #
+            if self._device_table is None:
+                py_audio = self.get_pyaudio()
+                device_table = []
+                device_count = py_audio.get_device_count()
+                for index in range(device_count):
+                    info_dict = py_audio.get_device_info_by_index(index)
+                    device_table.append({'index': index,
+                                         'name': info_dict['name'],
+                                         'max_input_channels': info_dict['maxInputChannels']})
+                self._device_table = device_table
+            #
+            return self._device_table
+
+    def get_device_list(self):
+        """ Names of sound cards for input. """
+        device_list = []
+        for device_dict in self.get_device_table():
+            # Sound card for input only.
+            if device_dict['max_input_channels'] != 0:
+                device_list.append(device_dict['name'])
+        #
+        return device_list
+
+    def get_device_index(self, part_of_device_name):
+        """ Lookup for device by name. """
+        for device_dict in self.get_device_table():
+            if part_of_device_name in device_dict['name']:
+                return device_dict['index']
+        #
+        return None
+
+    def open_stream(self, **kwargs):
+        """ Opens a stream on the shared PyAudio instance.
+            Same parameters as PyAudio.open(). """
+        with self._lock:
+            stream = self.get_pyaudio().open(**kwargs)
+            self._open_stream_counter += 1
+            #
+            return stream
+
+    def close_stream(self, stream):
+        """ Stops and closes a stream opened by open_stream(). """
+        with self._lock:
+            self._open_stream_counter = max(0, self._open_stream_counter - 1)
+            try:
+                stream.stop_stream()
+            finally:
+                stream.close()
+
+    def wait_for_device(self,
+                        part_of_device_name=None,
+                        device_index=None,
+                        timeout_s=60.0,
+                        is_active_function=None):
+        """ Used when a sound card was lost. Rescans until the sound card
+            is enumerated again. Lookup is done by name if available,
+            otherwise by index. Returns the new device index, or None if
+            the timeout was reached or if terminated by is_active_function. """
+        end_time = time.time() + timeout_s
+        while time.time() < end_time:
+            if is_active_function and (not is_active_function()):
+                return None
+            #
+            with self._lock:
+                self._rescan_needed = True
+                if part_of_device_name:
+                    index = self.get_device_index(part_of_device_name)
+                    if index is not None:
+                        return index
+                else:
+                    for device_dict in self.get_device_table():
+                        if (device_dict['index'] == device_index) and \
+                           (device_dict['max_input_channels'] != 0):
+                            return device_index
+            #
+            time.sleep(self._poll_interval_s)
+        #
+        return None
+
+    def _rescan(self):
+        """ PortAudio only enumerates devices when initiated. Must be
+            called with the lock acquired and no open streams. """
+        if self._pyaudio is not None:
+            try:
+                self._pyaudio.terminate()
+            except Exception as e:
+                self._logger.debug('Sound cards: PyAudio terminate failed: ' + str(e))
+        self._pyaudio = None
+        self._device_table = None
+        self._rescan_needed = False
+
+    def _read_cards_signature(self):
+        """ Content of "/proc/asound/cards". None if not available. """
+        try:
+            return pathlib.Path('/proc/asound/cards').read_text()
+        except:
+            return None
+
+    def _poll_exec(self):
+        """ Running in thread. Checks for added or removed sound cards. """
+        while self._active:
+            # Sleep, but exit earlier if externally terminated.
+            sleep_until = time.time() + self._poll_interval_s
+            while self._active and (time.time() < sleep_until):
+                time.sleep(0.5)
+            if not self._active:
+                break
+            #
+            cards_signature = self._read_cards_signature()
+            if cards_signature != self._cards_signature:
+                self._cards_signature = cards_signature
+                self._logger.info('Sound cards: Added or removed sound card detected.')
+                with self._lock:
+                    self._rescan_needed = True
+                    if self._open_stream_counter == 0:
+                        for device_name in self.get_device_list():
+                            self._logger.info('- ' + device_name)
@@ -6,7 +6,6 @@
 
 import logging
 import numpy as np
-import scipy.signal
 import wurb_core
 # # Check if librosa is available.
 # librosa_available = False
@@ -32,6 +31,7 @@ def default_settings():
         ]
     developer_settings = [
         {'key': 'sound_debug', 'value': 'N'}, 
+        {'key': 'sound_dtype', 'value': 'float32'}, # "float32" or "float64".
         {'key': 'sound_simple_filter_min_hz', 'value': '15000'}, 
 #         {'key': 'filter_max_hz', 'value': '150000'}, 
         {'key': 'sound_simple_threshold_dbfs', 'value': '-50'}, 
@@ -72,9 +72,29 @@ class SoundDetectorBase():
         #
         self._debug = self._settings.boolean('sound_debug')
         self.sampling_freq = self._settings.float('rec_sampling_freq_khz') * 1000
+        # Float precision. float32 is enough for thresholds in dBFS, and 
+        # halves the memory bandwidth.
+        if self._settings.text('sound_dtype') == 'float64':
+            self.dtype = np.float64
+        else:
+            self.dtype = np.float32
+        # Sample indexes for the active part of the last checked buffer. 
+        # End index excluded. None if silent.
+        self.find_active_span = False # True: Search for last active sample also.
+        self.active_start_index = None
+        self.active_end_index = None
+        # Strongest peak in the last checked buffer. None if not available.
+        self.peak_freq_hz = None
+        self.peak_dbfs = None
     
     def check_for_sound(self, time_and_data):
         """ Abstract. """
+    
+    def get_sound_info(self):
+        """ Summary for the last checked buffer. Used for the recordings catalog. """
+        if self.peak_freq_hz is None:
+            return None
+        return {'peak_freq_hz': self.peak_freq_hz, 'peak_dbfs': self.peak_dbfs}
         
 class SoundDetectorNone(SoundDetectorBase):
     """ Used for continous recordings, including silence. """
@@ -82,9 +102,11 @@ class SoundDetectorNone(SoundDetectorBase):
         """ """
         super(SoundDetectorNone, self).__init__()
     
-    def check_for_sound(self, _time_and_data):
+    def check_for_sound(self, time_and_data):
         """ """
         # Always true. 
+        self.active_start_index = 0
+        self.active_end_index = int(len(time_and_data[1]) / 2) # 16 bits.
         return True
     
         
@@ -102,45 +124,80 @@ class SoundDetectorSimple(SoundDetectorBase):
         # self.window_size = 2048
         # self.jump_size = 1000
 
-        # self.window_function = scipy.signal.blackmanharris(self.window_size)        
-        self.window_function = scipy.signal.hann(self.window_size)        
+        # Shared tables, same for all detector instances.
+        # self.window_function = wurb_core.dsp_cache.get_window('blackmanharris', self.window_size)        
+        self.window_function = wurb_core.dsp_cache.get_window('hann', self.window_size, 
+                                                              dtype=self.dtype)        
         # Max db value in window. dbFS = db full scale. Half spectrum used.
-        self.window_function_dbfs_max = np.sum(self.window_function) / 2 
-        self.freq_bins_hz = np.arange((self.window_size / 2) + 1) / (self.window_size / self.sampling_freq)
+        self.window_function_dbfs_max = self.dtype(
+                    wurb_core.dsp_cache.get_dbfs_max('hann', self.window_size))
+        self.freq_bins_hz = wurb_core.dsp_cache.get_freq_bins_hz(self.window_size, self.sampling_freq)
+        self._low_freq_bins = self.freq_bins_hz < self.filter_min_hz
+        # Reused for each frame.
+        self._frame_buffer = np.empty(self.window_size, dtype=self.dtype)
     
     def check_for_sound(self, time_and_data):
-        """ This is the old algorithm used during 2017. """
+        """ This is the old algorithm used during 2017. 
+            Frames are checked from the start of the buffer until sound is found. 
+            If find_active_span is set, frames are also checked backwards from 
+            the end to find the last active sample. """
         _rec_time, raw_data = time_and_data
         #
-        data_int16 = np.fromstring(raw_data, dtype=np.int16) # To ndarray.
-        # self._work_buffer = np.concatenate([self._work_buffer, data_int16])
-        self._work_buffer = data_int16
+        data_int16 = np.frombuffer(raw_data, dtype=np.int16) # To ndarray.
+        self.active_start_index = None
+        self.active_end_index = None
+        self.peak_freq_hz = None
+        self.peak_dbfs = None
+        frame_starts = range(0, len(data_int16) - self.window_size + 1, self.jump_size)
+        #
+        for frame_start in frame_starts:
+            if self._check_frame(data_int16, frame_start):
+                self.active_start_index = frame_start
+                self.active_end_index = frame_start + self.window_size
+                break
         #
-        while len(self._work_buffer) >= self.window_size:
-            # Get frame of window size.
-            data_frame = self._work_buffer[:self.window_size] # Copy frame.
-            self._work_buffer = self._work_buffer[self.jump_size:] # Cut the first jumped size.            
-            # Transform to intervall -1 to 1 and apply window function.
-            signal = data_frame / 32768.0 * self.window_function
-            # From time domain to frequeny domain.
-            spectrum = np.fft.rfft(signal)
-            # High pass filter. Unit Hz. Cut below 15 kHz.
-            spectrum[ self.freq_bins_hz < self.filter_min_hz ] = 0.000000001 # log10 does not like zero.
-            # Convert spectrum to dBFS (bin values related to maximal possible value).
-            dbfs_spectrum = 20 * np.log10(np.abs(spectrum) / self.window_function_dbfs_max)
-            # Find peak and dBFS value for the peak.
-            bin_peak_index = dbfs_spectrum.argmax()
-            peak_db = dbfs_spectrum[bin_peak_index]
-            # Treshold.
-            if peak_db > self.threshold_dbfs:
-                if self._debug:
-                    peak_frequency_hz = bin_peak_index * self.sampling_freq / self.window_size
-                    print('DEBUG: Peak freq hz: '+ str(peak_frequency_hz) + '   dBFS: ' + str(peak_db))
-                #
-                return True
+        if self.active_start_index is None:
+            if self._debug:
+                print('DEBUG: Silent.')
+            #
+            return False
         #
-        if self._debug:
-            print('DEBUG: Silent.')
+        if self.find_active_span:
+            for frame_start in reversed(frame_starts):
+                if frame_start <= self.active_start_index:
+                    break
+                if self._check_frame(data_int16, frame_start):
+                    self.active_end_index = frame_start + self.window_size
+                    break
+        #
+        return True
+    
+    def _check_frame(self, data_int16, frame_start):
+        """ True if the frame contains sound above threshold. """
+        # Get frame of window size.
+        data_frame = data_int16[frame_start:frame_start + self.window_size]
+        # Transform to intervall -1 to 1 and apply window function. In place.
+        signal = wurb_core.int16_to_float(data_frame, out=self._frame_buffer)
+        np.multiply(signal, self.window_function, out=signal)
+        # From time domain to frequeny domain. Complex64 for float32.
+        spectrum = wurb_core.dsp_cache.rfft(signal, overwrite_x=True)
+        # High pass filter. Unit Hz. Cut below 15 kHz.
+        spectrum[self._low_freq_bins] = 0.000000001 # log10 does not like zero.
+        # Convert spectrum to dBFS (bin values related to maximal possible value).
+        dbfs_spectrum = 20 * np.log10(np.abs(spectrum) / self.window_function_dbfs_max)
+        # Find peak and dBFS value for the peak.
+        bin_peak_index = dbfs_spectrum.argmax()
+        peak_db = dbfs_spectrum[bin_peak_index]
+        # Treshold.
+        if peak_db > self.threshold_dbfs:
+            peak_frequency_hz = bin_peak_index * self.sampling_freq / self.window_size
+            if (self.peak_dbfs is None) or (self.peak_dbfs < peak_db):
+                self.peak_freq_hz = peak_frequency_hz
+                self.peak_dbfs = peak_db
+            if self._debug:
+                print('DEBUG: Peak freq hz: '+ str(peak_frequency_hz) + '   dBFS: ' + str(peak_db))
+            #
+            return True
         #
         return False
         
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import time
+import queue
+import threading
+import logging
+import wurb_core
+
+def get_available_ram_bytes():
+    """ "MemAvailable" from "/proc/meminfo". None if not available. """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except:
+        pass
+    return None
+
+
+class WurbStagingMover(object):
+    """ RAM staging for sound files. Files are recorded to a tmpfs directory,
+        for example "/dev/shm", and moved to the USB memory by a background
+        thread when closed. Moves are done in large sequential copies, which
+        is the fastest way to write to USB memories.
+        The RAM used is limited. Files are written directly to the USB memory
+        when the staging area is full, or when available RAM is low.
+        Note: Staged files are lost on power failure.
+        Usage:
+            mover = WurbStagingMover('/dev/shm/wurb_staging')
+            mover.start()
+            staged_path = mover.reserve('file.wav.part', max_file_bytes)
+            if staged_path:
+                ... write and close the file ...
+                mover.move_file(staged_path, '/media/usb0/wurb1_rec/file.wav',
+                                done_function=None)
+            mover.stop() # Waits until all files are moved.
+    """
+    def __init__(self, staging_dir_path,
+                 max_bytes=128*1024*1024, # Staged files, reserved size.
+                 min_free_ram_bytes=64*1024*1024, # Direct write below this.
+                 copy_chunk_size=4*1024*1024):
+        """ """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._staging_dir_path = str(staging_dir_path)
+        self._max_bytes = max_bytes
+        self._min_free_ram_bytes = min_free_ram_bytes
+        self._copy_chunk_size = copy_chunk_size
+        #
+        self._lock = threading.Lock()
+        self._reserved_dict = {} # Key: staged path, value: reserved bytes.
+        self._reserved_bytes = 0
+        self._move_queue = queue.Queue()
+        self._mover_thread = None
+        self._created_dirs = set()
+        # Statistics.
+        self._moved_counter = 0
+        self._moved_bytes = 0
+        self._move_time_s = 0.0
+        self._direct_counter = 0
+        self._max_backlog_counter = 0
+        self._max_backlog_bytes = 0
+
+    def start(self):
+        """ """
+        if self._mover_thread and self._mover_thread.is_alive():
+            return
+        os.makedirs(self._staging_dir_path, exist_ok=True)
+        self._moved_counter = 0
+        self._moved_bytes = 0
+        self._move_time_s = 0.0
+        self._direct_counter = 0
+        self._max_backlog_counter = 0
+        self._max_backlog_bytes = 0
+        #
+        self._mover_thread = threading.Thread(target=self._mover_exec, args=[])
+        self._mover_thread.start()
+
+    def stop(self):
+        """ Terminates the mover when all queued files are moved. """
+        if self._mover_thread:
+            self._move_queue.put(None)
+            self._mover_thread.join()
+            self._mover_thread = None
+        self._log_stats()
+
+    def move_leftover_files(self, target_dir_path, dir_sharding='None'):
+        """ Moves files left in the staging directory, for example if the
+            application was terminated while recording. Files are moved to 
+            the same subdirectory as when recorded, calculated from the time 
+            in the file name. Partial files keep the temporary name and are 
+            recovered from the target directory. Files that failed to move
+            are kept and moved at next start. Returns a list with the new paths. """
+        target_paths = []
+        try:
+            with os.scandir(self._staging_dir_path) as dir_entries:
+                leftover_paths = [dir_entry.path for dir_entry in dir_entries if dir_entry.is_file()]
+        except Exception as e:
+            self._logger.error('Recorder: Failed to scan staged files: ' + str(e))
+            return target_paths
+        #
+        for staged_path in leftover_paths:
+            file_name = os.path.basename(staged_path)
+            target_path = os.path.join(target_dir_path, 
+                                       self._get_shard_dir_name(file_name, dir_sharding), 
+                                       file_name)
+            try:
+                self._move(staged_path, target_path)
+                target_paths.append(target_path)
+            except Exception as e:
+                self._logger.warning('Recorder: Failed to move staged file: ' + 
+                                     staged_path + ' ' + str(e))
+        if leftover_paths:
+            self._logger.warning('Recorder: Staged files from earlier session moved: ' +
+                                 str(len(target_paths)) + ' of ' + str(len(leftover_paths)))
+        #
+        return target_paths
+
+    def _get_shard_dir_name(self, file_name, dir_sharding):
+        """ Subdirectory used when the file was recorded. Empty string if 
+            the name does not contain the time. """
+        if file_name.endswith(wurb_core.PARTIAL_FILE_SUFFIX):
+            file_name = file_name[:-len(wurb_core.PARTIAL_FILE_SUFFIX)]
+        name_dict = wurb_core.wurb_catalog.parse_file_name(file_name)
+        if name_dict is None:
+            return ''
+        return wurb_core.wurb_recorder.get_shard_dir_name(name_dict['local_time_s'], dir_sharding)
+
+    def reserve(self, file_name, max_file_bytes):
+        """ Returns a path in the staging directory, or None if the file
+            should be written directly to the USB memory. """
+        with self._lock:
+            if self._reserved_bytes + max_file_bytes > self._max_bytes:
+                self._direct_counter += 1
+                self._logger.debug('Recorder: Staging area full. Direct write.')
+                return None
+            available_ram_bytes = get_available_ram_bytes()
+            if (available_ram_bytes is not None) and \
+               (available_ram_bytes - max_file_bytes < self._min_free_ram_bytes):
+                self._direct_counter += 1
+                self._logger.debug('Recorder: Low on RAM. Direct write.')
+                return None
+            #
+            staged_path = os.path.join(self._staging_dir_path, file_name)
+            if staged_path in self._reserved_dict:
+                return None # Same name, not moved yet.
+            self._reserved_dict[staged_path] = max_file_bytes
+            self._reserved_bytes += max_file_bytes
+            return staged_path
+
+    def move_file(self, staged_path, target_path, done_function=None):
+        """ Queues a closed file for moving. done_function is called from the
+            mover thread when the file is in place. """
+        self._move_queue.put((staged_path, target_path, done_function))
+        # Statistics.
+        backlog_counter = self._move_queue.qsize()
+        with self._lock:
+            backlog_bytes = self._reserved_bytes
+        self._max_backlog_counter = max(self._max_backlog_counter, backlog_counter)
+        self._max_backlog_bytes = max(self._max_backlog_bytes, backlog_bytes)
+
+    def release(self, staged_path):
+        """ Removes a staged file without moving it, for example if it
+            failed to open. """
+        try:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        finally:
+            self._release_reservation(staged_path)
+
+    def _release_reservation(self, staged_path):
+        """ """
+        with self._lock:
+            self._reserved_bytes -= self._reserved_dict.pop(staged_path, 0)
+
+    def _move(self, staged_path, target_path):
+        """ Copies in large chunks under a temporary name and renames when
+            the data is on disk. Returns the number of bytes moved. """
+        target_dir_path = os.path.dirname(target_path)
+        if target_dir_path not in self._created_dirs:
+            os.makedirs(target_dir_path, exist_ok=True)
+            self._created_dirs.add(target_dir_path)
+        if target_path.endswith(wurb_core.PARTIAL_FILE_SUFFIX):
+            partial_target_path = target_path
+        else:
+            partial_target_path = target_path + wurb_core.PARTIAL_FILE_SUFFIX
+        #
+        moved_bytes = 0
+        buffer = bytearray(self._copy_chunk_size)
+        with open(staged_path, 'rb', buffering=0) as source_file:
+            with open(partial_target_path, 'wb', buffering=0) as target_file:
+                while True:
+                    size = source_file.readinto(buffer)
+                    if not size:
+                        break
+                    with memoryview(buffer) as buffer_view:
+                        written = 0
+                        while written < size:
+                            written += target_file.write(buffer_view[written:size])
+                    moved_bytes += size
+                os.fsync(target_file.fileno())
+        if partial_target_path != target_path:
+            os.rename(partial_target_path, target_path)
+        os.remove(staged_path)
+        #
+        return moved_bytes
+
+    def _mover_exec(self):
+        """ Running in thread. """
+        while True:
+            item = self._move_queue.get()
+            if item is None:
+                break # Terminated.
+            #
+            staged_path, target_path, done_function = item
+            start_time = time.time()
+            try:
+                moved_bytes = self._move(staged_path, target_path)
+                # Statistics.
+                move_time_s = time.time() - start_time
+                self._moved_counter += 1
+                self._moved_bytes += moved_bytes
+                self._move_time_s += move_time_s
+                if move_time_s > 0.0:
+                    self._logger.debug('Recorder: Staged file moved. Speed (MB/s): ' +
+                                       str(round(moved_bytes / move_time_s / 1000000, 2)) +
+                                       '  Backlog (files): ' + str(self._move_queue.qsize()))
+                if done_function:
+                    done_function()
+            except Exception as e:
+                self._logger.error('Recorder: Failed to move staged file: ' + staged_path + ' ' + str(e))
+            finally:
+                self._release_reservation(staged_path)
+
+    def _log_stats(self):
+        """ """
+        mb_per_s = 0.0
+        if self._move_time_s > 0.0:
+            mb_per_s = self._moved_bytes / self._move_time_s / 1000000
+        self._logger.info('Recorder: Staging stats. Moved files: ' + str(self._moved_counter) +
+                          '  Speed (MB/s): ' + str(round(mb_per_s, 2)) +
+                          '  Direct writes: ' + str(self._direct_counter) +
+                          '  Max backlog (files): ' + str(self._max_backlog_counter) +
+                          '  Max backlog (MB): ' + str(round(self._max_backlog_bytes / 1000000, 1)))
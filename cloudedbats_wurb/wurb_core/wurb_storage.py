@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import time
+import pathlib
+import threading
+import logging
+import wurb_core
+
+def default_settings():
+    """ Available settings for the this module.
+        This info is used to define default values and to
+        generate the wurb_settings_DEFAULT.txt file."""
+
+    description = [
+        '# Settings for the storage manager.',
+        '# Retention policies: None, Oldest, Lowest_peak.',
+        ]
+    default_settings = [
+        {'key': 'storage_reserve_mb', 'value': '500'},
+        {'key': 'storage_retention', 'value': 'None'}, # None, Oldest, Lowest_peak.
+        ]
+    developer_settings = [
+        {'key': 'storage_check_interval_s', 'value': '10'}, # Max age for cached free space.
+        {'key': 'storage_retention_margin_mb', 'value': '200'}, # Freed above the reserve.
+        {'key': 'storage_log_interval_min', 'value': '30'}, # Remaining capacity logged.
+        ]
+    #
+    return description, default_settings, developer_settings
+
+def get_sidecar_paths(file_path):
+    """ Files created from a recording, deleted together with it. Preview
+        image and sound, spectrogram tiles and chirp metrics. """
+    dir_path, file_name = os.path.split(file_path)
+    base_name = os.path.splitext(file_name)[0]
+    preview_dir_path = os.path.join(dir_path, wurb_core.wurb_preview.PREVIEW_DIR_NAME)
+    return [os.path.join(preview_dir_path, base_name + '.png'),
+            os.path.join(preview_dir_path, base_name + '_preview.wav'),
+            wurb_core.wurb_preview.tile_file_path(file_path),
+            wurb_core.wurb_chirp_metrics.metrics_file_path(file_path)]
+
+@wurb_core.singleton
+class WurbStorageManager(object):
+    """ Singleton class for free space on the USB memory.
+        Free space is read with statvfs and cached. Bytes queued for writing
+        since the last check are subtracted, so the estimate is on the safe
+        side. No new files are opened when the free space is below the
+        reserve. Recording continues when space is available again.
+        A retention policy, running in a separate thread, can delete the
+        oldest recordings or the recordings with the lowest peak level.
+        The catalog is used to find them.
+        Usage:
+            WurbStorageManager().start() # Activates retention and logging.
+            if WurbStorageManager().is_space_available(file_bytes):
+                ...
+                WurbStorageManager().add_written_bytes(len(data))
+            WurbStorageManager().stop()
+    """
+    def __init__(self):
+        """ Note: Singleton, parameters not allowed. """
+        self._logger = logging.getLogger('CloudedBatsWURB')
+        self._settings = wurb_core.WurbSettings()
+        #
+        self._lock = threading.Lock()
+        self._dir_path = None
+        self._reserve_bytes = 500 * 1000000
+        self._retention_margin_bytes = 200 * 1000000
+        self._retention = 'None'
+        self._check_interval_s = 10.0
+        self._log_interval_s = 30 * 60.0
+        self._max_bytes_per_s = 384000 * 2
+        # Cached free space.
+        self._free_bytes = None
+        self._check_time = 0.0
+        self._queued_bytes = 0 # Since last check.
+        self._space_low = False
+        # Recorded data rate.
+        self._rec_bytes = 0
+        self._rec_start_time = None
+        #
+        self._catalog = None
+        self._active = False
+        self._wake_event = threading.Event()
+        self._check_thread = None
+
+    def start(self):
+        """ Settings are read here since the singleton may be
+            created before settings are loaded. """
+        self._read_settings()
+        # Check if already started.
+        if self._active:
+            return
+        #
+        if self._settings.boolean('rec_catalog'):
+            self._catalog = wurb_core.WurbCatalog(os.path.join(self._dir_path, 'wurb_catalog.db'))
+        try:
+            self._active = True
+            self._wake_event.clear()
+            self._check_thread = threading.Thread(target = self._check_exec, args = [])
+            self._check_thread.start()
+        except Exception as e:
+            self._active = False
+            self._logger.error('Storage: Failed to start storage manager. ' + str(e))
+
+    def stop(self):
+        """ """
+        self._active = False
+        self._wake_event.set()
+
+    def is_space_available(self, file_bytes):
+        """ Called before a new file is opened. Cached, statvfs is only
+            called when the cached value is too old. """
+        with self._lock:
+            if self._dir_path is None:
+                self._read_settings()
+            if time.time() > (self._check_time + self._check_interval_s):
+                self._update_free_bytes()
+            if self._free_bytes is None:
+                return True # Unknown, let the writer fail.
+            #
+            space_available = (self._free_bytes - self._queued_bytes - file_bytes) >= self._reserve_bytes
+            if not space_available:
+                if not self._space_low:
+                    self._space_low = True
+                    self._logger.warning('Storage: Free space below reserve. No new files. Free (MB): ' +
+                                         str(int((self._free_bytes - self._queued_bytes) / 1000000)))
+                self._wake_event.set() # Apply retention now.
+            elif self._space_low:
+                self._space_low = False
+                self._logger.info('Storage: Free space available again.')
+            #
+            return space_available
+
+    def add_written_bytes(self, data_bytes):
+        """ Called for each buffer queued for writing. """
+        with self._lock:
+            self._queued_bytes += data_bytes
+            self._rec_bytes += data_bytes
+            if self._rec_start_time is None:
+                self._rec_start_time = time.time()
+
+    def get_free_bytes(self):
+        """ Estimated free space. Not cached. """
+        with self._lock:
+            self._update_free_bytes()
+            return self._free_bytes
+
+    def get_remaining_hours(self):
+        """ Projected recording time until the reserve is reached. Returns
+            hours at continuous recording, and hours at the rate measured
+            since recording started (None if not available). """
+        with self._lock:
+            if self._free_bytes is None:
+                return None, None
+            usable_bytes = max(0, self._free_bytes - self._queued_bytes - self._reserve_bytes)
+            hours_continuous = usable_bytes / self._max_bytes_per_s / 3600.0
+            hours_current_rate = None
+            if self._rec_start_time is not None:
+                rec_time_s = time.time() - self._rec_start_time
+                if (rec_time_s > 60.0) and (self._rec_bytes > 0):
+                    hours_current_rate = usable_bytes / (self._rec_bytes / rec_time_s) / 3600.0
+            #
+            return hours_continuous, hours_current_rate
+
+    def _read_settings(self):
+        """ """
+        self._dir_path = self._settings.text('rec_directory_path')
+        self._reserve_bytes = self._settings.integer('storage_reserve_mb') * 1000000
+        self._retention_margin_bytes = self._settings.integer('storage_retention_margin_mb') * 1000000
+        self._retention = self._settings.text('storage_retention')
+        self._check_interval_s = self._settings.float('storage_check_interval_s')
+        self._log_interval_s = self._settings.float('storage_log_interval_min') * 60.0
+        if self._settings.text('rec_microphone_type') == 'M500':
+            self._max_bytes_per_s = 500000 * 2
+        else:
+            self._max_bytes_per_s = self._settings.integer('rec_sampling_freq_khz') * 1000 * 2
+
+    def _update_free_bytes(self):
+        """ Must be called with the lock acquired. """
+        try:
+            # Use first existing part of the path. Directories are created later.
+            path = pathlib.Path(self._dir_path)
+            while not path.exists():
+                path = path.parent
+            statvfs = os.statvfs(str(path))
+            self._free_bytes = statvfs.f_bavail * statvfs.f_frsize
+            self._queued_bytes = 0
+        except Exception as e:
+            self._free_bytes = None
+            self._logger.debug('Storage: Failed to check free space: ' + str(e))
+        self._check_time = time.time()
+
+    def _apply_retention(self):
+        """ Deletes recordings until the free space is above the reserve
+            plus a margin. Oldest or lowest peak level first. """
+        if self._retention == 'Lowest_peak' and self._catalog:
+            order_by = 'peak_dbfs' # Files without detections first.
+        else:
+            order_by = 'start_time_s'
+        #
+        target_bytes = self._reserve_bytes + self._retention_margin_bytes
+        deleted_counter = 0
+        deleted_bytes = 0
+        failed_paths = set() # Not returned again, the loop must not spin.
+        while self._active:
+            with self._lock:
+                self._update_free_bytes()
+                free_bytes = self._free_bytes or 0
+            if free_bytes >= target_bytes:
+                break
+            file_list = [(file_path, file_name) for file_path, file_name in 
+                         self._get_retention_candidates(order_by, max_files=20 + len(failed_paths))
+                         if file_path not in failed_paths]
+            if not file_list:
+                self._logger.warning('Storage: No more recordings to delete.')
+                break
+            pass_removed_counter = 0 # Deleted, or already deleted.
+            for file_path, file_name in file_list:
+                try:
+                    file_size = os.path.getsize(file_path)
+                    os.remove(file_path)
+                    deleted_counter += 1
+                    deleted_bytes += file_size
+                    free_bytes += file_size
+                except FileNotFoundError:
+                    pass # Already deleted. Removed from the catalog below.
+                except Exception as e:
+                    self._logger.warning('Storage: Failed to delete: ' + file_path + ' ' + str(e))
+                    failed_paths.add(file_path)
+                    continue
+                pass_removed_counter += 1
+                freed_bytes = self._delete_sidecar_files(file_path)
+                self._add_manifest_deletion(file_path)
+                deleted_bytes += freed_bytes
+                free_bytes += freed_bytes
+                if self._catalog:
+                    self._catalog.remove_file(file_name)
+                if free_bytes >= target_bytes:
+                    break
+            if pass_removed_counter == 0:
+                # For example a read-only file system. Checked again later.
+                self._logger.warning('Storage: No recordings could be deleted.')
+                break
+        #
+        if deleted_counter > 0:
+            self._logger.info('Storage: Retention policy "' + self._retention +
+                              '". Deleted files: ' + str(deleted_counter) +
+                              '  Freed (MB): ' + str(round(deleted_bytes / 1000000, 1)))
+
+    def _get_retention_candidates(self, order_by, max_files=20):
+        """ Returns a list of (file_path, file_name). """
+        if self._catalog:
+            return [(os.path.join(row['dir_path'], row['file_name']), row['file_name'])
+                    for row in self._catalog.find_files(order_by=order_by, limit=max_files)]
+        # Without catalog. Oldest by modification time. Only recordings, the
+        # preview and metrics subdirectories contain files created from them.
+        skip_dir_names = [wurb_core.wurb_preview.PREVIEW_DIR_NAME, 
+                          wurb_core.wurb_chirp_metrics.METRICS_DIR_NAME]
+        file_list = []
+        for root, dirs, files in os.walk(self._dir_path):
+            dirs[:] = [d for d in dirs if d not in skip_dir_names]
+            for file_name in files:
+                if wurb_core.wurb_catalog.parse_file_name(file_name):
+                    file_path = os.path.join(root, file_name)
+                    file_list.append((os.path.getmtime(file_path), file_path, file_name))
+        file_list.sort()
+        return [(file_path, file_name) for _mtime, file_path, file_name in file_list[:max_files]]
+
+    def _delete_sidecar_files(self, file_path):
+        """ Returns the number of bytes freed. """
+        freed_bytes = 0
+        for sidecar_path in get_sidecar_paths(file_path):
+            try:
+                file_size = os.path.getsize(sidecar_path)
+                os.remove(sidecar_path)
+                freed_bytes += file_size
+            except FileNotFoundError:
+                pass # Not created for all recordings.
+            except Exception as e:
+                self._logger.warning('Storage: Failed to delete: ' + sidecar_path + ' ' + str(e))
+        return freed_bytes
+
+    def _add_manifest_deletion(self, file_path):
+        """ Deleted files are marked in the night manifest, if used. The
+            verification then only reports files lost by other reasons. """
+        dir_path, file_name = os.path.split(file_path)
+        name_dict = wurb_core.wurb_catalog.parse_file_name(file_name)
+        if name_dict is None:
+            return
+        night_name = wurb_core.wurb_recorder.get_shard_dir_name(name_dict['local_time_s'], 'Night')
+        manifest_path = os.path.join(dir_path, wurb_core.wurb_manifest.manifest_file_name(night_name))
+        if not os.path.exists(manifest_path):
+            return
+        try:
+            # One short row in append mode. Rows from the recorder are not mixed.
+            wurb_core.wurb_manifest.append_manifest_deletion(manifest_path, file_name)
+        except Exception as e:
+            self._logger.warning('Storage: Failed to update manifest: ' + manifest_path + ' ' + str(e))
+
+    def _log_remaining_capacity(self):
+        """ """
+        hours_continuous, hours_current_rate = self.get_remaining_hours()
+        if hours_continuous is None:
+            return
+        message = 'Storage: Free (MB): ' + str(int(self._free_bytes / 1000000)) + \
+                  '  Remaining (h) continuous recording: ' + str(round(hours_continuous, 1))
+        if hours_current_rate is not None:
+            message += '  at current rate: ' + str(round(hours_current_rate, 1))
+        self._logger.info(message)
+
+    def _check_exec(self):
+        """ Running in thread. Retention and logging. """
+        last_log_time = 0.0
+        while self._active:
+            with self._lock:
+                self._update_free_bytes()
+                space_low = (self._free_bytes is not None) and \
+                            (self._free_bytes < self._reserve_bytes + self._max_bytes_per_s * 60)
+            if space_low and (self._retention in ['Oldest', 'Lowest_peak']):
+                try:
+                    self._apply_retention()
+                except Exception as e:
+                    self._logger.error('Storage: Retention failed: ' + str(e))
+            #
+            if time.time() > (last_log_time + self._log_interval_s):
+                last_log_time = time.time()
+                self._log_remaining_capacity()
+            # Sleep, but wake up if space is needed or terminated.
+            self._wake_event.wait(timeout=self._check_interval_s)
+            self._wake_event.clear()
+        #
+        if self._catalog:
+            self._catalog.close()
+            self._catalog = None
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# Project: http://cloudedbats.org
+# Copyright (c) 2016-2018 Arnold Andreasson 
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import time
+import struct
+import pathlib
+import ctypes
+import ctypes.util
+
+# Used when the erase block size can't be read from the system.
+DEFAULT_ERASE_BLOCK_SIZE = 4 * 1024 * 1024 # 4 MB.
+WAVE_HEADER_SIZE = 44
+# Files are written under a temporary name and renamed when closed.
+PARTIAL_FILE_SUFFIX = '.part'
+
+def get_erase_block_size(dir_path, default_size=DEFAULT_ERASE_BLOCK_SIZE):
+    """ Erase block size for the memory card or USB memory where dir_path
+        is located. Read from "/sys/dev/block/<major>:<minor>". Only SD cards
+        report this. Default size is returned for unknown devices. """
+    try:
+        # Use first existing part of the path. Directories are created later.
+        path = pathlib.Path(dir_path)
+        while not path.exists():
+            path = path.parent
+        st_dev = os.stat(str(path)).st_dev
+        sys_path = pathlib.Path('/sys/dev/block',
+                                str(os.major(st_dev)) + ':' + str(os.minor(st_dev))).resolve()
+        # Partitions are subdirectories to the disk.
+        for device_path in [sys_path, sys_path.parent]:
+            erase_size_path = pathlib.Path(device_path, 'device', 'preferred_erase_size')
+            if erase_size_path.exists():
+                erase_size = int(erase_size_path.read_text().strip())
+                if erase_size > 0:
+                    return erase_size
+    except:
+        pass
+    #
+    return default_size
+
+def wave_header(sampling_freq_hz, data_size, n_channels=1, sample_width=2):
+    """ Canonical 44 bytes header for PCM wave files. """
+    byte_rate = sampling_freq_hz * n_channels * sample_width
+    block_align = n_channels * sample_width
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, 1, n_channels, sampling_freq_hz,
+                       byte_rate, block_align, sample_width * 8,
+                       b'data', data_size)
+
+def guano_chunk(metadata_list):
+    """ GUANO metadata chunk, see "https://guano-md.org". The list contains
+        (key, value) tuples. Namespaced keys are written as "namespace|key". """
+    lines = ['GUANO|Version: 1.0']
+    for key, value in metadata_list:
+        lines.append(str(key) + ': ' + str(value).replace('\n', '\\n'))
+    text = '\n'.join(lines).encode('utf-8')
+    chunk = struct.pack('<4sI', b'guan', len(text)) + text
+    if len(text) % 2:
+        chunk += b'\x00' # Chunks are word aligned. Not included in size.
+    return chunk
+
+def repair_wave_file(file_path, n_channels=1, sample_width=2):
+    """ Patches the RIFF and data sizes in a canonical wave header from the
+        actual file size. Used for files not closed, for example after a power
+        failure. Incomplete frames at the end are removed. Files already
+        closed, but not renamed, have a valid data size and are not changed.
+        Metadata chunks after the audio data are then kept. Returns the data
+        size, or None if the file is too short or not a wave file. """
+    file_size = os.path.getsize(file_path)
+    if file_size < WAVE_HEADER_SIZE:
+        return None
+    frame_size = n_channels * sample_width
+    with open(file_path, 'r+b') as wave_file:
+        header = wave_file.read(WAVE_HEADER_SIZE)
+        if header[0:4] != b'RIFF':
+            return None
+        # Size written at close. Zero in the placeholder header.
+        if header[36:40] == b'data':
+            header_data_size = struct.unpack('<I', header[40:44])[0]
+            if (header_data_size > 0) and \
+               (WAVE_HEADER_SIZE + header_data_size <= file_size):
+                return header_data_size
+        #
+        data_size = ((file_size - WAVE_HEADER_SIZE) // frame_size) * frame_size
+        wave_file.truncate(WAVE_HEADER_SIZE + data_size)
+        wave_file.seek(4)
+        wave_file.write(struct.pack('<I', 36 + data_size))
+        wave_file.seek(40)
+        wave_file.write(struct.pack('<I', data_size))
+    #
+    return data_size
+
+_libc = None
+def _fallocate_keep_size(fd, size):
+    """ Allocates file space without changing the file size. The linux
+        fallocate() call is used since os.posix_fallocate() falls back
+        to writing zeros on file systems without support. """
+    global _libc
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                        ctypes.c_longlong, ctypes.c_longlong]
+        FALLOC_FL_KEEP_SIZE = 1
+        return _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) == 0
+    except:
+        return False
+
+
+class WurbWaveWriter(object):
+    """ Wave file writer for USB memories and SD cards.
+        Small and unaligned writes are slow and wear the flash memory.
+        Data is collected in RAM and written in chunks of equal size,
+        aligned to the chunk size from the start of the file. The header
+        is written as a placeholder in the first chunk and the RIFF and
+        data sizes are patched in place at close. Metadata chunks added with
+        add_chunk() are appended after the audio data in the last write.
+        Usage:
+            writer = WurbWaveWriter('test.wav', 384000, chunk_size=4*1024*1024)
+            writer.write(data_bytes)
+            writer.close()
+            stats_dict = writer.get_stats()
+    """
+    def __init__(self, file_path, sampling_freq_hz,
+                 chunk_size=DEFAULT_ERASE_BLOCK_SIZE,
+                 preallocate_size=0, # Expected file size in bytes. 0=no preallocation.
+                 n_channels=1, # 1=Mono.
+                 sample_width=2): # 2=16 bits.
+        """ """
+        self._file_path = str(file_path)
+        self._sampling_freq_hz = int(sampling_freq_hz)
+        self._chunk_size = max(512, int(chunk_size))
+        self._n_channels = n_channels
+        self._sample_width = sample_width
+        #
+        self._data_size = 0
+        self._file_size = 0
+        self._trailing_chunks = bytearray()
+        # Statistics.
+        self._write_counter = 0
+        self._write_time_s = 0.0
+        self._max_latency_s = 0.0
+        # Raw file without Python buffering. Header placeholder first in buffer.
+        self._file = open(self._file_path, 'wb', buffering=0)
+        self._buffer = bytearray(wave_header(self._sampling_freq_hz, 0,
+                                             self._n_channels, self._sample_width))
+        if preallocate_size > 0:
+            _fallocate_keep_size(self._file.fileno(), preallocate_size)
+
+    def get_file_path(self):
+        """ """
+        return self._file_path
+
+    def get_data_size(self):
+        """ Number of audio bytes written, buffered data included. """
+        return self._data_size
+
+    def add_chunk(self, chunk):
+        """ Complete RIFF chunk, id and size included. Written after the
+            audio data when the file is closed. """
+        self._trailing_chunks += chunk
+
+    def write(self, buffer):
+        """ Adds data to the RAM buffer. Full chunks are written to file. """
+        self._buffer += buffer
+        self._data_size += len(buffer)
+        if len(self._buffer) >= self._chunk_size:
+            aligned_size = (len(self._buffer) // self._chunk_size) * self._chunk_size
+            self._write_to_file(aligned_size)
+
+    def close(self):
+        """ Writes remaining data and metadata chunks, and patches the
+            header sizes. """
+        if self._file is None:
+            return
+        try:
+            if len(self._trailing_chunks) > 0:
+                if self._data_size % 2:
+                    self._buffer += b'\x00' # Pad byte after odd sized data chunk.
+                self._buffer += self._trailing_chunks
+            if len(self._buffer) > 0:
+                self._write_to_file(len(self._buffer))
+            # Release preallocated space not used.
+            os.ftruncate(self._file.fileno(), self._file_size)
+            # Patch RIFF and data sizes in place.
+            header = wave_header(self._sampling_freq_hz, self._data_size,
+                                 self._n_channels, self._sample_width)
+            self._file.seek(4)
+            self._file.write(struct.pack('<I', self._file_size - 8))
+            self._file.seek(40)
+            self._file.write(header[40:44])
+            # On disk before the file is renamed by the caller.
+            os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            self._file = None
+
+    def get_stats(self):
+        """ Write statistics as a dict. Speed in MB/s, latency in ms. """
+        stats_dict = {}
+        stats_dict['bytes_written'] = self._file_size
+        stats_dict['write_counter'] = self._write_counter
+        stats_dict['write_time_s'] = self._write_time_s
+        stats_dict['mb_per_s'] = 0.0
+        stats_dict['mean_latency_ms'] = 0.0
+        stats_dict['max_latency_ms'] = self._max_latency_s * 1000.0
+        if self._write_time_s > 0.0:
+            stats_dict['mb_per_s'] = self._file_size / self._write_time_s / 1000000.0
+        if self._write_counter > 0:
+            stats_dict['mean_latency_ms'] = self._write_time_s / self._write_counter * 1000.0
+        #
+        return stats_dict
+
+    def _write_to_file(self, size):
+        """ Writes the first part of the buffer in one call. """
+        start_time = time.time()
+        with memoryview(self._buffer) as buffer_view:
+            written = 0
+            while written < size:
+                written += self._file.write(buffer_view[written:size])
+        del self._buffer[:size]
+        self._file_size += size
+        # Statistics.
+        latency_s = time.time() - start_time
+        self._write_counter += 1
+        self._write_time_s += latency_s
+        if self._max_latency_s < latency_s:
+            self._max_latency_s = latency_s
+
+
+# === TEST ===
+if __name__ == "__main__":
+    """ """
+    import wave
+    print('Test started.')
+    writer = WurbWaveWriter('test.wav', 384000, chunk_size=65536, preallocate_size=1000000)
+    for _index in range(10):
+        writer.write(bytes(384000)) # 0.5 sec.
+    writer.add_chunk(guano_chunk([('Samplerate', 384000), ('WURB|Detections', 3)]))
+    writer.close()
+    print('Stats: ', writer.get_stats())
+    wave_file = wave.open('test.wav', 'rb')
+    print('Frames: ', wave_file.getnframes(), '  Rate: ', wave_file.getframerate())
+    wave_file.close()
+    # Closed file, not renamed. Header and GUANO chunk are kept.
+    with open('test.wav', 'rb') as test_file:
+        closed_content = test_file.read()
+    print('Repair, closed file. Data size: ', repair_wave_file('test.wav'))
+    with open('test.wav', 'rb') as test_file:
+        print('Unchanged: ', test_file.read() == closed_content)
+    # Not closed. Sizes from the file length, incomplete frame removed.
+    with open('test.wav', 'wb') as test_file:
+        test_file.write(wave_header(384000, 0) + bytes(1001))
+    print('Repair, not closed. Data size: ', repair_wave_file('test.wav'))
+    wave_file = wave.open('test.wav', 'rb')
+    print('Frames: ', wave_file.getnframes())
+    wave_file.close()
+    os.remove('test.wav')
+    print('Test ended.')